@@ -0,0 +1,44 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class MediaGroupCollector:
+    """Gathers the items of an album, which Telegram delivers as one update per
+    file sharing a media_group_id.
+
+    A group is handed to `on_complete(items)` once no new item has arrived for
+    `window` seconds.
+    """
+
+    def __init__(self, on_complete, window=1.0):
+        self.on_complete = on_complete
+        self.window = window
+        self.groups = {}
+        self.timers = {}
+        self._tasks = set()
+
+    def add(self, group_id: str, item):
+        self.groups.setdefault(group_id, []).append(item)
+        timer = self.timers.get(group_id)
+        if timer:
+            timer.cancel()
+        self.timers[group_id] = asyncio.get_running_loop().call_later(self.window, self._complete, group_id)
+
+    def flush(self):
+        """Hand over every group now, without waiting out the window, e.g. on shutdown."""
+        for group_id, timer in list(self.timers.items()):
+            timer.cancel()
+            self._complete(group_id)
+
+    async def join(self):
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def _complete(self, group_id):
+        del self.timers[group_id]
+        items = self.groups.pop(group_id)
+        logger.info("Media group %s complete with %d items", group_id, len(items), extra={'event': 'media_group'})
+        task = asyncio.create_task(self.on_complete(items))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
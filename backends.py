@@ -0,0 +1,227 @@
+import time
+import random
+import logging
+import httpx
+from logs import transfer_id
+from metrics import BACKEND_BYTES, BACKEND_FAILURES, BACKEND_SECONDS, STAGE_SECONDS
+from transfer import SourceError, stream_upload
+
+logger = logging.getLogger(__name__)
+
+
+class UploadError(Exception):
+    """The destination answered, but did not accept the file."""
+
+
+def answer(response: httpx.Response) -> dict:
+    """The destination's JSON answer; one that is not JSON did not accept the file either."""
+    try:
+        return response.json()
+    except ValueError:
+        raise UploadError(f"Unexpected answer: {response.text[:200]}")
+
+
+class UploadResult:
+    def __init__(self, backend: str, file_hash: str, download_url: str, content_hash=None, latency=0.0, suffix=''):
+        self.backend = backend
+        self.file_hash = file_hash
+        self.download_url = download_url
+        # sha256 of the content, when the backend saw the whole stream
+        self.content_hash = content_hash
+        # Time the destination took to answer once it had the whole file
+        self.latency = latency
+        # Added to the file name on the way, e.g. ".gz" when it was compressed
+        self.suffix = suffix
+
+
+class UploadBackend:
+    name = "backend"
+    # Whether the backend reads the file by range (source.read_range) rather than as one stream
+    reads_ranges = False
+    # Probed before transfers to tell whether the host is up at all (see preflight.py); None for never
+    health_url = None
+
+    async def upload(self, source, file_path: str, filename: str, size: int, key: str, progress=None,
+                     throttle=None) -> UploadResult:
+        raise NotImplementedError
+
+
+class FilesVcBackend(UploadBackend):
+    """files.vc, or anything with the same single-request upload API."""
+
+    def __init__(self, pool, upload_url="https://api.files.vc/upload",
+                 download_url="https://files.vc/d/dl?hash={hash}", name="files.vc"):
+        self.pool = pool
+        self.upload_url = upload_url
+        self.download_url = download_url
+        self.name = name
+        self.health_url = upload_url
+
+    async def upload(self, source, file_path, filename, size, key, progress=None, throttle=None):
+        try:
+            streamer = await source.open(file_path, progress)
+        except Exception as e:
+            raise SourceError(str(e) or type(e).__name__) from e
+        streamer.throttle = throttle
+        response, content_hash, latency = await stream_upload(self.pool, streamer, filename, self.upload_url)
+        logger.info("API response: %s - %.200s", response.status_code, response.text, extra={'event': 'api_response'})
+        if response.status_code != 200:
+            raise UploadError(response.text)
+        result = answer(response)
+        if "debug_info" not in result or "hash" not in result["debug_info"]:
+            raise UploadError(result.get('message', 'Unknown error'))
+        file_hash = result["debug_info"]["hash"]
+        return UploadResult(self.name, file_hash, self.download_url.format(hash=file_hash), content_hash, latency,
+                            streamer.suffix)
+
+
+class ResumableBackend(UploadBackend):
+    """A target speaking resumable.ResumableUploader's chunked protocol, whose
+    final answer carries the download "url" and optionally a "hash"."""
+
+    reads_ranges = True
+
+    def __init__(self, uploader, name="resumable"):
+        self.uploader = uploader
+        self.name = name
+        self.health_url = uploader.url
+
+    async def upload(self, source, file_path, filename, size, key, progress=None, throttle=None):
+        started = time.monotonic()
+        timed = not getattr(source, 'times_first_byte', True)
+
+        async def read_range(offset, length):
+            nonlocal timed
+            if throttle:
+                await throttle(length)
+            try:
+                data = await source.read_range(file_path, offset, length)
+            except Exception as e:
+                raise SourceError(str(e) or type(e).__name__) from e
+            if not timed:
+                timed = True
+                STAGE_SECONDS.labels('first_byte').observe(time.monotonic() - started)
+            return data
+
+        # Checkpoints are per transfer, two transfers of one file sharing an upload session would corrupt it.
+        # A job resumed after a restart keeps its transfer id, and so its checkpoint
+        if transfer_id.get():
+            key = f"{key}-{transfer_id.get()}"
+        response = await self.uploader.upload(key, filename, size, read_range, progress)
+        logger.info("API response: %s - %.200s", response.status_code, response.text, extra={'event': 'api_response'})
+        result = answer(response)
+        if "url" not in result:
+            raise UploadError(result.get('message', 'Unknown error'))
+        # Chunks overlap, so only the completing request's time is attributable to the target
+        latency = min(response.elapsed.total_seconds(), time.monotonic() - started)
+        return UploadResult(self.name, result.get("hash", ""), result["url"], latency=latency)
+
+
+class BackendStats:
+    """Exponentially weighted moving averages of one backend's recent uploads."""
+
+    def __init__(self, alpha: float, half_life: float):
+        self.alpha = alpha
+        # Errors are forgiven over time, or a backend that failed once would
+        # look slow forever without new uploads to prove otherwise
+        self.half_life = half_life
+        self.error_updated = 0.0
+        self.throughput = None  # bytes/sec while the body was being sent
+        self.latency = None  # seconds from the end of the body to the answer
+        self.error_rate = 0.0
+        self.uploads = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.down_until = 0.0
+
+    def _ewma(self, current, sample):
+        return sample if current is None else current + self.alpha * (sample - current)
+
+    def success(self, size: int, elapsed: float, latency: float):
+        self.uploads += 1
+        self.consecutive_failures = 0
+        self.latency = self._ewma(self.latency, latency)
+        self.throughput = self._ewma(self.throughput, size / max(elapsed - latency, 1e-3))
+        self.error_rate = self._ewma(self.current_error_rate(), 0.0)
+        self.error_updated = time.monotonic()
+
+    def failure(self):
+        self.uploads += 1
+        self.failures += 1
+        self.consecutive_failures += 1
+        self.error_rate = self._ewma(self.current_error_rate(), 1.0)
+        self.error_updated = time.monotonic()
+
+    def current_error_rate(self) -> float:
+        return self.error_rate * 0.5 ** ((time.monotonic() - self.error_updated) / self.half_life)
+
+    def expected_time(self, size: int) -> float:
+        if self.throughput is None:
+            # Never measured: look as good as possible so it gets tried
+            return 0.0
+        seconds = (self.latency or 0.0) + size / self.throughput
+        return seconds / (1.0 - min(self.current_error_rate(), 0.9))
+
+    def as_dict(self):
+        return {'throughput': self.throughput, 'latency': self.latency, 'error_rate': round(self.current_error_rate(), 3),
+                'uploads': self.uploads, 'failures': self.failures, 'healthy': time.monotonic() >= self.down_until}
+
+
+class UploadRouter:
+    """Sends each file to the backend expected to finish it first and fails over
+    to the next one when an upload fails. Failing to read the file (a
+    SourceError) is raised as it is, without counting against the backend.
+
+    A backend that fails `max_failures` times in a row is taken out of rotation
+    for `cooldown` seconds. A small share of uploads (`explore`) go to a random
+    healthy backend so the estimates of the others stay current.
+    """
+
+    def __init__(self, backends, alpha=0.3, max_failures=3, cooldown=60.0, explore=0.05):
+        self.backends = list(backends)
+        self.backend_stats = {backend.name: BackendStats(alpha, cooldown) for backend in self.backends}
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.explore = explore
+
+    def ranked(self, size: int) -> list:
+        now = time.monotonic()
+        healthy = [b for b in self.backends if self.backend_stats[b.name].down_until <= now]
+        down = [b for b in self.backends if self.backend_stats[b.name].down_until > now]
+        healthy.sort(key=lambda b: self.backend_stats[b.name].expected_time(size))
+        if len(healthy) > 1 and random.random() < self.explore:
+            healthy.insert(0, healthy.pop(random.randrange(1, len(healthy))))
+        # Backends in cooldown are still a last resort rather than no upload at all
+        return healthy + down
+
+    async def upload(self, source, file_path, filename, size, key, progress=None, throttle=None) -> UploadResult:
+        error = UploadError("No upload backend can take this file")
+        for backend in self.ranked(size):
+            if backend.reads_ranges and not hasattr(source, 'read_range'):
+                # Compressed or archived on the way, so it only exists as a stream
+                continue
+            stats = self.backend_stats[backend.name]
+            started = time.monotonic()
+            try:
+                result = await backend.upload(source, file_path, filename, size, key, progress, throttle)
+            except (UploadError, httpx.HTTPError, OSError) as e:
+                # Anything else, a SourceError say, is no fault of the backend and no other would do better
+                stats.failure()
+                BACKEND_FAILURES.labels(backend.name).inc()
+                if stats.consecutive_failures >= self.max_failures:
+                    stats.down_until = time.monotonic() + self.cooldown
+                    logger.warning(f"Backend {backend.name} marked down for {self.cooldown:.0f}s")
+                logger.warning(f"Upload to {backend.name} failed: {e}")
+                error = e
+                continue
+            elapsed = time.monotonic() - started
+            stats.success(size, elapsed, result.latency)
+            STAGE_SECONDS.labels('transfer').observe(elapsed - result.latency)
+            STAGE_SECONDS.labels('upload_response').observe(result.latency)
+            BACKEND_BYTES.labels(backend.name).inc(size)
+            BACKEND_SECONDS.labels(backend.name).inc(elapsed)
+            return result
+        raise error
+
+    def stats(self) -> dict:
+        return {name: stats.as_dict() for name, stats in self.backend_stats.items()}
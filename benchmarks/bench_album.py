@@ -0,0 +1,76 @@
+"""An album sent as a batch vs the same files handled one update at a time.
+
+Feeds the updates of a --files item album into handle_file, a few ms apart as
+Telegram delivers them, once without a media_group_id (every item queued,
+uploaded and answered on its own) and once as a media group. Reports the
+wall time until the last answer and how many Bot API calls it took.
+
+    python -m benchmarks.bench_album --files 10 --size 4194304
+"""
+import argparse
+import asyncio
+import time
+
+import bot
+from albums import MediaGroupCollector
+from pool import HttpPool
+from scheduler import TransferScheduler
+from sources import BotApiSource
+from benchmarks.fakes import FakeBot, FakeContext, FakeFilesVc, FakeTelegramFiles, ServerThread, bot_services, document_update
+
+
+async def run_path(album, args, files, uploads):
+    pool = HttpPool()
+    scheduler = TransferScheduler(bot.TRANSFER_WORKERS)
+    scheduler.start()
+    bot_data = bot_services(pool, BotApiSource(pool), scheduler, f"{uploads.url}/upload",
+                            media_groups=MediaGroupCollector(bot.submit_album, args.window))
+    telegram = FakeBot(files, latency=args.api_latency)
+    context = FakeContext(telegram, bot_data)
+    group = f"album-{album}" if album else None
+    updates = [document_update(args.size, n + (1000 if album else 0), media_group_id=group, latency=args.api_latency)
+               for n in range(args.files)]
+
+    started = time.perf_counter()
+    for update in updates:
+        await bot.handle_file(update, context)
+        await asyncio.sleep(args.spacing)
+    if album:
+        # The batch only reaches the scheduler once the window has passed
+        while not any(update.message.replies for update in updates):
+            await asyncio.sleep(0.005)
+    await scheduler.join()
+    elapsed = time.perf_counter() - started
+    await scheduler.stop()
+    await pool.aclose()
+
+    replies = sum(len(update.message.replies) for update in updates)
+    answered = sum(reply.count('🔗') for update in updates for reply in update.message.replies)
+    print(f"== {'album' if album else 'per item'}")
+    print(f"wall time:     {elapsed:.2f}s")
+    print(f"links:         {answered}/{args.files}")
+    print(f"Bot API calls: {telegram.calls} getFile + {replies} messages/edits")
+    print(f"last answer:   {[r for u in updates for r in u.message.replies][-1].splitlines()[0]!r}")
+
+
+async def run(args):
+    with ServerThread(FakeTelegramFiles(rate=args.rate), FakeFilesVc(rate=args.rate)) as (files, uploads):
+        await run_path(False, args, files, uploads)
+        await run_path(True, args, files, uploads)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', type=int, default=10)
+    parser.add_argument('--size', type=int, default=4 * 1024 * 1024)
+    parser.add_argument('--rate', type=float, default=8 * 1024 * 1024, help="simulated bytes/sec per connection")
+    parser.add_argument('--api-latency', type=float, default=0.05, help="simulated Bot API round trip")
+    parser.add_argument('--spacing', type=float, default=0.01, help="seconds between the album's updates")
+    parser.add_argument('--window', type=float, default=bot.ALBUM_WINDOW)
+    args = parser.parse_args()
+    bot.logging.disable(bot.logging.INFO)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""Bandwidth and time saved by compressing uploads on the way, by file type.
+
+Sends one document of --size bytes per file type through handle_file, with
+files.vc accepting --upload-rate bytes/sec: once as it is and once per codec
+(gzip, and zstd when the zstandard package is installed). Reports the bytes
+that reached files.vc and the wall time of each. Then bundles one file of each
+type with /zip, once with every member stored and once deflated where it pays.
+
+    python -m benchmarks.bench_compression --size 33554432 --upload-rate 8388608
+"""
+import argparse
+import asyncio
+import itertools
+import time
+
+import bot
+from compress import get_codec, zstandard
+from pool import HttpPool
+from scheduler import TransferScheduler
+from sources import LocalBotApiSource
+from benchmarks.fakes import FakeBot, FakeContext, FakeFilesVc, FakeTelegramFiles, ServerThread, bot_services, document_update
+
+# (label, content served, file name sent)
+FILE_TYPES = [
+    ("log", "log", "server.log"),
+    ("csv", "csv", "export.csv"),
+    ("binary", "random", "backup.bin"),
+    ("jpeg", "random", "photo.jpg"),
+]
+
+FILE_IDS = itertools.count()
+
+
+async def send(codec, updates, archive, files, uploads, upload_url):
+    pool = HttpPool()
+    scheduler = TransferScheduler(1)
+    scheduler.start()
+    context = FakeContext(FakeBot(files), bot_services(pool, LocalBotApiSource(pool), scheduler, upload_url,
+                                                       codec=codec))
+    sent = uploads.uploaded_bytes
+    started = time.perf_counter()
+    if archive:
+        await bot.zip_files(updates[0], context)
+    for update in updates:
+        await bot.handle_file(update, context)
+    if archive:
+        await bot.zip_files(updates[0], context)
+    await scheduler.join()
+    elapsed = time.perf_counter() - started
+    await scheduler.stop()
+    await pool.aclose()
+    failed = [update.message.replies[-1] for update in updates if '✅' not in update.message.replies[-1]]
+    if archive:
+        failed = [reply for reply in updates[0].message.replies[-1:] if '✅' not in reply]
+    return uploads.uploaded_bytes - sent, elapsed, failed
+
+
+def report(label, mode, total, sent, elapsed, baseline, failed):
+    saved = f"{1 - sent / baseline[0]:4.0%} fewer bytes, {1 - elapsed / baseline[1]:4.0%} less time" if baseline else ""
+    print(f"{label:8s} {mode:9s} {sent / 2**20:7.1f}MB of {total / 2**20:5.1f}MB  {elapsed:6.2f}s  {saved}"
+          f"{'  FAILED ' + failed[0] if failed else ''}")
+
+
+async def run(args):
+    codecs = [get_codec("gzip")] + ([get_codec("zstd")] if zstandard else [])
+    with ServerThread(FakeTelegramFiles(rate=args.download_rate), FakeFilesVc(rate=args.upload_rate)) as (
+            files, uploads):
+        upload_url = f"{uploads.url}/upload"
+        print(f"{args.size / 2**20:.0f}MB per file, upload {args.upload_rate / 2**20:.0f}MB/s")
+        for label, kind, file_name in FILE_TYPES:
+            baseline = None
+            for codec in [None, *codecs]:
+                # A new file id each time, or the upload cache would answer
+                update = document_update(args.size, next(FILE_IDS), kind=kind, file_name=file_name)
+                sent, elapsed, failed = await send(codec, [update], False, files, uploads, upload_url)
+                report(label, codec.name if codec else "as is", args.size, sent, elapsed, baseline, failed)
+                baseline = baseline or (sent, elapsed)
+
+        baseline = None
+        for mode, max_ratio in (("stored", 0.0), ("deflated", args.max_ratio)):
+            bot.COMPRESSION_MAX_RATIO = max_ratio
+            updates = [document_update(args.size, next(FILE_IDS), kind=kind, file_name=file_name)
+                       for _, kind, file_name in FILE_TYPES]
+            sent, elapsed, failed = await send(None, updates, True, files, uploads, upload_url)
+            report("/zip", mode, args.size * len(updates), sent, elapsed, baseline, failed)
+            baseline = baseline or (sent, elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=32 * 1024 * 1024)
+    parser.add_argument('--download-rate', type=float, default=0, help="simulated bytes/sec, 0 for unlimited")
+    parser.add_argument('--upload-rate', type=float, default=8 * 1024 * 1024, help="simulated bytes/sec")
+    parser.add_argument('--max-ratio', type=float, default=bot.COMPRESSION_MAX_RATIO)
+    args = parser.parse_args()
+    bot.logging.disable(bot.logging.WARNING)
+    bot.PROGRESS_MIN_SIZE = args.size * len(FILE_TYPES) + 1
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
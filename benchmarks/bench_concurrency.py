@@ -0,0 +1,104 @@
+"""Per-update latency while many transfers are in flight.
+
+Runs N concurrent handle_file calls against the local stand-ins and keeps
+answering /start every 50ms, reporting how long each /start took. With
+--blocking the transfers use a synchronous client on the event loop, which is
+how bot.py used to behave.
+
+    python -m benchmarks.bench_concurrency --transfers 16 --size 4194304
+"""
+import argparse
+import asyncio
+import statistics
+import time
+import httpx
+
+import bot
+from pool import HttpPool
+from scheduler import TransferScheduler
+from sources import BotApiSource
+from benchmarks.fakes import FakeBot, FakeContext, FakeFilesVc, FakeMessage, FakeTelegramFiles, FakeUpdate, ServerThread, bot_services, document_update
+
+
+async def blocking_transfer(update, context):
+    # The pre-async path: download and upload with a synchronous client on the loop
+    document = update.message.document
+    file_obj = await context.bot.get_file(document.file_id)
+    with httpx.Client(timeout=120) as client:
+        data = client.get(file_obj.file_path).content
+        client.post(bot.API_UPLOAD_URL, files={'file': (document.file_name, data)})
+    await update.message.reply_text("✅ Upload successful!")
+
+
+async def probe_start(stop: asyncio.Event, latencies: list, context, interval=0.05):
+    # A /start "arrives" every interval; latency runs from arrival to reply, so
+    # time spent waiting for a blocked loop counts against it
+    while not stop.is_set():
+        arrival = time.perf_counter() + interval
+        await asyncio.sleep(interval)
+        await bot.start(FakeUpdate(FakeMessage()), context)
+        latencies.append(time.perf_counter() - arrival)
+
+
+async def run(args):
+    with ServerThread(FakeTelegramFiles(rate=args.rate), FakeFilesVc(rate=args.rate)) as (files, uploads):
+        bot.API_UPLOAD_URL = f"{uploads.url}/upload"
+        pool = HttpPool(max_connections=args.connections, max_keepalive=args.connections)
+        scheduler = TransferScheduler(args.workers, args.transfers, args.transfers)
+        scheduler.start()
+        bot_data = bot_services(pool, BotApiSource(pool), scheduler, bot.API_UPLOAD_URL)
+        context = FakeContext(FakeBot(files), bot_data)
+        handler = blocking_transfer if args.blocking else bot.handle_file
+        updates = [document_update(args.size, n, user_id=n % args.users) for n in range(args.transfers)]
+        # One warm-up transfer so first-use imports are not counted as loop stalls
+        await handler(document_update(1024), context)
+        await scheduler.join()
+
+        latencies = []
+        stop = asyncio.Event()
+        prober = asyncio.create_task(probe_start(stop, latencies, context))
+        # Let the prober take a baseline sample before the burst lands
+        await asyncio.sleep(0.1)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(handler(update, context) for update in updates))
+        await scheduler.join()
+        elapsed = time.perf_counter() - started
+        stop.set()
+        await prober
+        pool_stats = pool.stats()
+        await pool.aclose()
+        await scheduler.stop()
+        connections = {'telegram': files.connections, 'files.vc': uploads.connections}
+
+    ok = sum(1 for update in updates if update.message.replies and update.message.replies[-1].startswith('✅'))
+    latencies_ms = sorted(latency * 1000 for latency in latencies)
+    p99 = latencies_ms[min(len(latencies_ms) - 1, int(len(latencies_ms) * 0.99))]
+    print(f"mode:               {'blocking' if args.blocking else 'async'}")
+    print(f"transfers:          {ok}/{args.transfers} ok, {args.size} bytes each")
+    print(f"wall time:          {elapsed:.2f}s ({args.transfers * args.size / elapsed / 1e6:.1f} MB/s)")
+    print(f"/start samples:     {len(latencies_ms)}")
+    print(f"/start latency p50: {statistics.median(latencies_ms):.2f}ms")
+    print(f"/start latency p99: {p99:.2f}ms")
+    print(f"/start latency max: {latencies_ms[-1]:.2f}ms")
+    print(f"connections opened: {connections}")
+    if not args.blocking:
+        for host, stats in pool_stats.items():
+            print(f"pool {host}: {stats}")
+        print(f"scheduler:          {scheduler.stats()}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--transfers', type=int, default=16)
+    parser.add_argument('--size', type=int, default=4 * 1024 * 1024)
+    parser.add_argument('--rate', type=float, default=16 * 1024 * 1024, help="simulated bytes/sec per connection")
+    parser.add_argument('--workers', type=int, default=16, help="transfer workers")
+    parser.add_argument('--users', type=int, default=4, help="spread transfers over this many users")
+    parser.add_argument('--connections', type=int, default=20, help="pool size per host")
+    parser.add_argument('--blocking', action='store_true', help="use the old synchronous transfer path")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
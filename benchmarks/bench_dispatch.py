@@ -0,0 +1,93 @@
+"""Answers lost to Bot API flood limits, with the calls made as they come and through the dispatcher.
+
+Runs `python bot.py` against the Bot API stand-in, which answers a bot
+making more than --token-rate calls a second, or sending more than
+--chat-rate messages a second into one chat, with a 429 and a retry_after
+of --retry-after seconds. --users users each send --files documents at
+once in their private chats, --big of them large enough to get a progress
+message, edited every --progress-interval seconds while the upload runs.
+First with the budgets off and 429s raised, as before the dispatcher, then
+with its defaults. Reports the time until every file was answered (or
+--timeout), the links, errors and files never answered, the 429s, and the
+flood waits and coalesced edits from the bot's /metrics.
+
+    python -m benchmarks.bench_dispatch --users 20 --files 4 --chat-rate 1
+"""
+import argparse
+import os
+import re
+import tempfile
+import time
+
+import httpx
+
+from benchmarks.bench_shards import free_port
+from benchmarks.bench_startup import launch, stop, wait_for
+from benchmarks.fakes import FakeBotApi, FakeFilesVc, ServerThread, document_message_update
+
+UNBUDGETED = dict(BOT_API_RATE=0, BOT_API_CHAT_RATE=0, BOT_API_GROUP_PER_MINUTE=0, BOT_API_MAX_FLOOD_WAIT=0)
+COALESCED = 'reason="coalesced"'
+
+
+def metric(text, name, labels=''):
+    return sum(float(value) for value in re.findall(rf'^{name}(?:\{{{labels}[^}}]*\}})? (\S+)$', text, re.M))
+
+
+def run(label, args, api, uploads, directory, log, first_chat, **env):
+    chats = range(first_chat, first_chat + args.users)
+    port = free_port()
+    floods = sum(api.floods.values())
+    edits = api.calls.get('editMessageText', 0)
+    process = launch(api, uploads, directory, log, METRICS_PORT=port, METRICS_LISTEN='127.0.0.1',
+                     PROGRESS_MIN_SIZE=args.big_size, PROGRESS_INTERVAL=args.progress_interval,
+                     TRANSFER_WORKERS=args.workers, MAX_QUEUED=args.users * args.files,
+                     MAX_QUEUED_PER_USER=args.files, **env)
+    wait_for(lambda: api.polling, args.timeout)
+    started = time.perf_counter()
+    for chat in chats:
+        for n in range(args.files):
+            size = args.big_size if n < args.big else args.size
+            api.push_update(document_message_update(size, chat, message_id=chat * 100 + n))
+
+    def count(mark):
+        return sum(sum(mark in text for text in api.texts.get(chat, [])) for chat in chats)
+
+    wait_for(lambda: count('✅') + count('⚠️') + count('❌') >= args.users * args.files, args.timeout)
+    elapsed = time.perf_counter() - started
+    links, errors = count('✅'), count('⚠️') + count('❌')
+    text = httpx.get(f"http://127.0.0.1:{port}/metrics").text
+    stop(process, args.timeout)
+    print(f"{label:12s} {elapsed:6.2f}s  {links:3d} links, {errors:3d} errors, "
+          f"{args.users * args.files - links - errors:3d} never answered, "
+          f"{sum(api.floods.values()) - floods:4d} 429s, {api.calls.get('editMessageText', 0) - edits:4d} edits, "
+          f"{metric(text, 'bot_api_flood_waits_total'):.0f} flood waits, "
+          f"{metric(text, 'bot_api_calls_dropped_total', COALESCED):.0f} edits coalesced")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--files', type=int, default=4, help="files per user")
+    parser.add_argument('--big', type=int, default=1, help="files per user big enough for progress edits")
+    parser.add_argument('--size', type=int, default=64 * 1024)
+    parser.add_argument('--big-size', type=int, default=16 * 1024 * 1024)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--upload-rate', type=float, default=4 * 1024 * 1024, help="simulated bytes/sec")
+    parser.add_argument('--progress-interval', type=float, default=0.5)
+    parser.add_argument('--chat-rate', type=float, default=1, help="messages/sec a bot may send into one chat")
+    parser.add_argument('--token-rate', type=float, default=30, help="calls/sec a bot may make")
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--timeout', type=float, default=120)
+    parser.add_argument('--log', default=os.devnull, help="where the bot's output goes")
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory, open(args.log, 'wb') as log, \
+            ServerThread(FakeBotApi(token_rate=args.token_rate, chat_rate=args.chat_rate,
+                                    retry_after=args.retry_after), FakeFilesVc(rate=args.upload_rate)) as (api, uploads):
+        print(f"{args.users} users x {args.files} files ({args.big} of {args.big_size / 2**20:.0f}MB each), "
+              f"{args.token_rate:g} calls/s per bot, {args.chat_rate:g} messages/s per chat")
+        run("as they come", args, api, uploads, directory, log, 1_000, **UNBUDGETED)
+        run("dispatched", args, api, uploads, directory, log, 2_000)
+
+
+if __name__ == "__main__":
+    main()
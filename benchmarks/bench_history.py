@@ -0,0 +1,105 @@
+"""/myfiles and /search lookups against a large upload history.
+
+Fills a history database with --rows synthetic uploads spread over --users
+users, plus one heavy user with --heavy rows, then times page and search
+lookups for a typical and for the heavy user, and the cost of recording
+uploads on the event loop.
+
+    python -m benchmarks.bench_history --rows 2000000 --users 50000
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import tempfile
+import time
+
+from history import UploadHistory
+
+WORDS = ['report', 'invoice', 'photo', 'backup', 'video', 'notes', 'scan', 'draft', 'final', 'holiday']
+EXTENSIONS = ['pdf', 'jpg', 'mp4', 'zip', 'docx']
+
+
+def synthetic_rows(count, user_ids, rng):
+    now = time.time()
+    for n in range(count):
+        name = f"{rng.choice(WORDS)}_{rng.choice(WORDS)}_{n}.{rng.choice(EXTENSIONS)}"
+        yield (rng.choice(user_ids), f"uid{n}", name, rng.randrange(1, 2**31), 'files.vc', f"{n:016x}",
+               f"https://files.vc/d/dl?hash={n:016x}", now - count + n)
+
+
+def fill(history, args):
+    rng = random.Random(1)
+    users = list(range(1, args.users + 1))
+    heavy = args.users + 1
+    started = time.perf_counter()
+    batch = []
+    for row in synthetic_rows(args.rows, users, rng):
+        batch.append(row)
+        if len(batch) == 50_000:
+            history._write(batch)
+            batch = []
+    history._write(batch + list(synthetic_rows(args.heavy, [heavy], rng)))
+    return time.perf_counter() - started, heavy
+
+
+async def timed(coro_factory, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = await coro_factory()
+        samples.append((time.perf_counter() - started) * 1000)
+    samples.sort()
+    return statistics.median(samples), samples[min(len(samples) - 1, int(len(samples) * 0.99))], result
+
+
+async def run(args, path):
+    history = UploadHistory(path)
+    elapsed, heavy = fill(history, args)
+    size_mb = os.path.getsize(path) / 2**20
+    print(f"history:     {args.rows + args.heavy} rows, {args.users + 1} users, {size_mb:.0f}MB, filled in {elapsed:.1f}s")
+
+    typical = args.users // 2
+    for label, factory in [
+        ("/myfiles, typical user", lambda: history.page(typical, 1)),
+        ("/myfiles, heavy user p1", lambda: history.page(heavy, 1)),
+        ("/myfiles, heavy user p500", lambda: history.page(heavy, 500)),
+        ("/search, typical user", lambda: history.search(typical, 'invoice')),
+        ("/search, heavy user", lambda: history.search(heavy, 'holiday_report')),
+        ("/search, heavy user, rare", lambda: history.search(heavy, f"_{args.heavy - 5}.")),
+        ("/search, heavy user, none", lambda: history.search(heavy, 'nothing-like-this')),
+    ]:
+        p50, p99, result = await timed(factory, args.repeat)
+        found = len(result[0]) if isinstance(result, tuple) else len(result)
+        print(f"{label:27s} p50 {p50:6.2f}ms  p99 {p99:6.2f}ms  ({found} rows)")
+
+    history.start()
+    loop_ms = []
+    for n in range(args.records):
+        started = time.perf_counter()
+        history.record(typical, f"new{n}", f"new_{n}.bin", 1024, 'files.vc', 'hash', 'https://files.vc/d/dl?hash=x')
+        loop_ms.append((time.perf_counter() - started) * 1000)
+        if n % 100 == 0:
+            await asyncio.sleep(0)
+    started = time.perf_counter()
+    files, total = await history.page(typical, 1)
+    print(f"record:      {statistics.mean(loop_ms) * 1000:.1f}us on the loop per upload; "
+          f"{args.records} then visible after {(time.perf_counter() - started) * 1000:.1f}ms ({files[0]['name']})")
+    await history.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=2_000_000)
+    parser.add_argument('--users', type=int, default=50_000)
+    parser.add_argument('--heavy', type=int, default=100_000, help="rows of the one heavy user")
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--records', type=int, default=10_000)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        asyncio.run(run(args, os.path.join(directory, 'history.db')))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""Large-file transfers through a local Bot API server, with peak memory.
+
+Sends one document of --size bytes through handle_file using a real PTB Bot
+in local mode against the Bot API stand-in. With --http the stand-in hands out
+paths that only exist on "its" machine, so the file is streamed over HTTP;
+otherwise it is read from disk. Peak RSS should stay flat whatever the size.
+
+    python -m benchmarks.bench_large_file --size 1073741824
+"""
+import argparse
+import asyncio
+import resource
+import tempfile
+import time
+from telegram import Bot
+
+import bot
+from pool import HttpPool
+from scheduler import TransferScheduler
+from sources import LocalBotApiSource
+from benchmarks.fakes import FakeBotApi, FakeContext, FakeFilesVc, ServerThread, bot_services, document_update
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def run(args, local_dir):
+    with ServerThread(FakeBotApi(local_dir=local_dir, local_http=args.http), FakeFilesVc()) as (api, uploads):
+        pool = HttpPool()
+        scheduler = TransferScheduler(1)
+        scheduler.start()
+        telegram_bot = Bot('123456:BENCH', base_url=api.base_url, base_file_url=api.base_file_url, local_mode=True)
+        bot_data = bot_services(pool, LocalBotApiSource(pool), scheduler, f"{uploads.url}/upload")
+        context = FakeContext(telegram_bot, bot_data)
+        async with telegram_bot:
+            update = document_update(args.size)
+            rss_before = peak_rss_mb()
+            started = time.perf_counter()
+            await bot.handle_file(update, context)
+            await scheduler.join()
+            elapsed = time.perf_counter() - started
+        await scheduler.stop()
+        await pool.aclose()
+
+    print(f"source:        {'local server over HTTP' if args.http else 'local server directory'}")
+    print(f"file size:     {args.size / 2**20:.0f}MB")
+    print(f"uploaded:      {uploads.uploaded_bytes} bytes in {elapsed:.1f}s ({args.size / elapsed / 2**20:.0f}MB/s)")
+    print(f"reply:         {update.message.replies[-1]!r}")
+    print(f"peak RSS:      {rss_before:.0f}MB before, {peak_rss_mb():.0f}MB after")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=1024 * 1024 * 1024)
+    parser.add_argument('--http', action='store_true', help="fetch over HTTP instead of from disk")
+    args = parser.parse_args()
+    bot.logging.disable(bot.logging.INFO)
+    with tempfile.TemporaryDirectory() as local_dir:
+        asyncio.run(run(args, local_dir))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""Event loop stalls caused by logging, with it off, written on the loop, and queued.
+
+Sends --files small documents through handle_file to --workers transfer
+workers while a probe task sleeps --interval at a time and records how late
+it wakes up. Log lines go to a sink that takes --write-delay per write, like
+a terminal or pipe whose reader falls behind. Modes: logging off, the old
+synchronous handler, the queued handler in text and in JSON, and JSON with
+every event sampled at --sample. Reports the wall time, the probe's lag
+(p50, p99, max, and the total beyond the interval) and the lines written and
+dropped.
+
+    python -m benchmarks.bench_logging --files 400 --write-delay 0.0005
+"""
+import argparse
+import asyncio
+import logging
+import statistics
+import time
+
+import bot
+import logs
+from metrics import LOG_LINES_DROPPED
+from pool import HttpPool
+from scheduler import TransferScheduler
+from sources import BotApiSource
+from benchmarks.fakes import FakeBot, FakeContext, FakeFilesVc, FakeTelegramFiles, ServerThread, bot_services, document_update
+
+EVENTS = ('file', 'cache_hit', 'file_path', 'uploaded', 'api_response', 'transferred', 'httpx')
+
+
+class SlowSink:
+    """A stream whose every write takes `delay` seconds; counts the lines written."""
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.lines = 0
+
+    def write(self, text):
+        time.sleep(self.delay)
+        self.lines += text.count('\n')
+
+    def flush(self):
+        pass
+
+
+async def probe(stop, lags, interval):
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - started - interval)
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+async def send(args, files, uploads):
+    pool = HttpPool()
+    scheduler = TransferScheduler(args.workers, max_queued=args.files, max_queued_per_user=args.files)
+    scheduler.start()
+    context = FakeContext(FakeBot(files), bot_services(pool, BotApiSource(pool), scheduler, f"{uploads.url}/upload"))
+    # One warm-up transfer so first-use imports are not counted as loop stalls
+    await bot.handle_file(document_update(1024, -1), context)
+    await scheduler.join()
+    updates = [document_update(args.size, n, user_id=n % 50) for n in range(args.files)]
+    stop, lags = asyncio.Event(), []
+    prober = asyncio.create_task(probe(stop, lags, args.interval))
+    started = time.perf_counter()
+    for update in updates:
+        await bot.handle_file(update, context)
+    await scheduler.join()
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await prober
+    await scheduler.stop()
+    await pool.aclose()
+    return elapsed, lags
+
+
+async def run(args):
+    sample = {event: args.sample for event in EVENTS}
+    modes = [
+        ("off", None),
+        ("on the loop", dict(fmt="text", queue_size=0)),
+        ("queued text", dict(fmt="text")),
+        ("queued json", dict(fmt="json")),
+        (f"json {args.sample:.0%} kept", dict(fmt="json", sample=sample)),
+    ]
+    with ServerThread(FakeTelegramFiles(), FakeFilesVc()) as (files, uploads):
+        print(f"{args.files} files of {args.size}B, {args.workers} workers, "
+              f"{args.write_delay * 1000:.2f}ms per log write")
+        for label, options in modes:
+            sink = SlowSink(args.write_delay)
+            dropped = {reason: LOG_LINES_DROPPED.labels(reason).value for reason in ('sampled', 'queue_full')}
+            logging.disable(logging.CRITICAL if options is None else logging.NOTSET)
+            logs.setup_logging(stream=sink, **(options or {}))
+            elapsed, lags = await send(args, files, uploads)
+            # Lines still queued are written before counting
+            logs.setup_logging(stream=SlowSink(0))
+            dropped = {reason: LOG_LINES_DROPPED.labels(reason).value - count for reason, count in dropped.items()}
+            stalled = sum(lags)
+            print(f"{label:14s} {elapsed:6.2f}s  lag p50 {statistics.median(lags) * 1000:5.2f}ms "
+                  f"p99 {percentile(lags, 0.99) * 1000:6.2f}ms max {max(lags) * 1000:6.2f}ms  "
+                  f"stalled {stalled:5.2f}s  {sink.lines:5d} lines, {dropped['sampled']:.0f} sampled out, "
+                  f"{dropped['queue_full']:.0f} dropped")
+    logging.disable(logging.NOTSET)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', type=int, default=400)
+    parser.add_argument('--size', type=int, default=16 * 1024)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--write-delay', type=float, default=0.0005, help="seconds each log write takes")
+    parser.add_argument('--interval', type=float, default=0.001, help="seconds the probe sleeps at a time")
+    parser.add_argument('--sample', type=float, default=0.1, help="share of lines kept in the sampled mode")
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
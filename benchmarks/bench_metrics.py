@@ -0,0 +1,110 @@
+"""Cost of the metrics instrumentation, and what a scrape returns.
+
+Times the individual metric operations, counts how many of them one file
+goes through handle_file with, and sets that against the CPU time the file
+costs as a whole. Then scrapes the /metrics endpoint once.
+
+    python -m benchmarks.bench_metrics --files 200 --size 1048576
+"""
+import argparse
+import asyncio
+import time
+import timeit
+import httpx
+
+import bot
+import metrics
+from pool import HttpPool
+from scheduler import TransferScheduler
+from sources import BotApiSource
+from benchmarks.fakes import FakeBot, FakeContext, FakeFilesVc, FakeTelegramFiles, ServerThread, bot_services, document_update
+
+
+def per_op_ns():
+    registry = metrics.Registry()
+    counter = metrics.Counter('bench_total', "bench", ['backend'], registry=registry)
+    histogram = metrics.Histogram('bench_seconds', "bench", ['stage'], registry=registry)
+    n = 200_000
+
+    def timed():
+        with histogram.labels('reply').time():
+            pass
+
+    timings = {
+        'counter inc': timeit.timeit(lambda: counter.labels('files.vc').inc(4096), number=n),
+        'histogram observe': timeit.timeit(lambda: histogram.labels('transfer').observe(0.42), number=n),
+        'histogram timer': timeit.timeit(timed, number=n),
+        'empty lambda': timeit.timeit(lambda: None, number=n),
+    }
+    baseline = timings.pop('empty lambda')
+    return {name: (seconds - baseline) / n * 1e9 for name, seconds in timings.items()}
+
+
+def count_ops():
+    # Wrap the leaf operations so a run can report how many it went through
+    ops = [0]
+    for cls, name in [(metrics._Value, 'inc'), (metrics._Value, 'dec'), (metrics._Buckets, 'observe')]:
+        original = getattr(cls, name)
+
+        def counted(self, *args, _original=original):
+            ops[0] += 1
+            return _original(self, *args)
+        setattr(cls, name, counted)
+    return ops
+
+
+async def run(args):
+    # Before count_ops() wraps the operations being timed
+    costs = per_op_ns()
+    with ServerThread(FakeTelegramFiles(), FakeFilesVc()) as (files, uploads):
+        pool = HttpPool()
+        scheduler = TransferScheduler(8, args.files, args.files)
+        scheduler.start()
+        bot_data = bot_services(pool, BotApiSource(pool), scheduler, f"{uploads.url}/upload")
+        context = FakeContext(FakeBot(files), bot_data)
+        await bot.handle_file(document_update(1024, -1), context)
+        await scheduler.join()
+
+        ops = count_ops()
+        cpu = time.process_time()
+        for n in range(args.files):
+            await bot.handle_file(document_update(args.size, n, user_id=n % 8), context)
+        await scheduler.join()
+        cpu_per_file = (time.process_time() - cpu) / args.files
+        ops_per_file = ops[0] / args.files
+
+        server = metrics.MetricsServer(host='127.0.0.1', port=0)
+        await server.start()
+        async with httpx.AsyncClient() as client:
+            started = time.perf_counter()
+            scrape = await client.get(f"http://127.0.0.1:{server.port}/metrics")
+            scrape_ms = (time.perf_counter() - started) * 1000
+        await server.stop()
+        await scheduler.stop()
+        await pool.aclose()
+
+    worst = max(costs.values())
+    print("per operation:")
+    for name, ns in costs.items():
+        print(f"  {name:18s} {ns:6.0f}ns")
+    print(f"operations/file:    {ops_per_file:.1f}")
+    print(f"CPU/file:           {cpu_per_file * 1e6:.0f}us for {args.size / 1024:.0f}KB")
+    print(f"overhead/file:      <= {ops_per_file * worst / 1000:.1f}us "
+          f"({ops_per_file * worst / 1e9 / cpu_per_file:.3%} of CPU)")
+    print(f"scrape:             HTTP {scrape.status_code}, {len(scrape.content)} bytes in {scrape_ms:.1f}ms")
+    for line in scrape.text.splitlines():
+        if line.startswith(('upload_stage_seconds_count', 'upload_stage_seconds_sum', 'backend_', 'transfers_')):
+            print(f"  {line}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', type=int, default=200)
+    parser.add_argument('--size', type=int, default=1024 * 1024)
+    args = parser.parse_args()
+    bot.logging.disable(bot.logging.INFO)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
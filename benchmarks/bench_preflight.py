@@ -0,0 +1,92 @@
+"""Transfers saved by the pre-flight checks on files that cannot be uploaded.
+
+Sends --files documents of --size bytes through handle_file to --workers
+transfer workers, with and without the pre-flight checks, in three cases:
+every file fine, a --blocked share of them executables under harmless names
+(with BLOCKED_TYPES set to refuse them), and files.vc down. Reports the time
+until every file was answered, the bytes downloaded from Telegram and
+accepted by files.vc, and the rejects by reason. Blocked files are uploaded
+when nothing checks them, as nothing else would know to refuse them.
+
+    python -m benchmarks.bench_preflight --files 20 --size 8388608
+"""
+import argparse
+import asyncio
+import itertools
+import random
+import time
+
+import bot
+from metrics import PREFLIGHT_REJECTS
+from pool import HttpPool
+from preflight import HealthCheck, Preflight
+from scheduler import TransferScheduler
+from sources import BotApiSource
+from benchmarks.fakes import FakeBot, FakeContext, FakeFilesVc, FakeTelegramFiles, ServerThread, bot_services, document_update
+
+BLOCKED_TYPES = ["application/x-msdownload"]
+REASONS = ('blocked_type', 'unavailable', 'destination_down')
+FILE_IDS = itertools.count()
+
+
+async def send(checked, blocked, args, files, uploads):
+    pool = HttpPool()
+    scheduler = TransferScheduler(args.workers, max_queued=args.files)
+    scheduler.start()
+    upload_url = f"{uploads.url}/upload"
+    services = bot_services(pool, BotApiSource(pool), scheduler, upload_url)
+    if checked:
+        services['preflight'] = Preflight(services['file_source'], services['upload_router'], HealthCheck(pool),
+                                          BLOCKED_TYPES)
+    context = FakeContext(FakeBot(files), services)
+    rng = random.Random(args.seed)
+    updates = [document_update(args.size, next(FILE_IDS), kind='exe' if rng.random() < blocked else None)
+               for _ in range(args.files)]
+    downloaded, uploaded = files.sent_bytes, uploads.uploaded_bytes
+    rejects = {reason: PREFLIGHT_REJECTS.labels(reason).value for reason in REASONS}
+    started = time.perf_counter()
+    await asyncio.gather(*(bot.handle_file(update, context) for update in updates))
+    await asyncio.wait_for(asyncio.gather(*(update.message.answered.wait() for update in updates)), 600)
+    elapsed = time.perf_counter() - started
+    await scheduler.stop()
+    await pool.aclose()
+    rejects = {reason: PREFLIGHT_REJECTS.labels(reason).value - rejects[reason] for reason in REASONS}
+    return elapsed, files.sent_bytes - downloaded, uploads.uploaded_bytes - uploaded, rejects
+
+
+async def run(args):
+    cases = [("all fine", 0.0, False), (f"{args.blocked:.0%} blocked", args.blocked, False),
+             ("files.vc down", 0.0, True)]
+    with ServerThread(FakeTelegramFiles(rate=args.download_rate, latency=args.latency),
+                      FakeFilesVc(rate=args.upload_rate)) as (files, uploads):
+        print(f"{args.files} files of {args.size / 2**20:.0f}MB, {args.workers} workers, "
+              f"download {args.download_rate / 2**20:.0f}MB/s, upload {args.upload_rate / 2**20:.0f}MB/s")
+        for label, blocked, down in cases:
+            uploads.failing = down
+            for checked in (False, True):
+                elapsed, downloaded, uploaded, rejects = await send(checked, blocked, args, files, uploads)
+                rejected = ", ".join(f"{count} {reason}" for reason, count in rejects.items() if count) or "none"
+                print(f"{label:14s} {'checked' if checked else 'unchecked':9s} answered in {elapsed:6.2f}s  "
+                      f"downloaded {downloaded / 2**20:7.1f}MB  uploaded {uploaded / 2**20:7.1f}MB  "
+                      f"rejected: {rejected}")
+        uploads.failing = False
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', type=int, default=20)
+    parser.add_argument('--size', type=int, default=8 * 1024 * 1024)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--blocked', type=float, default=0.25, help="share of files with a blocked type")
+    parser.add_argument('--latency', type=float, default=0.05, help="simulated time to first byte per download")
+    parser.add_argument('--download-rate', type=float, default=16 * 1024 * 1024, help="simulated bytes/sec")
+    parser.add_argument('--upload-rate', type=float, default=16 * 1024 * 1024, help="simulated bytes/sec")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    bot.logging.disable(bot.logging.ERROR)
+    bot.PROGRESS_MIN_SIZE = args.size + 1
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""Parallel ranged downloads against one stream, over links with a long round trip.
+
+Downloads a --size file from the Telegram file stand-in, once over a single
+stream and once as parallel Range requests, for each case: a per-connection
+cap (what one TCP window gets over the round trip) well under the link, a
+link that one connection already fills, and a server without Range support.
+Reports time, throughput, the speedup, how many ranges ran at once at the
+end and how many requests were made. The content hash is checked each time.
+
+    python -m benchmarks.bench_ranged --size 67108864 --latency 0.1
+"""
+import argparse
+import asyncio
+import hashlib
+import time
+
+from pool import HttpPool
+from sources import BotApiSource
+from benchmarks.fakes import FakeTelegramFiles, ServerThread, payload_at
+
+
+async def download(files, size, max_ranges, args):
+    pool = HttpPool()
+    source = BotApiSource(pool, max_ranges, args.range_size, args.buffer_size)
+    source.max_file_size = size
+    requests = files.requests
+    started = time.perf_counter()
+    streamer = await source.open(files.file_url(size))
+    try:
+        async for _ in streamer:
+            pass
+    finally:
+        await streamer.close()
+    elapsed = time.perf_counter() - started
+    await pool.aclose()
+    width = streamer.width if getattr(streamer, 'parallel', False) else 1
+    return elapsed, streamer.sha256.hexdigest(), width, files.requests - requests
+
+
+async def run(args):
+    expected = hashlib.sha256(payload_at(0, args.size)).hexdigest()
+    cases = [
+        ("window-bound", dict(rate=args.connection_rate, link_rate=args.link_rate)),
+        ("link-bound", dict(rate=args.link_rate, link_rate=args.link_rate)),
+        ("no ranges", dict(rate=args.connection_rate, link_rate=args.link_rate, ranges=False)),
+    ]
+    print(f"{args.size / 2**20:.0f}MB, round trip {args.latency * 1000:.0f}ms, "
+          f"{args.connection_rate / 2**20:.0f}MB/s per connection, link {args.link_rate / 2**20:.0f}MB/s")
+    for label, options in cases:
+        with ServerThread(FakeTelegramFiles(latency=args.latency, **options)) as (files,):
+            baseline = None
+            for max_ranges in (1, args.max_ranges):
+                elapsed, digest, width, requests = await download(files, args.size, max_ranges, args)
+                baseline = baseline or elapsed
+                mode = "one stream" if max_ranges == 1 else f"ranges<={max_ranges}"
+                print(f"{label:13s} {mode:11s} {elapsed:6.2f}s {args.size / elapsed / 2**20:6.1f}MB/s "
+                      f"x{baseline / elapsed:4.1f}  {width} at once at the end, {requests} requests"
+                      f"{'' if digest == expected else '  CONTENT MISMATCH'}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=64 * 1024 * 1024)
+    parser.add_argument('--latency', type=float, default=0.1, help="simulated time to first byte per request")
+    parser.add_argument('--connection-rate', type=float, default=4 * 1024 * 1024, help="bytes/sec per connection")
+    parser.add_argument('--link-rate', type=float, default=32 * 1024 * 1024, help="bytes/sec for all connections")
+    parser.add_argument('--max-ranges', type=int, default=8)
+    parser.add_argument('--range-size', type=int, default=2 * 1024 * 1024)
+    parser.add_argument('--buffer-size', type=int, default=32 * 1024 * 1024)
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
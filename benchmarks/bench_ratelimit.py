@@ -0,0 +1,88 @@
+"""What the rate limiter costs per update, and how closely it shapes bandwidth.
+
+Times admit() for a small set of returning users and for a stream of distinct
+users large enough to keep evicting buckets, and throttle() per chunk while
+under the limit. Then uploads through handle_file against the Bot API and
+files.vc stand-ins with a bytes/second limit on one user, and with two users
+sharing a global limit, and compares the achieved rate with the limit.
+
+    python -m benchmarks.bench_ratelimit --users 1000000 --size 8388608 --limit 2097152
+"""
+import argparse
+import asyncio
+import time
+
+import bot
+from pool import HttpPool
+from ratelimit import RateLimiter
+from scheduler import TransferScheduler
+from sources import BotApiSource
+from benchmarks.fakes import FakeBot, FakeContext, FakeFilesVc, FakeTelegramFiles, ServerThread, bot_services, document_update
+
+
+def per_call_us(label, limiter, user_ids):
+    started = time.perf_counter()
+    for user_id in user_ids:
+        limiter.admit(user_id)
+    elapsed = time.perf_counter() - started
+    print(f"admit, {label:32s} {elapsed / len(user_ids) * 1e6:5.2f}us  {limiter.stats()}")
+
+
+async def throttle_us(n):
+    limiter = RateLimiter(user_bytes_per_second=1e15, global_bytes_per_second=1e15)
+    throttle = limiter.shaper(1)
+    started = time.perf_counter()
+    for _ in range(n):
+        await throttle(65536)
+    print(f"throttle per chunk, under the limit  {(time.perf_counter() - started) / n * 1e6:5.2f}us")
+
+
+async def shaped(label, limiter, users, args, files, uploads):
+    pool = HttpPool()
+    scheduler = TransferScheduler(bot.TRANSFER_WORKERS)
+    scheduler.start()
+    bot_data = bot_services(pool, BotApiSource(pool), scheduler, f"{uploads.url}/upload", rate_limiter=limiter)
+    context = FakeContext(FakeBot(files), bot_data)
+    started = time.perf_counter()
+    for n, user_id in enumerate(users):
+        await bot.handle_file(document_update(args.size, n + len(label) * 100, user_id=user_id), context)
+    await scheduler.join()
+    elapsed = time.perf_counter() - started
+    await scheduler.stop()
+    await pool.aclose()
+    total = args.size * len(users)
+    print(f"{label:34s} {total / elapsed / 2**20:5.2f}MB/s for {total / 2**20:.0f}MB in {elapsed:.2f}s "
+          f"(limit {args.limit / 2**20:.2f}MB/s after a {args.limit / 2**20:.2f}MB burst, "
+          f"so {(total - args.limit) / args.limit:.2f}s expected)")
+
+
+async def run(args):
+    per_call_us("limits off", RateLimiter(), range(args.hot * 100))
+    hot = RateLimiter(user_files_per_minute=1e9, global_files_per_minute=1e12)
+    per_call_us(f"{args.hot} returning users", hot, [n % args.hot for n in range(args.hot * 100)])
+    churn = RateLimiter(user_files_per_minute=1e9, global_files_per_minute=1e12, max_users=args.max_users)
+    per_call_us(f"{args.users} distinct users", churn, range(args.users))
+    await throttle_us(100_000)
+
+    with ServerThread(FakeTelegramFiles(rate=args.rate), FakeFilesVc(rate=args.rate)) as (files, uploads):
+        await shaped("one user at the user limit", RateLimiter(user_bytes_per_second=args.limit), [1],
+                     args, files, uploads)
+        await shaped("two users under a global limit", RateLimiter(global_bytes_per_second=args.limit), [1, 2],
+                     args, files, uploads)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--hot', type=int, default=1000, help="returning users")
+    parser.add_argument('--users', type=int, default=1_000_000, help="distinct users")
+    parser.add_argument('--max-users', type=int, default=100_000, help="buckets kept before evicting")
+    parser.add_argument('--size', type=int, default=8 * 1024 * 1024)
+    parser.add_argument('--limit', type=float, default=2 * 1024 * 1024, help="bytes/sec limit")
+    parser.add_argument('--rate', type=float, default=0, help="simulated bytes/sec per connection, 0 for unlimited")
+    args = parser.parse_args()
+    bot.logging.disable(bot.logging.WARNING)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
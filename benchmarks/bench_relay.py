@@ -0,0 +1,88 @@
+"""Share codes: /get hit rate and latency, and the bytes kept off the uploads.
+
+Records --files distinct files as handle_file does, a --stale share of them
+with file_ids Telegram no longer takes, then answers --requests /get
+requests. Codes are drawn Zipf-like over the files, popular ones more often, plus an --unknown
+share of codes that were never handed out. This repeats for each --memory
+size of the in-memory LRU in front of the SQLite table. Reports the hit rate
+from the relay metrics, split by memory and disk, the lookup latency, and the
+bytes sent again by file_id that a re-share through a download link would
+have uploaded again.
+
+    python -m benchmarks.bench_relay --files 20000 --requests 20000 --memory 100 1000 10000
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import statistics
+import tempfile
+import time
+
+import bot
+from metrics import RELAY_BYTES, RELAY_LOOKUPS
+from relay import RelayCache
+from benchmarks.fakes import FakeContext, FakeMessage, FakeUpdate
+
+RESULTS = ('memory', 'disk', 'miss', 'stale')
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+async def run(args, memory, directory):
+    rng = random.Random(args.seed)
+    relay = RelayCache(os.path.join(directory, f"relay-{memory}.db"), memory_entries=memory)
+    context = FakeContext(None, {'relay': relay})
+    codes = []
+    for n in range(args.files):
+        file_id = f"{'expired:' if rng.random() < args.stale else ''}file{n}"
+        size = rng.randrange(2**20, 50 * 2**20)
+        codes.append(relay.remember(n % 100, f"uid{n}", file_id, "document", f"file{n}.bin", size))
+
+    before = {result: RELAY_LOOKUPS.labels(result).value for result in RESULTS}
+    bytes_before = RELAY_BYTES.labels().value
+    weights = list(itertools.accumulate(1 / (rank + 1) ** args.zipf for rank in range(args.files)))
+    latencies = []
+    for _ in range(args.requests):
+        if rng.random() < args.unknown:
+            code = bot.share_code(f"unknown{rng.random()}")
+        else:
+            code = rng.choices(codes, cum_weights=weights)[0]
+        update = FakeUpdate(FakeMessage(chat_id=rng.randrange(100)))
+        context.args = [code]
+        started = time.perf_counter()
+        await bot.get_shared(update, context)
+        latencies.append((time.perf_counter() - started) * 1000)
+    relay.close()
+
+    counts = {result: RELAY_LOOKUPS.labels(result).value - before[result] for result in RESULTS}
+    hits = counts['memory'] + counts['disk']
+    print(f"memory {memory:6d}  hit rate {hits / args.requests:5.1%} (memory {counts['memory'] / args.requests:5.1%}, "
+          f"disk {counts['disk'] / args.requests:5.1%}), miss {counts['miss']}, stale {counts['stale']}  "
+          f"p50 {statistics.median(latencies):5.2f}ms p99 {percentile(latencies, 0.99):5.2f}ms  "
+          f"{(RELAY_BYTES.labels().value - bytes_before) / 2**30:6.1f}GB not uploaded again")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', type=int, default=20_000)
+    parser.add_argument('--requests', type=int, default=20_000)
+    parser.add_argument('--memory', type=int, nargs='+', default=[100, 1000, 10_000])
+    parser.add_argument('--zipf', type=float, default=1.0, help="skew of the code popularity")
+    parser.add_argument('--stale', type=float, default=0.02, help="share of file_ids Telegram no longer takes")
+    parser.add_argument('--unknown', type=float, default=0.05, help="share of requests for codes never handed out")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    bot.logging.disable(bot.logging.WARNING)
+    bot.RELAY_CACHE = True
+    with tempfile.TemporaryDirectory() as directory:
+        for memory in args.memory:
+            asyncio.run(run(args, memory, directory))
+
+
+if __name__ == "__main__":
+    main()
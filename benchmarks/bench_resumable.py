@@ -0,0 +1,121 @@
+"""Chunked uploads against a fault-injecting target: retries and resume.
+
+First uploads a file while the target fails or drops a share of chunk
+requests, then interrupts an upload halfway (as a crash would) and runs it
+again with a fresh uploader, which has to pick up from the checkpoint.
+Exits with status 1 if an upload did not complete, a chunk arrived
+corrupt, a fault went without a retry or the resumed upload opened a new
+session or sent more again than was in flight when it was cut off.
+
+    python -m benchmarks.bench_resumable --size 67108864 --fail-rate 0.2
+"""
+import argparse
+import asyncio
+import logging
+import sys
+import tempfile
+import time
+
+from pool import HttpPool
+from resumable import ResumableUploader
+from sources import BotApiSource
+from benchmarks.fakes import FakeResumableTarget, FakeTelegramFiles, ServerThread
+
+
+def completed(response) -> bool:
+    return response.status_code == 200 and 'url' in response.json()
+
+
+def uploader_for(pool, target, checkpoint_dir, args):
+    return ResumableUploader(pool, f"{target.url}/uploads", checkpoint_dir, args.chunk_size, args.parallel,
+                             retries=8, backoff=0.05)
+
+
+async def with_faults(args, files, checkpoint_dir):
+    with ServerThread(FakeResumableTarget(args.fail_rate, args.drop_rate, args.seed)) as (target,):
+        pool = HttpPool()
+        source = BotApiSource(pool)
+        url = files.file_url(args.size)
+        uploader = uploader_for(pool, target, checkpoint_dir, args)
+        started = time.perf_counter()
+        response = await uploader.upload('faults', 'file.bin', args.size,
+                                         lambda offset, length: source.read_range(url, offset, length))
+        elapsed = time.perf_counter() - started
+        await pool.aclose()
+    print("== retries")
+    print(f"result:          HTTP {response.status_code} {response.json()}")
+    print(f"chunks accepted: {target.chunks}, faults injected: {target.faults}, retries: {uploader.retried}")
+    print(f"corrupt chunks:  {target.corrupt}")
+    print(f"time:            {elapsed:.2f}s")
+    total_chunks = (args.size + args.chunk_size - 1) // args.chunk_size
+    return [problem for failed, problem in [
+        (not completed(response), "the upload with faults did not complete"),
+        (target.corrupt, f"{target.corrupt} corrupt chunks with faults"),
+        (uploader.retried < target.faults, f"{target.faults} faults but only {uploader.retried} retries"),
+        (target.chunks != total_chunks, f"{target.chunks} chunks accepted of {total_chunks}"),
+    ] if failed]
+
+
+async def interrupted(args, files, checkpoint_dir):
+    with ServerThread(FakeResumableTarget()) as (target,):
+        pool = HttpPool()
+        source = BotApiSource(pool)
+        url = files.file_url(args.size)
+        total_chunks = (args.size + args.chunk_size - 1) // args.chunk_size
+
+        async def read_range(offset, length):
+            # Slow chunks down so the upload can be cut off partway through
+            await asyncio.sleep(0.02)
+            return await source.read_range(url, offset, length)
+
+        first = asyncio.create_task(uploader_for(pool, target, checkpoint_dir, args).upload(
+            'resume', 'file.bin', args.size, read_range))
+        while target.chunks < total_chunks // 2:
+            await asyncio.sleep(0.005)
+        first.cancel()
+        await asyncio.gather(first, return_exceptions=True)
+        sent_before = target.chunks
+
+        # A new uploader, as after a restart, with only the checkpoint to go on
+        response = await uploader_for(pool, target, checkpoint_dir, args).upload(
+            'resume', 'file.bin', args.size, read_range)
+        await pool.aclose()
+    print("== resume")
+    print(f"result:          HTTP {response.status_code} {response.json()}")
+    print(f"chunks:          {total_chunks} total, {sent_before} before the interruption, "
+          f"{target.chunks - sent_before} after")
+    print(f"sessions opened: {len(target.sessions)}, corrupt chunks: {target.corrupt}")
+    # Chunks in flight when it was cut off were sent but not checkpointed, so they go again
+    resent = target.chunks - total_chunks
+    return [problem for failed, problem in [
+        (not completed(response), "the resumed upload did not complete"),
+        (target.corrupt, f"{target.corrupt} corrupt chunks after resuming"),
+        (len(target.sessions) != 1, f"{len(target.sessions)} sessions opened instead of resuming the first"),
+        (not 0 <= resent <= args.parallel, f"{resent} chunks sent again, with {args.parallel} in flight"),
+    ] if failed]
+
+
+async def run(args):
+    with ServerThread(FakeTelegramFiles()) as (files,), tempfile.TemporaryDirectory() as checkpoint_dir:
+        return await with_faults(args, files, checkpoint_dir) + await interrupted(args, files, checkpoint_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=64 * 1024 * 1024)
+    parser.add_argument('--chunk-size', type=int, default=2 * 1024 * 1024)
+    parser.add_argument('--parallel', type=int, default=4)
+    parser.add_argument('--fail-rate', type=float, default=0.2)
+    parser.add_argument('--drop-rate', type=float, default=0.05)
+    parser.add_argument('--seed', type=int, default=1, help="seed for the injected faults")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+    problems = asyncio.run(run(args))
+    for problem in problems:
+        print(f"FAILED {problem}")
+    if problems:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
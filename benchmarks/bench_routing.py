@@ -0,0 +1,107 @@
+"""Latency-aware routing across several upload destinations.
+
+Three files.vc stand-ins with different simulated speeds take a stream of
+uploads through backends.UploadRouter, then through plain round-robin for
+comparison. In a second routed run the fastest destination fails for the
+middle third of the uploads, so the failover and its return show up too.
+
+    python -m benchmarks.bench_routing --uploads 60 --size 4194304
+"""
+import argparse
+import asyncio
+import collections
+import logging
+import time
+
+from backends import FilesVcBackend, UploadRouter
+from pool import HttpPool
+from sources import BotApiSource
+from benchmarks.fakes import FakeFilesVc, FakeTelegramFiles, ServerThread
+
+MB = 1024 * 1024
+
+
+class RoundRobinRouter(UploadRouter):
+    """Same failover, but takes the backends in turn whatever their speed."""
+
+    def __init__(self, backends, **kwargs):
+        super().__init__(backends, **kwargs)
+        self.turn = 0
+
+    def ranked(self, size):
+        self.turn += 1
+        start = self.turn % len(self.backends)
+        return self.backends[start:] + self.backends[:start]
+
+
+async def run_router(router, source, files, targets, args, outage=False):
+    url = files.file_url(args.size)
+    slots = asyncio.Semaphore(args.concurrency)
+    chosen = collections.Counter()
+    timeline = []
+    failed = 0
+
+    async def one(n):
+        nonlocal failed
+        async with slots:
+            if outage and n == args.uploads // 3:
+                targets[0].failing = True
+            if outage and n == 2 * args.uploads // 3:
+                targets[0].failing = False
+            try:
+                result = await router.upload(source, url, 'file.bin', args.size, f"file-{n}")
+            except Exception:
+                failed += 1
+                return
+            chosen[result.backend] += 1
+            timeline.append(result.backend[0])
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(n) for n in range(args.uploads)))
+    return time.perf_counter() - started, chosen, failed, ''.join(timeline)
+
+
+async def run(args):
+    rates = [args.rate * factor for factor in (1.0, 0.4, 0.15)]
+    stand_ins = [FakeFilesVc(rate=rate, latency=latency) for rate, latency in zip(rates, (0.05, 0.02, 0.01))]
+    with ServerThread(FakeTelegramFiles(), *stand_ins) as (files, *targets):
+        names = ['fast', 'medium', 'slow']
+        for name, target, rate in zip(names, targets, rates):
+            print(f"{name:7s} {rate / MB:5.1f}MB/s  {target.url}")
+        pool = HttpPool()
+        source = BotApiSource(pool)
+
+        def backends():
+            return [FilesVcBackend(pool, f"{target.url}/upload", name=name) for name, target in zip(names, targets)]
+
+        for title, router, outage in [
+            ("routed", UploadRouter(backends(), cooldown=args.cooldown), False),
+            ("routed, fast fails for the middle third", UploadRouter(backends(), cooldown=args.cooldown), True),
+            ("round-robin", RoundRobinRouter(backends(), cooldown=args.cooldown), False),
+        ]:
+            elapsed, chosen, failed, timeline = await run_router(router, source, files, targets, args, outage)
+            print(f"== {title}")
+            print(f"time:      {elapsed:.2f}s for {args.uploads} x {args.size / MB:.0f}MB, {failed} failed")
+            print(f"per backend: {dict(chosen)}")
+            print(f"order:     {timeline}")
+            for name, stats in router.backend_stats.items():
+                print(f"  {name:7s} expected {stats.expected_time(args.size):5.2f}s per file, "
+                      f"latency {(stats.latency or 0) * 1000:4.0f}ms, error rate {stats.current_error_rate():.2f}, "
+                      f"{stats.failures} failures")
+        await pool.aclose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--uploads', type=int, default=60)
+    parser.add_argument('--size', type=int, default=4 * MB)
+    parser.add_argument('--rate', type=float, default=32 * MB, help="simulated bytes/sec of the fastest destination")
+    parser.add_argument('--concurrency', type=int, default=2)
+    parser.add_argument('--cooldown', type=float, default=1.0, help="seconds a failing backend sits out")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
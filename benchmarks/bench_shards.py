@@ -0,0 +1,107 @@
+"""Throughput of one bot against several sharing a busy group, under per-bot flood limits.
+
+Runs `python bot.py` as a subprocess against the Bot API stand-in with 1, 2
+and up to --bots tokens, all members of one group. --users users send
+--files small documents, in a burst or one every --interval seconds, every
+bot getting its copy of each. The stand-in refuses a bot more than
+--chat-rate messages a second in the chat and more than --token-rate calls
+a second overall, with 429s, as Telegram does; each bot keeps to a budget
+of --budget calls a second and --chat-rate messages a second in the group.
+Reports the time until every file was answered with a link (or --timeout),
+how many were, duplicate answers, the 429s and how the messages were split
+between the bots (home, moved off a flood limited or backed up bot, or
+handed off), from the bot's /metrics.
+
+    python -m benchmarks.bench_shards --files 80 --users 40 --token-rate 10 --budget 9
+"""
+import argparse
+import os
+import re
+import socket
+import tempfile
+import time
+
+import httpx
+
+from benchmarks.bench_startup import launch, stop, wait_for
+from benchmarks.fakes import FakeBotApi, FakeFilesVc, ServerThread, document_message_update
+
+GROUP = -1001
+ROUTES = ('home', 'moved', 'handoff')
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+def routes(port):
+    """shard_messages_total summed by route, from the bot's /metrics."""
+    text = httpx.get(f"http://127.0.0.1:{port}/metrics").text
+    counts = dict.fromkeys(ROUTES, 0)
+    for route, value in re.findall(r'shard_messages_total\{shard="\d+",route="(\w+)"\} (\S+)', text):
+        counts[route] = counts.get(route, 0) + float(value)
+    return counts
+
+
+def run(bots, args, api, uploads, directory, log, first_message):
+    tokens = [f"{100 + n}:SHARD" for n in range(bots)]
+    port = free_port()
+    floods = sum(api.floods.values())
+    process = launch(api, uploads, directory, log, TELEGRAM_TOKENS=",".join(tokens), METRICS_PORT=port,
+                     METRICS_LISTEN='127.0.0.1', BOT_API_RATE=args.budget,
+                     BOT_API_GROUP_PER_MINUTE=args.chat_rate * 60, MAX_QUEUED=args.files,
+                     MAX_QUEUED_PER_USER=args.files, SHARD_HANDOFF=args.handoff)
+    # Every bot has polled once, so none misses the burst
+    wait_for(lambda: api.polling.issuperset(tokens), args.timeout)
+    messages = range(first_message, first_message + args.files)
+    started = time.perf_counter()
+    for n, message_id in enumerate(messages):
+        api.push_update(document_message_update(args.size, GROUP, user_id=1 + n % args.users, message_id=message_id),
+                        tokens)
+        time.sleep(args.interval)
+
+    def linked():
+        return [message for message in messages if any('✅' in text for text in api.answers.get((GROUP, message), []))]
+
+    wait_for(lambda: len(linked()) == args.files, args.timeout)
+    elapsed = time.perf_counter() - started
+    answered = len(linked())
+    duplicates = sum(max(0, sum('✅' in text for text in api.answers.get((GROUP, message), [])) - 1)
+                     for message in messages)
+    split = routes(port)
+    stop(process, args.timeout)
+    print(f"{bots} bot{'s' if bots > 1 else ' '} {answered:4d}/{args.files} answered in {elapsed:6.2f}s "
+          f"({answered / elapsed:5.1f} files/s), {duplicates} duplicates, "
+          f"{sum(api.floods.values()) - floods:4d} 429s, "
+          f"{', '.join(f'{split[route]:.0f} {route}' for route in ROUTES)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--bots', type=int, default=4)
+    parser.add_argument('--files', type=int, default=80)
+    parser.add_argument('--users', type=int, default=40)
+    parser.add_argument('--size', type=int, default=64 * 1024)
+    parser.add_argument('--interval', type=float, default=0, help="seconds between two files, 0 for a burst")
+    parser.add_argument('--chat-rate', type=float, default=0, help="messages/sec one bot may send to the group")
+    parser.add_argument('--token-rate', type=float, default=10, help="calls/sec one bot may make")
+    parser.add_argument('--budget', type=float, default=9, help="calls/sec each bot keeps to, BOT_API_RATE")
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--handoff', type=float, default=2)
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--log', default=os.devnull, help="where the bot's output goes")
+    args = parser.parse_args()
+    counts = sorted({1, min(2, args.bots), args.bots})
+    with tempfile.TemporaryDirectory() as directory, open(args.log, 'wb') as log, \
+            ServerThread(FakeBotApi(token_rate=args.token_rate, chat_rate=args.chat_rate,
+                                    retry_after=args.retry_after), FakeFilesVc()) as (api, uploads):
+        print(f"{args.files} files from {args.users} users in one group, {args.token_rate:g} calls/s per bot "
+              f"({args.budget:g} budgeted), {args.chat_rate or 'any':} messages/s per bot in the group")
+        for n, bots in enumerate(counts):
+            run(bots, args, api, uploads, directory, log, 1 + n * args.files)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""Streaming a download straight into the upload vs spooling it to disk first.
+
+Sends one document of --size bytes through handle_file, with Telegram
+serving it faster than files.vc accepts it, once streamed directly and once
+with SPOOL_TRANSFERS. Reports wall time, how long the download connection was
+held and the growth of resident memory, sampled while it runs. Then repeats
+both with a first upload target that fails after taking the whole body, and
+counts how many times the file was downloaded.
+
+    python -m benchmarks.bench_spool --size 268435456
+"""
+import argparse
+import asyncio
+import os
+import time
+
+import bot
+from backends import FilesVcBackend, UploadRouter
+from metrics import STAGE_SECONDS
+from pool import HttpPool
+from scheduler import TransferScheduler
+from sources import LocalBotApiSource
+from benchmarks.fakes import FakeBot, FakeContext, FakeFilesVc, FakeTelegramFiles, ServerThread, bot_services, document_update
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+def rss_mb():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * PAGE_SIZE / 2**20
+
+
+async def sample_peak(peak, stop):
+    while not stop.is_set():
+        peak[0] = max(peak[0], rss_mb())
+        await asyncio.sleep(0.01)
+
+
+async def transfer(spooled, args, files, upload_urls, n):
+    bot.SPOOL_TRANSFERS = spooled
+    pool = HttpPool()
+    scheduler = TransferScheduler(1)
+    scheduler.start()
+    backends = [FilesVcBackend(pool, url, name=f"target{i}") for i, url in enumerate(upload_urls)]
+    bot_data = bot_services(pool, LocalBotApiSource(pool), scheduler, upload_urls[-1],
+                            upload_router=UploadRouter(backends, explore=0))
+    context = FakeContext(FakeBot(files), bot_data)
+    update = document_update(args.size, n)
+    downloads = files.requests
+    spool_before = STAGE_SECONDS.labels('spool').sum
+
+    baseline = rss_mb()
+    peak, stop = [baseline], asyncio.Event()
+    sampler = asyncio.create_task(sample_peak(peak, stop))
+    started = time.perf_counter()
+    await bot.handle_file(update, context)
+    await scheduler.join()
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await sampler
+    await scheduler.stop()
+    await pool.aclose()
+
+    held = STAGE_SECONDS.labels('spool').sum - spool_before if spooled else elapsed
+    ok = '✅' in update.message.replies[-1]
+    print(f"{'spooled' if spooled else 'direct':8s} {elapsed:6.2f}s  {args.size / elapsed / 2**20:6.1f}MB/s  "
+          f"download held {held:5.2f}s  RSS +{peak[0] - baseline:5.1f}MB  "
+          f"downloaded {files.requests - downloads}x  {'ok' if ok else update.message.replies[-1]!r}")
+
+
+async def run(args):
+    with ServerThread(FakeTelegramFiles(rate=args.download_rate), FakeFilesVc(rate=args.upload_rate),
+                      FakeFilesVc(rate=args.upload_rate)) as (files, uploads, down):
+        down.failing = True
+        download = f"{args.download_rate / 2**20:.0f}MB/s" if args.download_rate else "unlimited"
+        print(f"{args.size / 2**20:.0f}MB, download {download}, "
+              f"upload {args.upload_rate / 2**20:.0f}MB/s")
+        for spooled in (False, True):
+            await transfer(spooled, args, files, [f"{uploads.url}/upload"], 0)
+        print("first upload target fails:")
+        for spooled in (False, True):
+            await transfer(spooled, args, files, [f"{down.url}/upload", f"{uploads.url}/upload"], 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=256 * 1024 * 1024)
+    parser.add_argument('--download-rate', type=float, default=0, help="simulated bytes/sec, 0 for unlimited")
+    parser.add_argument('--upload-rate', type=float, default=32 * 1024 * 1024, help="simulated bytes/sec")
+    args = parser.parse_args()
+    bot.logging.disable(bot.logging.WARNING)
+    bot.PROGRESS_MIN_SIZE = args.size + 1
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""Time to first reply after a restart, and a graceful drain on SIGTERM.
+
+Runs `python bot.py` as a subprocess against the Bot API and files.vc
+stand-ins. First with a backlog of --backlog /start updates waiting, as after
+a restart, and reports the time from launch to the first reply and until the
+whole backlog is answered, then the reply time of single updates sent one
+by one, for the old 1s poll interval and the current settings. Then sends --transfers documents through a slow upload target,
+sends SIGTERM while they are in flight, and reports how long the bot took
+to exit, how many jobs it kept and whether the next start finished them.
+
+    python -m benchmarks.bench_startup --backlog 300 --transfers 8
+"""
+import argparse
+import os
+import signal
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.fakes import FakeBotApi, FakeFilesVc, ServerThread, command_update, document_message_update
+
+TOKEN = '123456:BENCH'
+
+
+def launch(api, uploads, directory, log, **env):
+    env = {
+        **os.environ,
+        'TELEGRAM_TOKEN': TOKEN,
+        'BOT_API_URL': api.base_url,
+        'BOT_API_FILE_URL': api.base_file_url,
+        'API_UPLOAD_URL': f"{uploads.url}/upload",
+        'CACHE_DB': os.path.join(directory, 'cache.db'),
+        'HISTORY_DB': os.path.join(directory, 'history.db'),
+        'PENDING_JOBS_DB': os.path.join(directory, 'pending.db'),
+        **{key: str(value) for key, value in env.items()},
+    }
+    return subprocess.Popen([sys.executable, 'bot.py'], env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+def wait_for(condition, timeout):
+    deadline = time.perf_counter() + timeout
+    while not condition():
+        if time.perf_counter() > deadline:
+            return False
+        time.sleep(0.005)
+    return True
+
+
+def stop(process, timeout):
+    started = time.perf_counter()
+    process.send_signal(signal.SIGTERM)
+    try:
+        process.wait(timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+    return time.perf_counter() - started
+
+
+def startup(label, args, api, uploads, directory, log, first_chat, **env):
+    chats = range(first_chat, first_chat + args.backlog)
+    for chat in chats:
+        api.push_update(command_update('/start', chat))
+    started = time.perf_counter()
+    process = launch(api, uploads, directory, log, **env)
+    wait_for(lambda: first_chat in api.replied, args.timeout)
+    first = api.replied.get(first_chat, float('nan')) - started
+    wait_for(lambda: all(chat in api.replied for chat in chats), args.timeout)
+    last = max(api.replied.get(chat, float('nan')) for chat in chats) - started
+    answered = sum(1 for chat in chats if chat in api.replied)
+
+    # Then updates trickling in one at a time, as most of the day
+    latencies = []
+    for chat in range(first_chat + args.backlog, first_chat + args.backlog + args.trickle):
+        sent = time.perf_counter()
+        api.push_update(command_update('/start', chat))
+        wait_for(lambda: chat in api.replied, args.timeout)
+        latencies.append((api.replied[chat] - sent) * 1000)
+        time.sleep(0.2)
+    stop(process, args.timeout)
+    print(f"{label:18s} first reply {first:5.2f}s, {answered}/{args.backlog} backlog answered after {last:5.2f}s, "
+          f"then p50 {statistics.median(latencies):6.1f}ms / max {max(latencies):6.1f}ms per update")
+
+
+def pending_jobs(directory):
+    path = os.path.join(directory, 'pending.db')
+    if not os.path.exists(path):
+        return 0
+    with sqlite3.connect(path) as db:
+        return db.execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
+
+
+def drain(args, api, uploads, directory, log):
+    first_chat = 5_000_000
+    chats = range(first_chat, first_chat + args.transfers)
+    uploads.uploads = 0
+    process = launch(api, uploads, directory, log, SHUTDOWN_TIMEOUT=args.shutdown_timeout,
+                     TRANSFER_WORKERS=args.workers)
+    for chat in chats:
+        api.push_update(document_message_update(args.size, chat))
+    wait_for(lambda: sum(1 for chat in chats if chat in api.replied) >= args.transfers - args.workers, args.timeout)
+    # Let the first transfers get going
+    time.sleep(args.size / args.rate / 2)
+    finished = sum(1 for chat in chats if any('✅' in text for text in api.texts.get(chat, [])))
+    elapsed = stop(process, args.shutdown_timeout + args.timeout)
+    done = sum(1 for chat in chats if any('✅' in text for text in api.texts.get(chat, [])))
+    kept = pending_jobs(directory)
+    print(f"SIGTERM with {args.transfers - finished} of {args.transfers} transfers unfinished: exited in "
+          f"{elapsed:.2f}s (SHUTDOWN_TIMEOUT {args.shutdown_timeout:g}s), {done - finished} finished meanwhile, "
+          f"{kept} kept, exit code {process.returncode}")
+
+    started = time.perf_counter()
+    process = launch(api, uploads, directory, log, TRANSFER_WORKERS=args.workers)
+    wait_for(lambda: all(any('✅' in text for text in api.texts.get(chat, [])) for chat in chats), args.timeout)
+    elapsed = time.perf_counter() - started
+    stop(process, args.timeout)
+    done = sum(1 for chat in chats if any('✅' in text for text in api.texts.get(chat, [])))
+    print(f"restarted: {done}/{args.transfers} answered with a link after {elapsed:.2f}s, "
+          f"{pending_jobs(directory)} still kept")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--backlog', type=int, default=300, help="updates waiting at startup")
+    parser.add_argument('--trickle', type=int, default=20, help="single updates sent after the backlog")
+    parser.add_argument('--transfers', type=int, default=8)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--size', type=int, default=8 * 1024 * 1024)
+    parser.add_argument('--rate', type=float, default=1024 * 1024, help="simulated upload bytes/sec")
+    parser.add_argument('--shutdown-timeout', type=float, default=2)
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--log', default=os.devnull, help="where the bot's output goes")
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory, open(args.log, 'wb') as log, \
+            ServerThread(FakeBotApi(), FakeFilesVc(rate=args.rate)) as (api, uploads):
+        # The stand-in has no flood limits to keep to; bench_dispatch is about those
+        startup("poll interval 1s", args, api, uploads, directory, log, 1_000_000, POLL_INTERVAL=1, BOT_API_RATE=0)
+        startup("current settings", args, api, uploads, directory, log, 2_000_000, BOT_API_RATE=0)
+        drain(args, api, uploads, directory, log)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""CPU time per MB spent in the download loop.
+
+"before" is the original streamer: a synchronous 8 KiB iter_content loop that
+writes an INFO log line per chunk. "after" is TelegramFileStreamer with
+adaptive chunks and a throttled progress callback. Only the CPU time of the
+thread running the client is counted; the stand-in server runs in its own
+thread.
+
+    python -m benchmarks.bench_streamer --size 20971520 --repeat 5
+"""
+import argparse
+import asyncio
+import logging
+import os
+import time
+import httpx
+
+from pool import HttpPool
+from transfer import ProgressReporter, TelegramFileStreamer
+from benchmarks.fakes import FakeTelegramFiles, ServerThread
+
+logger = logging.getLogger("bench_streamer")
+
+
+def before(url):
+    with httpx.Client() as client, client.stream("GET", url) as response:
+        total_size = int(response.headers.get('content-length', 0))
+        uploaded_size = 0
+        for chunk in response.iter_bytes(chunk_size=8192):
+            uploaded_size += len(chunk)
+            logger.info(f"Uploaded {uploaded_size} of {total_size} bytes")
+    return uploaded_size
+
+
+async def after(url, pool):
+    updates = []
+
+    async def on_progress(done, total):
+        updates.append(done)
+
+    progress = ProgressReporter(on_progress, interval=3.0)
+    streamer = await TelegramFileStreamer(pool.client_for(url), url, progress).open()
+    try:
+        async for chunk in streamer:
+            pass
+    finally:
+        await streamer.close()
+        await progress.close()
+    return streamer.uploaded_size
+
+
+async def run_after(url, repeat):
+    pool = HttpPool()
+    try:
+        await after(url, pool)  # warm-up
+        started = time.thread_time()
+        for _ in range(repeat):
+            await after(url, pool)
+        return time.thread_time() - started
+    finally:
+        await pool.aclose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=20 * 1024 * 1024)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    # Log lines go where bot.py sends them, minus the cost of a terminal
+    handler = logging.StreamHandler(open(os.devnull, 'w'))
+    handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+    megabytes = args.size * args.repeat / (1024 * 1024)
+    with ServerThread(FakeTelegramFiles()) as (files,):
+        url = files.file_url(args.size)
+        before(url)  # warm-up
+        started = time.thread_time()
+        for _ in range(args.repeat):
+            before(url)
+        before_cpu = time.thread_time() - started
+        after_cpu = asyncio.run(run_after(url, args.repeat))
+
+    print(f"file size:   {args.size} bytes x {args.repeat}")
+    print(f"before:      {before_cpu * 1000 / megabytes:.2f} ms CPU/MB")
+    print(f"after:       {after_cpu * 1000 / megabytes:.2f} ms CPU/MB")
+    print(f"speedup:     {before_cpu / after_cpu:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
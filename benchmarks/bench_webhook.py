@@ -0,0 +1,114 @@
+"""Updates/sec and handling latency for polling vs webhook delivery.
+
+Builds the real Application from bot.py against a local Bot API stand-in and
+feeds it /start updates at a fixed rate: queued for getUpdates in polling
+mode, POSTed to the embedded webhook listener in webhook mode. Latency runs
+from when an update is offered until the bot's reply reaches the stand-in.
+
+    python -m benchmarks.bench_webhook --updates 500 --rate 50
+"""
+import argparse
+import asyncio
+import socket
+import statistics
+import time
+import httpx
+
+import bot
+from benchmarks.fakes import FakeBotApi, ServerThread, command_update
+
+SECRET = "bench-secret"
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def offer(updates, rate, send):
+    sent = {}
+    started = time.perf_counter()
+    tasks = []
+    for n, update in enumerate(updates):
+        delay = started + n / rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        sent[update['message']['chat']['id']] = time.perf_counter()
+        tasks.append(asyncio.create_task(send(update)))
+    await asyncio.gather(*tasks)
+    return sent
+
+
+async def wait_for_replies(api, count, timeout):
+    deadline = time.monotonic() + timeout
+    while len(api.replied) < count and time.monotonic() < deadline:
+        await asyncio.sleep(0.01)
+
+
+async def run_mode(mode, args):
+    bot.CACHE_DB = ':memory:'
+    bot.HISTORY_DB = ':memory:'
+    updates = [command_update('/start', 100_000 + n, update_id=n + 1) for n in range(args.updates)]
+    with ServerThread(FakeBotApi()) as (api,):
+        app = bot.build_application('123456:BENCH', api.base_url, api.base_file_url)
+        async with app:
+            await bot.post_init(app)
+            await app.start()
+            if mode == 'polling':
+                await app.updater.start_polling(poll_interval=args.poll_interval)
+
+                async def send(update):
+                    api.push_update(update)
+            else:
+                port = free_port()
+                await app.updater.start_webhook(
+                    listen='127.0.0.1', port=port, url_path='hook', webhook_url=f"http://127.0.0.1:{port}/hook",
+                    secret_token=SECRET, max_connections=args.max_connections,
+                )
+                client = httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}")
+                # Wait here rather than in httpx's pool, which gets slow with many queued requests
+                connections = asyncio.Semaphore(args.max_connections)
+                rejected = await client.post('/hook', json=command_update('/start', 1, update_id=0))
+                print(f"webhook without secret: HTTP {rejected.status_code}")
+
+                async def send(update):
+                    async with connections:
+                        await client.post('/hook', json=update, headers={'X-Telegram-Bot-Api-Secret-Token': SECRET})
+
+            sent = await offer(updates, args.rate, send)
+            await wait_for_replies(api, len(updates), args.timeout)
+            if mode == 'webhook':
+                await client.aclose()
+            await app.updater.stop()
+            await app.stop()
+            await bot.post_shutdown(app)
+
+    latencies = sorted((api.replied[chat] - sent[chat]) * 1000 for chat in sent if chat in api.replied)
+    first, last = min(sent.values()), max(api.replied.values(), default=0)
+    print(f"mode:         {mode}")
+    print(f"replied:      {len(latencies)}/{len(updates)}")
+    if latencies:
+        print(f"updates/sec:  {len(latencies) / (last - first):.0f} (offered {args.rate:.0f})")
+        print(f"latency p50:  {statistics.median(latencies):.1f}ms")
+        print(f"latency p99:  {latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]:.1f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--mode', choices=['polling', 'webhook', 'both'], default='both')
+    parser.add_argument('--updates', type=int, default=500)
+    parser.add_argument('--rate', type=float, default=50, help="offered updates/sec")
+    parser.add_argument('--poll-interval', type=float, default=bot.POLL_INTERVAL)
+    parser.add_argument('--max-connections', type=int, default=bot.WEBHOOK_MAX_CONNECTIONS)
+    parser.add_argument('--timeout', type=float, default=30)
+    args = parser.parse_args()
+    bot.logging.disable(bot.logging.INFO)
+    # The stand-in has no flood limits to keep to; bench_dispatch is about those
+    bot.BOT_API_RATE = 0
+    for mode in (['polling', 'webhook'] if args.mode == 'both' else [args.mode]):
+        asyncio.run(run_mode(mode, args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""Throughput of the worker processes behind the job queue, and redelivery.
+
+Starts 1, 2, 4... worker processes (worker.py), then queues --jobs transfers
+in their SQLite job queue and times how long they take to drain it. The
+workers run against the Bot API and files.vc stand-ins, each with
+--concurrency transfer slots. Then runs two workers, kills one with SIGKILL
+partway through, and checks that every job still finishes.
+
+    python -m benchmarks.bench_workers --jobs 64 --processes 1 2 4
+"""
+import argparse
+import multiprocessing
+import os
+import signal
+import tempfile
+import time
+
+import bot
+import worker
+from jobqueue import SqliteJobQueue
+from benchmarks.fakes import FakeBotApi, FakeFilesVc, ServerThread
+
+TOKEN = '123456:BENCH'
+
+
+def queue_jobs(path, args, first_chat):
+    queue = SqliteJobQueue(path)
+    for n in range(args.jobs):
+        file = [f"file{n}.bin", args.size, f"{args.size}:{n}", f"{args.size}:{first_chat + n}"]
+        queue.put({'chat_id': first_chat + n, 'chat_type': 'private', 'user_id': first_chat + n, 'message_id': n + 1,
+                   'files': [file], 'album': False})
+    return queue
+
+
+def start_workers(count, path, args, api):
+    processes = [
+        multiprocessing.Process(target=worker.worker_main, args=(
+            path, args.concurrency, args.lease, [TOKEN], api.base_url, api.base_file_url, False))
+        for _ in range(count)
+    ]
+    for process in processes:
+        process.start()
+    return processes
+
+
+def drain(queue, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        stats = queue.stats()
+        if not stats['ready'] and not stats['claimed']:
+            return stats
+        time.sleep(0.02)
+    return queue.stats()
+
+
+def stop_workers(processes):
+    for process in processes:
+        if process.is_alive():
+            process.terminate()
+    for process in processes:
+        process.join()
+
+
+def run(args, directory):
+    with ServerThread(FakeBotApi(rate=args.rate), FakeFilesVc(rate=args.rate)) as (api, uploads):
+        # Inherited by the forked workers
+        bot.API_UPLOAD_URL = f"{uploads.url}/upload"
+        bot.CACHE_DB = ':memory:'
+        bot.HISTORY_DB = ':memory:'
+
+        baseline = None
+        print(f"{args.jobs} jobs of {args.size / 2**20:.0f}MB, {args.concurrency} slots per process, "
+              f"{args.rate / 2**20:.0f}MB/s per connection")
+        for count in args.processes:
+            path = os.path.join(directory, f"jobs-{count}.db")
+            SqliteJobQueue(path).close()
+            processes = start_workers(count, path, args, api)
+            # Process start-up is paid once per deployment, not per job
+            time.sleep(args.warmup)
+            first_chat = count * 1_000_000
+            started = time.perf_counter()
+            queue = queue_jobs(path, args, first_chat)
+            stats = drain(queue, args.timeout)
+            elapsed = time.perf_counter() - started
+            stop_workers(processes)
+            answered = sum(1 for chat in api.replied if first_chat <= chat < first_chat + args.jobs)
+            rate = answered / elapsed
+            baseline = baseline or rate / count
+            print(f"{count} processes: {answered}/{args.jobs} answered in {elapsed:.2f}s, {rate:.1f} files/s "
+                  f"({rate * args.size / 2**20:.0f}MB/s, {rate / baseline / count:.0%} of linear), left {stats}")
+            queue.close()
+
+        path = os.path.join(directory, "jobs-kill.db")
+        first_chat = 9_000_000
+        queue = queue_jobs(path, args, first_chat)
+        sends_before = api.calls.get('sendMessage', 0)
+        started = time.perf_counter()
+        processes = start_workers(2, path, args, api)
+        while sum(1 for chat in api.replied if chat >= first_chat) < args.jobs // 4:
+            time.sleep(0.01)
+        os.kill(processes[0].pid, signal.SIGKILL)
+        stats = drain(queue, args.timeout + args.lease)
+        elapsed = time.perf_counter() - started
+        stop_workers(processes)
+        answered = sum(1 for chat in api.replied if chat >= first_chat)
+        sends = api.calls.get('sendMessage', 0) - sends_before
+        print(f"one of 2 killed: {answered}/{args.jobs} answered in {elapsed:.2f}s (lease {args.lease:.0f}s), "
+              f"{sends - answered} answered twice, left {stats}")
+        queue.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--jobs', type=int, default=64)
+    parser.add_argument('--size', type=int, default=2 * 1024 * 1024)
+    parser.add_argument('--rate', type=float, default=4 * 1024 * 1024, help="simulated bytes/sec per connection")
+    parser.add_argument('--processes', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--concurrency', type=int, default=2, help="transfer slots per process")
+    parser.add_argument('--lease', type=float, default=2.0)
+    parser.add_argument('--warmup', type=float, default=3.0, help="seconds the workers get to start up")
+    parser.add_argument('--timeout', type=float, default=120)
+    args = parser.parse_args()
+    bot.logging.disable(bot.logging.WARNING)
+    with tempfile.TemporaryDirectory() as directory:
+        run(args, directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,737 @@
+"""Local stand-ins for the Telegram file endpoint and the files.vc upload API.
+
+Both speak just enough HTTP/1.1 for httpx: keep-alive, Content-Length and
+chunked request bodies. Throughput and latency are simulated with sleeps so
+transfers overlap the way they do against the real hosts.
+"""
+import asyncio
+import collections
+import functools
+import hashlib
+import itertools
+import json
+import os
+import random
+import threading
+import time
+from urllib.parse import parse_qsl
+
+from telegram.error import BadRequest
+
+from backends import FilesVcBackend, UploadRouter
+from cache import UploadCache
+from history import UploadHistory
+from ratelimit import RateLimiter
+
+
+class Request:
+    def __init__(self, method, path, headers, body):
+        self.method = method
+        self.path = path
+        self.headers = headers
+        self.body = body
+
+
+class Response:
+    def __init__(self, status=200, body=b'', headers=None, stream=None, length=None):
+        self.status = status
+        self.body = body
+        self.headers = headers or {}
+        # Optional async iterator of chunks, used instead of body
+        self.stream = stream
+        self.length = len(body) if stream is None else length
+
+
+REASONS = {200: 'OK', 206: 'Partial Content', 400: 'Bad Request', 404: 'Not Found',
+           416: 'Range Not Satisfiable', 429: 'Too Many Requests', 500: 'Internal Server Error',
+           503: 'Service Unavailable'}
+
+
+class FakeServer:
+    def __init__(self, host='127.0.0.1', port=0):
+        self.host = host
+        self.port = port
+        self.server = None
+        self.connections = 0
+        self.requests = 0
+        self._writers = set()
+        self._tasks = set()
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}"
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.server = await asyncio.start_server(self._serve, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        self.server.close()
+        # Keep-alive connections the client never closed, or long polls, are still being served
+        for writer in list(self._writers):
+            writer.close()
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self.server.wait_closed()
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc):
+        await self.stop()
+
+    async def handle(self, request: Request) -> Response:
+        raise NotImplementedError
+
+    async def body_chunks(self, reader, headers):
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    await reader.readline()
+                    return
+                async for chunk in self.read_exactly(reader, size):
+                    yield chunk
+                await reader.readline()
+        else:
+            async for chunk in self.read_exactly(reader, int(headers.get('content-length', 0))):
+                yield chunk
+
+    async def read_exactly(self, reader, size, chunk_size=64 * 1024):
+        while size > 0:
+            chunk = await reader.read(min(chunk_size, size))
+            if not chunk:
+                raise asyncio.IncompleteReadError(b'', size)
+            size -= len(chunk)
+            yield chunk
+
+    async def read_body(self, reader, headers):
+        return b''.join([chunk async for chunk in self.body_chunks(reader, headers)])
+
+    async def _serve(self, reader, writer):
+        self.connections += 1
+        self._writers.add(writer)
+        self._tasks.add(asyncio.current_task())
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                method, path, _ = line.decode().split(' ', 2)
+                headers = {}
+                while True:
+                    header = await reader.readline()
+                    if header in (b'\r\n', b'\n', b''):
+                        break
+                    key, value = header.decode().split(':', 1)
+                    headers[key.strip().lower()] = value.strip()
+                body = await self.read_body(reader, headers)
+                self.requests += 1
+                response = await self.handle(Request(method, path, headers, body))
+                head = [f"HTTP/1.1 {response.status} {REASONS.get(response.status, 'OK')}",
+                        f"Content-Length: {response.length}"]
+                head += [f"{key}: {value}" for key, value in response.headers.items()]
+                writer.write(('\r\n'.join(head) + '\r\n\r\n').encode())
+                if method == 'HEAD':
+                    # Only the head; its Content-Length is that of what a GET would get
+                    pass
+                elif response.stream is None:
+                    writer.write(response.body)
+                else:
+                    async for chunk in response.stream:
+                        writer.write(chunk)
+                        await writer.drain()
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except asyncio.CancelledError:
+            # Cancelled by stop(); not re-raised, asyncio would log a cancelled handler as an error
+            pass
+        finally:
+            self._writers.discard(writer)
+            self._tasks.discard(asyncio.current_task())
+            writer.close()
+
+
+PATTERN = bytes(range(256)) * 256
+
+
+def _text_block(line, size=4 * 1024 * 1024, seed=1):
+    rng = random.Random(seed)
+    lines, length = [], 0
+    while length < size:
+        lines.append(line(rng))
+        length += len(lines[-1])
+    return ''.join(lines).encode()[:size]
+
+
+def _log_line(rng):
+    return (f"2026-10-18T12:{rng.randrange(60):02d}:{rng.randrange(60):02d}.{rng.randrange(1000):03d} "
+            f"{rng.choice(['INFO', 'INFO', 'INFO', 'WARNING', 'ERROR'])} worker-{rng.randrange(8)} "
+            f"request={rng.getrandbits(64):016x} path=/api/v1/items/{rng.randrange(100000)} "
+            f"status={rng.choice([200, 200, 200, 404, 500])} took={rng.random() * 100:.2f}ms\n")
+
+
+def _csv_line(rng):
+    return (f"{rng.randrange(10**9)},{rng.choice(['alice', 'bob', 'carol', 'dave'])},"
+            f"{rng.uniform(-90, 90):.6f},{rng.uniform(-180, 180):.6f},{rng.randrange(1000)},"
+            f"{rng.choice(['true', 'false'])}\n")
+
+
+# Content served for file names starting with these, 4MB repeated: long enough
+# that the repetition is out of reach of the compressors' windows
+CONTENT = {
+    'log': lambda: _text_block(_log_line),
+    'csv': lambda: _text_block(_csv_line),
+    'random': lambda: random.Random(1).randbytes(4 * 1024 * 1024),
+    # A Windows executable, whatever its name says
+    'exe': lambda: b'MZ' + random.Random(2).randbytes(4 * 1024 * 1024 - 2),
+}
+
+
+@functools.cache
+def content(name: str) -> bytes:
+    """The pattern served for a file name, made on first use."""
+    kind = next((kind for kind in CONTENT if name.startswith(kind)), None)
+    return CONTENT[kind]() if kind else PATTERN
+
+
+def payload_at(offset: int, length: int, pattern=PATTERN) -> bytes:
+    """Bytes of the stand-in file content, `pattern` over and over; by default the
+    byte at offset o is o % 256."""
+    start = offset % len(pattern)
+    data = pattern[start:start + length]
+    while len(data) < length:
+        data += pattern[:length - len(data)]
+    return data
+
+
+async def throttled(offset: int, length: int, rate: float, chunk_size=64 * 1024, pattern=PATTERN):
+    """Yield `length` bytes of payload from `offset` at roughly `rate` bytes/sec (0 means unlimited)."""
+    end = offset + length
+    while offset < end:
+        chunk = payload_at(offset, min(chunk_size, end - offset), pattern)
+        offset += len(chunk)
+        if rate:
+            await asyncio.sleep(len(chunk) / rate)
+        yield chunk
+
+
+class FakeTelegramFiles(FakeServer):
+    """Serves /file/bot<token>/<name>_<size>.bin as `size` bytes of generated payload,
+    honoring single Range requests unless `ranges` is off. The content is one of
+    CONTENT by the start of the name, e.g. log lines for "log3_1024.bin".
+
+    `rate` caps each response, like the window of a connection over a long
+    round trip; `link_rate` caps all of them together, like the link itself.
+    Bytes sent are counted in `sent_bytes`.
+    """
+
+    def __init__(self, rate=0.0, latency=0.0, ranges=True, link_rate=0.0, **kwargs):
+        super().__init__(**kwargs)
+        self.rate = rate
+        self.latency = latency
+        self.ranges = ranges
+        self.link_rate = link_rate
+        self.link_free = 0.0
+        self.sent_bytes = 0
+
+    async def shared_link(self, stream):
+        async for chunk in stream:
+            self.sent_bytes += len(chunk)
+            if self.link_rate:
+                # The chunk may have been on the link while the response's own rate held it
+                now = time.monotonic()
+                duration = len(chunk) / self.link_rate
+                self.link_free = max(self.link_free, now - duration) + duration
+                await asyncio.sleep(self.link_free - now)
+            yield chunk
+
+    def file_url(self, size, name='file', token='TOKEN'):
+        return f"{self.url}/file/bot{token}/{name}_{size}.bin"
+
+    async def handle(self, request):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        try:
+            name, size = request.path.rsplit('/', 1)[1].rsplit('_', 1)
+            size = int(size.split('.')[0])
+        except (IndexError, ValueError):
+            return Response(404, b'not found')
+        pattern = content(name)
+        byte_range = request.headers.get('range', '')
+        if self.ranges and byte_range.startswith('bytes='):
+            start, _, end = byte_range[6:].partition('-')
+            start = int(start)
+            end = min(int(end), size - 1) if end else size - 1
+            if start >= size:
+                return Response(416, headers={'Content-Range': f"bytes */{size}"})
+            headers = {'Content-Range': f"bytes {start}-{end}/{size}", 'Accept-Ranges': 'bytes'}
+            return Response(206, stream=self.shared_link(throttled(start, end - start + 1, self.rate, pattern=pattern)),
+                            length=end - start + 1, headers=headers)
+        return Response(200, stream=self.shared_link(throttled(0, size, self.rate, pattern=pattern)), length=size)
+
+
+class UploadedBody:
+    def __init__(self, size, sha256):
+        self.size = size
+        self.sha256 = sha256
+
+
+class FakeFilesVc(FakeServer):
+    """Accepts POST /upload and answers like api.files.vc with a debug_info.hash.
+
+    Bodies are hashed as they arrive and never kept, so memory stays flat for
+    any upload size. While `failing` is set every request gets a 503, as during
+    an outage; uploads only once their body was sent.
+    """
+
+    def __init__(self, rate=0.0, latency=0.0, **kwargs):
+        super().__init__(**kwargs)
+        self.rate = rate
+        self.latency = latency
+        self.failing = False
+        self.uploads = 0
+        self.uploaded_bytes = 0
+
+    async def read_body(self, reader, headers):
+        digest = hashlib.sha256()
+        size = 0
+        async for chunk in self.body_chunks(reader, headers):
+            digest.update(chunk)
+            size += len(chunk)
+            if self.rate:
+                await asyncio.sleep(len(chunk) / self.rate)
+        return UploadedBody(size, digest.hexdigest())
+
+    async def handle(self, request):
+        if self.failing:
+            return Response(503, b'service unavailable')
+        if request.method != 'POST' or not request.path.startswith('/upload'):
+            return Response(404, b'not found')
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.uploads += 1
+        self.uploaded_bytes += request.body.size
+        body = json.dumps({"status": "success", "debug_info": {"hash": request.body.sha256[:16]}}).encode()
+        return Response(200, body, {'Content-Type': 'application/json'})
+
+
+class FakeResumableTarget(FakeServer):
+    """Upload target speaking the chunked protocol of resumable.ResumableUploader,
+    with injected faults: a `fail_rate` share of chunk PUTs get a 500 and a
+    `drop_rate` share have their connection cut before any response.
+
+    Received chunks are checked against the stand-in payload, so a completed
+    upload proves every byte arrived intact.
+    """
+
+    def __init__(self, fail_rate=0.0, drop_rate=0.0, seed=0, **kwargs):
+        super().__init__(**kwargs)
+        self.fail_rate = fail_rate
+        self.drop_rate = drop_rate
+        self.random = random.Random(seed)
+        self.sessions = {}
+        self.chunks = 0
+        self.faults = 0
+        self.corrupt = 0
+
+    async def handle(self, request):
+        parts = request.path.strip('/').split('/')
+        if request.method == 'POST' and parts == ['uploads']:
+            upload_id = f"u{len(self.sessions) + 1}"
+            self.sessions[upload_id] = {'size': json.loads(request.body)['size'], 'received': {}}
+            return Response(200, json.dumps({'upload_id': upload_id}).encode())
+        session = self.sessions.get(parts[1]) if len(parts) > 1 else None
+        if session is None:
+            return Response(404, b'unknown upload')
+        if request.method == 'PUT':
+            roll = self.random.random()
+            if roll < self.drop_rate:
+                self.faults += 1
+                raise ConnectionAbortedError()
+            if roll < self.drop_rate + self.fail_rate:
+                self.faults += 1
+                return Response(500, b'injected failure')
+            offset = int(request.headers['content-range'].split()[1].split('-')[0])
+            if request.body != payload_at(offset, len(request.body)):
+                self.corrupt += 1
+            session['received'][offset] = len(request.body)
+            self.chunks += 1
+            return Response(200, b'{}')
+        if request.method == 'POST' and parts[2:] == ['complete']:
+            if sum(session['received'].values()) != session['size']:
+                return Response(400, b'incomplete upload')
+            body = {'url': f"{self.url}/d/{parts[1]}", 'hash': parts[1]}
+            return Response(200, json.dumps(body).encode(), {'Content-Type': 'application/json'})
+        return Response(404, b'not found')
+
+
+class FakeBotApi(FakeTelegramFiles):
+    """Bot API stand-in: getMe, getUpdates, webhooks, getFile, sendMessage and
+    editMessageText, plus file downloads under /file/bot<token>/.
+
+    Updates are queued with push_update() and served to getUpdates long polls,
+    to any token or, given `tokens`, only to those bots. The time each chat
+    first got a message back is kept in `replied`, every text sent or edited
+    into it in `texts`, and replies quoting a message in `answers`, by (chat
+    id, message id).
+
+    Flood limits like Telegram's: with `token_rate`, a bot making more calls
+    than that in a second gets a 429 with `retry_after`, as does one sending
+    or editing more than `chat_rate` messages a second in one chat. 429s are
+    counted in `floods`, per token.
+
+    With `local_dir` it behaves like a server started with --local: getFile
+    answers with an absolute path, backed by a sparse file of the right size in
+    that directory. With `local_http` as well, the path does not exist on this
+    machine and the file is only reachable over HTTP.
+    """
+
+    def __init__(self, local_dir=None, local_http=False, token_rate=0, chat_rate=0, retry_after=1, **kwargs):
+        super().__init__(**kwargs)
+        self.local_dir = local_dir
+        self.local_http = local_http
+        self.token_rate = token_rate
+        self.chat_rate = chat_rate
+        self.retry_after = retry_after
+        # Per token, None holding those for any token
+        self.updates = {}
+        self.new_update = {}
+        self.update_id = 0
+        self.polling = set()
+        self.windows = {}
+        self.floods = {}
+        self.answers = {}
+        self.webhook_url = None
+        self.replied = {}
+        self.texts = {}
+        self.calls = {}
+        self.message_id = 0
+
+    @property
+    def base_url(self):
+        return f"{self.url}/bot"
+
+    @property
+    def base_file_url(self):
+        return f"{self.url}/file/bot"
+
+    def push_update(self, update: dict, tokens=None):
+        """Queue an update for getUpdates, for every bot in `tokens` or any one;
+        safe to call from any thread."""
+        self.loop.call_soon_threadsafe(self._push_update, update, tokens)
+
+    def _push_update(self, update, tokens):
+        self.update_id += 1
+        update.setdefault('update_id', self.update_id)
+        for token in tokens or [None]:
+            self.updates.setdefault(token, []).append(update)
+        for token, new_update in self.new_update.items():
+            if tokens is None or token in tokens:
+                new_update.set()
+
+    def limited(self, key, rate) -> bool:
+        """Whether a call is over `rate` a second for `key`; counted if not."""
+        now = time.monotonic()
+        calls = self.windows.setdefault(key, collections.deque())
+        while calls and calls[0] <= now - 1:
+            calls.popleft()
+        if len(calls) >= rate:
+            return True
+        calls.append(now)
+        return False
+
+    def too_many(self, token):
+        self.floods[token] = self.floods.get(token, 0) + 1
+        body = {'ok': False, 'error_code': 429, 'description': f"Too Many Requests: retry after {self.retry_after}",
+                'parameters': {'retry_after': self.retry_after}}
+        return Response(429, json.dumps(body).encode(), {'Content-Type': 'application/json'})
+
+    def params(self, request):
+        if request.headers.get('content-type', '').startswith('application/json'):
+            return json.loads(request.body or b'{}')
+        return {key: value for key, value in parse_qsl(request.body.decode())}
+
+    def ok(self, result):
+        return Response(200, json.dumps({'ok': True, 'result': result}).encode(), {'Content-Type': 'application/json'})
+
+    def message(self, chat_id, text):
+        self.message_id += 1
+        return {'message_id': self.message_id, 'date': int(time.time()), 'text': text,
+                'chat': {'id': int(chat_id), 'type': 'private' if int(chat_id) > 0 else 'group'}}
+
+    async def handle(self, request):
+        if request.path.startswith('/file/'):
+            return await super().handle(request)
+        token, method = request.path[len('/bot'):].rsplit('/', 1)
+        self.calls[method] = self.calls.get(method, 0) + 1
+        params = self.params(request)
+        if method != 'getUpdates' and self.token_rate and self.limited(token, self.token_rate):
+            return self.too_many(token)
+        if method in ('sendMessage', 'editMessageText') and self.chat_rate and \
+                self.limited((token, params.get('chat_id')), self.chat_rate):
+            return self.too_many(token)
+        return await self.call(method, params, token)
+
+    async def call(self, method, params, token=None):
+        if method == 'getMe':
+            return self.ok({'id': 1, 'is_bot': True, 'first_name': 'Fake', 'username': 'fake_bot',
+                            'can_join_groups': True, 'can_read_all_group_messages': False,
+                            'supports_inline_queries': False})
+        if method == 'getUpdates':
+            self.polling.add(token)
+            queue = token if token in self.updates else None
+            offset = int(params.get('offset', 0))
+            updates = self.updates[queue] = [u for u in self.updates.get(queue, []) if u['update_id'] >= offset]
+            if not updates:
+                self.new_update[token] = asyncio.Event()
+                try:
+                    await asyncio.wait_for(self.new_update[token].wait(), float(params.get('timeout', 0)) or 0.01)
+                except asyncio.TimeoutError:
+                    pass
+                queue = token if token in self.updates else None
+            return self.ok(self.updates.get(queue, [])[:int(params.get('limit', 100))])
+        if method == 'setWebhook':
+            self.webhook_url = params.get('url')
+            return self.ok(True)
+        if method == 'deleteWebhook':
+            self.webhook_url = None
+            return self.ok(True)
+        if method == 'getFile':
+            size = int(params['file_id'].split(':')[0])
+            file_path = f"file_{size}.bin"
+            if self.local_http:
+                file_path = f"/srv/telegram-bot-api/{file_path}"
+            elif self.local_dir:
+                file_path = os.path.join(os.path.abspath(self.local_dir), file_path)
+                if not os.path.exists(file_path):
+                    with open(file_path, 'wb') as f:
+                        f.truncate(size)
+            return self.ok({'file_id': params['file_id'], 'file_unique_id': params['file_id'],
+                            'file_size': size, 'file_path': file_path})
+        if method in ('sendMessage', 'editMessageText'):
+            chat_id = int(params.get('chat_id', 0))
+            self.replied.setdefault(chat_id, time.perf_counter())
+            self.texts.setdefault(chat_id, []).append(params.get('text', ''))
+            reply_to = params.get('reply_parameters')
+            if isinstance(reply_to, str):
+                reply_to = json.loads(reply_to)
+            if reply_to:
+                self.answers.setdefault((chat_id, reply_to['message_id']), []).append(params.get('text', ''))
+            return self.ok(self.message(chat_id, params.get('text', '')))
+        return Response(404, json.dumps({'ok': False, 'error_code': 404, 'description': 'Not Found'}).encode())
+
+
+def command_update(text, chat_id, update_id=None):
+    """A private-chat message update carrying a bot command like /start."""
+    user = {'id': chat_id, 'is_bot': False, 'first_name': 'User'}
+    message = {'message_id': chat_id, 'date': int(time.time()), 'chat': {'id': chat_id, 'type': 'private'},
+               'from': user, 'text': text,
+               'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]}
+    update = {'message': message}
+    if update_id is not None:
+        update['update_id'] = update_id
+    return update
+
+
+def document_message_update(size, chat_id, update_id=None, user_id=None, message_id=None):
+    """A message update carrying a document of `size` bytes: in a private chat,
+    or with a `user_id` and a negative `chat_id` in a group."""
+    user = {'id': user_id or chat_id, 'is_bot': False, 'first_name': 'User'}
+    message_id = message_id or chat_id
+    document = {'file_id': f"{size}:{message_id}", 'file_unique_id': f"{size}:{message_id}", 'file_size': size,
+                'file_name': f"file{message_id}.bin"}
+    chat = {'id': chat_id, 'type': 'private' if chat_id > 0 else 'group'}
+    message = {'message_id': message_id, 'date': int(time.time()), 'chat': chat, 'from': user, 'document': document}
+    update = {'message': message}
+    if update_id is not None:
+        update['update_id'] = update_id
+    return update
+
+
+class ServerThread:
+    """Runs stand-in servers on their own event loop so they keep serving even
+    when the code under test blocks its loop."""
+
+    def __init__(self, *servers):
+        self.servers = servers
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        for server in self.servers:
+            asyncio.run_coroutine_threadsafe(server.start(), self.loop).result()
+        return self.servers
+
+    def __exit__(self, *exc):
+        for server in self.servers:
+            asyncio.run_coroutine_threadsafe(server.stop(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+MESSAGE_IDS = itertools.count(1)
+
+
+class FakeMessage:
+    """Just enough of telegram.Message for handle_file and start.
+
+    `latency` simulates the Bot API round trip of each reply or edit.
+    `answered` is set with the first reply that is not a "⏳" status.
+    Files sent by file_id are answered with a message holding that file_id,
+    unless it starts with "expired:", which Telegram would no longer take.
+    """
+
+    def __init__(self, document=None, video=None, photo=None, caption=None, chat_id=1, media_group_id=None,
+                 latency=0.0):
+        self.document = document
+        self.video = video
+        self.photo = photo or []
+        self.caption = caption
+        self.chat_id = chat_id
+        self.message_id = next(MESSAGE_IDS)
+        self.media_group_id = media_group_id
+        self.latency = latency
+        self.replies = []
+        self.sent_files = []
+        self.edits = 0
+        self.answered = asyncio.Event()
+
+    def _replied(self, text):
+        self.replies.append(text)
+        if not text.startswith('⏳'):
+            self.answered.set()
+
+    async def reply_text(self, text, **kwargs):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self._replied(text)
+        return self
+
+    async def edit_text(self, text, **kwargs):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.edits += 1
+        self._replied(text)
+        return self
+
+    async def _send_file(self, file_id, **fields):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if file_id.startswith('expired:'):
+            raise BadRequest("Wrong file identifier/http url specified")
+        self.sent_files.append(file_id)
+        self.answered.set()
+        return FakeMessage(chat_id=self.chat_id, **fields)
+
+    async def reply_document(self, document, **kwargs):
+        return await self._send_file(document, document=FakeDocument(document, 0))
+
+    async def reply_video(self, video, **kwargs):
+        return await self._send_file(video, video=FakeDocument(video, 0))
+
+    async def reply_photo(self, photo, **kwargs):
+        return await self._send_file(photo, photo=[FakeDocument(photo, 0)])
+
+
+class FakeDocument:
+    def __init__(self, file_id, file_size, file_name='file.bin', file_unique_id=None, mime_type=None):
+        self.file_id = file_id
+        self.file_unique_id = file_unique_id or file_id
+        self.file_size = file_size
+        self.file_name = file_name
+        self.mime_type = mime_type
+
+
+class FakeUpdate:
+    def __init__(self, message, user_id=1):
+        self.message = message
+        self.effective_message = message
+        self.effective_user = type('User', (), {'id': user_id})()
+        self.effective_chat = type('Chat', (), {'id': message.chat_id, 'type': 'private'})()
+
+
+class FakeBot:
+    """Resolves file ids of the form '<size>:<n>', or '<size>:<n>:<kind>' for content
+    other than the default (see CONTENT), to URLs on a FakeTelegramFiles server."""
+
+    def __init__(self, files: FakeTelegramFiles, latency=0.0):
+        self.files = files
+        self.latency = latency
+        self.calls = 0
+
+    async def get_file(self, file_id):
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        size, n, *kind = file_id.split(':')
+        return type('File', (), {'file_path': self.files.file_url(int(size), f"{kind[0]}{n}" if kind else 'file')})()
+
+
+class FakeContext:
+    def __init__(self, bot, bot_data=None):
+        self.bot = bot
+        self.user_data = {}
+        self.args = []
+        self.bot_data = bot_data if bot_data is not None else {}
+
+
+def document_update(size, n=0, user_id=1, media_group_id=None, latency=0.0, kind=None, file_name=None):
+    file_id = f"{size}:{n}:{kind}" if kind else f"{size}:{n}"
+    document = FakeDocument(file_id, size, file_name or f"file{n}.bin")
+    message = FakeMessage(document=document, chat_id=user_id, media_group_id=media_group_id, latency=latency)
+    return FakeUpdate(message, user_id=user_id)
+
+
+class UpdateGenerator:
+    """Endless synthetic document updates for load tests.
+
+    Sizes are drawn from `sizes` (with `weights` if given) and senders from
+    `users` user ids. A `repeat` fraction re-sends a file sent before, which
+    the upload cache should answer without a transfer. Seeded, so two runs
+    send the same files in the same order.
+    """
+
+    def __init__(self, sizes, weights=None, users=100, repeat=0.0, latency=0.0, seed=1):
+        self.sizes = sizes
+        self.weights = weights
+        self.users = users
+        self.repeat = repeat
+        self.latency = latency
+        self.rng = random.Random(seed)
+        self.sent = []
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.sent and self.rng.random() < self.repeat:
+            size, n = self.rng.choice(self.sent)
+        else:
+            size, n = self.rng.choices(self.sizes, self.weights)[0], len(self.sent)
+            self.sent.append((size, n))
+        return document_update(size, n, user_id=self.rng.randrange(self.users) + 1, latency=self.latency)
+
+
+def bot_services(pool, source, scheduler, upload_url, **extra):
+    """The bot_data handle_file expects, built around a stand-in upload URL;
+    databases live in memory."""
+    return {
+        'http_pool': pool,
+        'file_source': source,
+        'upload_cache': UploadCache(':memory:'),
+        'upload_history': UploadHistory(':memory:'),
+        'upload_router': UploadRouter([FilesVcBackend(pool, upload_url)]),
+        'scheduler': scheduler,
+        'rate_limiter': RateLimiter(),
+        'codec': None,
+        **extra,
+    }
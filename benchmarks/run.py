@@ -0,0 +1,187 @@
+"""Transfer benchmark matrix: throughput, latency, memory and CPU per file size and concurrency.
+
+Each cell of the --sizes x --concurrency matrix sends --files synthetic
+documents end to end through handle_file, against the Bot API and files.vc
+stand-ins, from `concurrency` senders that each wait for their answer before
+sending the next file. Cells run in a fresh process each, so RSS and CPU time
+are the bot's alone: the stand-ins run in this one.
+
+Results are written as JSON. With --compare, a previous results file is
+read back and cells that got worse by more than --threshold are listed, and
+the exit status is 1, so the runner can guard the transfer path in CI.
+
+    python -m benchmarks.run --sizes 65536 1048576 8388608 --concurrency 1 4 16
+    python -m benchmarks.run --output new.json --compare baseline.json
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import time
+
+# Higher is better for these, lower for everything else compared
+HIGHER_IS_BETTER = {'mb_per_s', 'files_per_s'}
+COMPARED = ['mb_per_s', 'p50_ms', 'p99_ms', 'cpu_ms_per_mb', 'rss_peak_mb']
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+async def sender(updates, context, latencies):
+    import bot
+    for update in updates:
+        started = time.perf_counter()
+        await bot.handle_file(update, context)
+        await update.message.answered.wait()
+        latencies.append((time.perf_counter() - started) * 1000)
+
+
+async def run_cell(size, concurrency, args, files_port, upload_url):
+    import bot
+    from pool import HttpPool
+    from scheduler import TransferScheduler
+    from sources import LocalBotApiSource
+    from benchmarks.fakes import FakeBot, FakeContext, FakeTelegramFiles, UpdateGenerator, bot_services
+
+    bot.logging.disable(bot.logging.WARNING)
+    bot.PROGRESS_MIN_SIZE = args.progress_min_size
+    pool = HttpPool(max_connections=max(concurrency, 1), max_keepalive=max(concurrency, 1))
+    scheduler = TransferScheduler(concurrency, args.files, args.files)
+    scheduler.start()
+    bot_data = bot_services(pool, LocalBotApiSource(pool), scheduler, upload_url)
+    # Only builds URLs; the server itself runs in the parent
+    files = FakeTelegramFiles(port=files_port)
+    context = FakeContext(FakeBot(files, latency=args.api_latency), bot_data)
+    generator = UpdateGenerator([size], users=args.users, repeat=args.repeat, latency=args.api_latency)
+    updates = [next(generator) for _ in range(args.files)]
+    # Warm up the connections and first-use imports outside the measurement
+    warmup = next(UpdateGenerator([1024], seed=0))
+    await bot.handle_file(warmup, context)
+    await warmup.message.answered.wait()
+
+    latencies = []
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    rss_before = usage.ru_maxrss / 1024
+    started = time.perf_counter()
+    await asyncio.gather(*(sender(updates[i::concurrency], context, latencies) for i in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    after = resource.getrusage(resource.RUSAGE_SELF)
+    await scheduler.stop()
+    await pool.aclose()
+
+    ok = sum(1 for update in updates if update.message.replies[-1].startswith('✅'))
+    megabytes = size * args.files / 2**20
+    cpu = after.ru_utime + after.ru_stime - usage.ru_utime - usage.ru_stime
+    return {
+        'size': size,
+        'concurrency': concurrency,
+        'files': args.files,
+        'ok': ok,
+        'wall_s': round(elapsed, 3),
+        'mb_per_s': round(megabytes / elapsed, 2),
+        'files_per_s': round(args.files / elapsed, 2),
+        'p50_ms': round(statistics.median(latencies), 2),
+        'p99_ms': round(percentile(latencies, 0.99), 2),
+        'rss_before_mb': round(rss_before, 1),
+        'rss_peak_mb': round(after.ru_maxrss / 1024, 1),
+        'cpu_ms_per_mb': round(cpu * 1000 / megabytes, 2),
+    }
+
+
+def cell_main(results, *cell_args):
+    results.put(asyncio.run(run_cell(*cell_args)))
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+
+def compare(results, baseline_path, threshold):
+    with open(baseline_path) as f:
+        baseline = {(cell['size'], cell['concurrency']): cell for cell in json.load(f)['results']}
+    regressions = []
+    for cell in results:
+        before = baseline.get((cell['size'], cell['concurrency']))
+        if before is None:
+            continue
+        for key in COMPARED:
+            if not before[key]:
+                continue
+            change = (cell[key] - before[key]) / before[key]
+            if key in HIGHER_IS_BETTER:
+                change = -change
+            if change > threshold:
+                regressions.append(f"size {cell['size']} x{cell['concurrency']}: {key} {before[key]} -> {cell[key]} "
+                                   f"({change:.0%} worse)")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[64 * 1024, 1024 * 1024, 8 * 1024 * 1024])
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--files', type=int, default=32, help="files per cell")
+    parser.add_argument('--users', type=int, default=8)
+    parser.add_argument('--repeat', type=float, default=0.0, help="fraction of files sent again (cache hits)")
+    parser.add_argument('--rate', type=float, default=32 * 1024 * 1024, help="simulated bytes/sec per connection")
+    parser.add_argument('--latency', type=float, default=0.02, help="simulated upload response time")
+    parser.add_argument('--api-latency', type=float, default=0.02, help="simulated Bot API round trip")
+    parser.add_argument('--progress-min-size', type=int, default=5 * 1024 * 1024)
+    parser.add_argument('--output', default='benchmark-results.json')
+    parser.add_argument('--compare', help="earlier results file to check for regressions")
+    parser.add_argument('--threshold', type=float, default=0.15, help="relative change counted as a regression")
+    args = parser.parse_args()
+
+    from benchmarks.fakes import FakeFilesVc, FakeTelegramFiles, ServerThread
+
+    context = multiprocessing.get_context('spawn')
+    results = []
+    with ServerThread(FakeTelegramFiles(rate=args.rate), FakeFilesVc(rate=args.rate, latency=args.latency)) as (
+            files, uploads):
+        print(f"{'size':>10s} {'conc':>4s} {'ok':>5s} {'MB/s':>7s} {'files/s':>7s} {'p50 ms':>8s} {'p99 ms':>8s} "
+              f"{'RSS MB':>13s} {'CPU ms/MB':>9s}")
+        for size in args.sizes:
+            for concurrency in args.concurrency:
+                queue = context.Queue()
+                process = context.Process(target=cell_main, args=(
+                    queue, size, concurrency, args, files.port, f"{uploads.url}/upload"))
+                process.start()
+                cell = queue.get()
+                process.join()
+                results.append(cell)
+                print(f"{size:10d} {concurrency:4d} {cell['ok']:2d}/{cell['files']:<2d} {cell['mb_per_s']:7.1f} "
+                      f"{cell['files_per_s']:7.1f} {cell['p50_ms']:8.1f} {cell['p99_ms']:8.1f} "
+                      f"{cell['rss_before_mb']:5.0f} -> {cell['rss_peak_mb']:4.0f} {cell['cpu_ms_per_mb']:9.1f}")
+
+    meta = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'args': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+    }
+    with open(args.output, 'w') as f:
+        json.dump({'meta': meta, 'results': results}, f, indent=2)
+    print(f"results written to {args.output}")
+
+    if args.compare:
+        regressions = compare(results, args.compare, args.threshold)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            sys.exit(1)
+        print(f"no regressions against {args.compare} beyond {args.threshold:.0%}")
+
+
+if __name__ == "__main__":
+    main()
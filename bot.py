@@ -1,611 +1,1009 @@
 import os
+import signal
+import asyncio
 import logging
-import requests
-from telegram import Update, File
-from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler, MessageHandler, filters
+import httpx
+from datetime import datetime, timezone
+from telegram import Chat, Message, Update, User
+from telegram.error import BadRequest
+from telegram.ext import ApplicationBuilder, CallbackContext, ContextTypes, CommandHandler, MessageHandler, filters
+from telegram.request import HTTPXRequest
+from albums import MediaGroupCollector
+from backends import FilesVcBackend, ResumableBackend, UploadError, UploadResult, UploadRouter
+from cache import UploadCache
+from compress import ArchiveSource, CompressingSource, compressed_type, get_codec
+from dispatcher import BotApiDispatcher, progress_lane
+from history import UploadHistory
+from jobqueue import SqliteJobQueue
+from logs import new_transfer_id, parse_rates, setup_logging, transfer_id
+from metrics import (ERRORS, IN_FLIGHT, JOB_QUEUE_JOBS, QUEUED, RELAY_BYTES, RELAY_LOOKUPS, STAGE_SECONDS,
+                     MetricsServer)
+from pool import HttpPool
+from preflight import HealthCheck, Preflight, Rejected, normalize_name
+from ratelimit import RateLimiter
+from relay import RelayCache, share_code
+from resumable import ResumableUploader
+from scheduler import QueueFull, TransferScheduler
+from shards import ShardRequest, ShardRouter
+from sources import MB, BotApiSource, LocalBotApiSource
+from spool import Spool
+from transfer import ProgressReporter, ssl_context
 
 # Configuration
 TELEGRAM_TOKEN = os.environ.get("TELEGRAM_TOKEN")
-API_UPLOAD_URL = "https://api.files.vc/upload"
-MAX_FILE_SIZE = 20 * 1024 * 1024  # 20MB
-
-# Logging setup
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+API_UPLOAD_URL = os.environ.get("API_UPLOAD_URL", "https://api.files.vc/upload")
+API_DOWNLOAD_URL = os.environ.get("API_DOWNLOAD_URL", "https://files.vc/d/dl?hash={hash}")
+
+# Further destinations with the files.vc upload API, comma-separated as
+# "upload_url|download_url", the download URL containing {hash}. Each file goes
+# to whichever destination has been fastest lately (see backends.py)
+UPLOAD_MIRRORS = [m.split("|", 1) for m in os.environ.get("UPLOAD_MIRRORS", "").split(",") if "|" in m]
+ROUTER_MAX_FAILURES = int(os.environ.get("ROUTER_MAX_FAILURES", 3))
+ROUTER_COOLDOWN = float(os.environ.get("ROUTER_COOLDOWN", 60))
+
+# Self-hosted Bot API server (https://github.com/tdlib/telegram-bot-api), needed for files over 20MB
+BOT_API_URL = os.environ.get("BOT_API_URL")  # e.g. http://localhost:8081/bot
+BOT_API_FILE_URL = os.environ.get("BOT_API_FILE_URL")  # e.g. http://localhost:8081/file/bot
+BOT_API_LOCAL = os.environ.get("BOT_API_LOCAL", "0") == "1"  # server runs with --local
+
+# Downloads from the Bot API as up to DOWNLOAD_RANGES concurrent Range requests
+# of DOWNLOAD_RANGE_SIZE bytes, put back in order; 1 for a single stream. How
+# many run at once adapts to the link (see transfer.RangedFileStreamer), and
+# ranges waiting their turn take at most DOWNLOAD_BUFFER bytes per file
+DOWNLOAD_RANGES = int(os.environ.get("DOWNLOAD_RANGES", 8))
+DOWNLOAD_RANGE_SIZE = int(os.environ.get("DOWNLOAD_RANGE_SIZE", 2 * 1024 * 1024))
+DOWNLOAD_BUFFER = int(os.environ.get("DOWNLOAD_BUFFER", 32 * 1024 * 1024))
+
+# Connection pool, per upstream host
+HTTP_MAX_CONNECTIONS = int(os.environ.get("HTTP_MAX_CONNECTIONS", 20))
+HTTP_MAX_KEEPALIVE = int(os.environ.get("HTTP_MAX_KEEPALIVE", 10))
+HTTP_IDLE_TIMEOUT = float(os.environ.get("HTTP_IDLE_TIMEOUT", 60))
+
+# Upload dedup cache
+CACHE_DB = os.environ.get("CACHE_DB", "cache.db")
+CACHE_MAX_ENTRIES = int(os.environ.get("CACHE_MAX_ENTRIES", 100_000))
+CACHE_TTL = float(os.environ.get("CACHE_TTL", 30 * 24 * 3600))
+
+# Upload history behind /myfiles and /search
+HISTORY_DB = os.environ.get("HISTORY_DB", "history.db")
+HISTORY_PAGE_SIZE = int(os.environ.get("HISTORY_PAGE_SIZE", 10))
+
+# Share codes: with RELAY_CACHE=1 every file sent to the bot gets a short code,
+# and /get <code> has the bot send it again by its Telegram file_id, which
+# moves no bytes at all. RELAY_MEMORY_ENTRIES of them are kept in memory
+RELAY_CACHE = os.environ.get("RELAY_CACHE", "0") == "1"
+RELAY_DB = os.environ.get("RELAY_DB", "relay.db")
+RELAY_MAX_ENTRIES = int(os.environ.get("RELAY_MAX_ENTRIES", 100_000))
+RELAY_MEMORY_ENTRIES = int(os.environ.get("RELAY_MEMORY_ENTRIES", 10_000))
+
+# Pre-flight checks, run while a file waits in the queue: its type is read from
+# its first bytes and the upload hosts are probed (each at most every
+# HEALTH_CHECK_TTL seconds), so files that cannot be uploaded are turned away
+# before they are transferred. BLOCKED_TYPES are comma-separated MIME types or
+# prefixes, matched by name and by content, e.g. "application/x-msdownload"
+PREFLIGHT = os.environ.get("PREFLIGHT", "1") == "1"
+BLOCKED_TYPES = [t for t in os.environ.get("BLOCKED_TYPES", "").split(",") if t.strip()]
+HEALTH_CHECK_TTL = float(os.environ.get("HEALTH_CHECK_TTL", 30))
+
+# Transfer scheduler
+TRANSFER_WORKERS = int(os.environ.get("TRANSFER_WORKERS", 4))
+MAX_QUEUED = int(os.environ.get("MAX_QUEUED", 100))
+MAX_QUEUED_PER_USER = int(os.environ.get("MAX_QUEUED_PER_USER", 20))
+
+# Rate limits, 0 for none. Files over a files/minute limit are turned away;
+# bytes/second limits slow transfers down instead. Admins (comma-separated
+# user ids) can change them while running with /limits, until the next start;
+# with JOB_QUEUE_DB set the worker processes follow the change too
+RATE_USER_FILES_PER_MINUTE = float(os.environ.get("RATE_USER_FILES_PER_MINUTE", 0))
+RATE_GLOBAL_FILES_PER_MINUTE = float(os.environ.get("RATE_GLOBAL_FILES_PER_MINUTE", 0))
+RATE_USER_BYTES_PER_SECOND = float(os.environ.get("RATE_USER_BYTES_PER_SECOND", 0))
+RATE_GLOBAL_BYTES_PER_SECOND = float(os.environ.get("RATE_GLOBAL_BYTES_PER_SECOND", 0))  # per process
+ADMIN_IDS = {int(i) for i in os.environ.get("ADMIN_IDS", "").split(",") if i.strip()}
+
+# Transfers in separate worker processes (see worker.py) fed through a job queue
+# in this SQLite file; unset to transfer in the bot process itself
+JOB_QUEUE_DB = os.environ.get("JOB_QUEUE_DB")  # e.g. jobs.db
+WORKER_PROCESSES = int(os.environ.get("WORKER_PROCESSES", 2))
+WORKER_CONCURRENCY = int(os.environ.get("WORKER_CONCURRENCY", 4))  # transfers per process
+JOB_LEASE = float(os.environ.get("JOB_LEASE", 60))  # redelivered if a worker is silent this long
+
+# Chunked, resumable uploads for targets that support them (see resumable.py),
+# routed to alongside the single-request destinations above
+RESUMABLE_UPLOAD_URL = os.environ.get("RESUMABLE_UPLOAD_URL")
+UPLOAD_CHUNK_SIZE = int(os.environ.get("UPLOAD_CHUNK_SIZE", 8 * 1024 * 1024))
+UPLOAD_PARALLEL = int(os.environ.get("UPLOAD_PARALLEL", 4))
+UPLOAD_RETRIES = int(os.environ.get("UPLOAD_RETRIES", 5))
+CHECKPOINT_DIR = os.environ.get("CHECKPOINT_DIR", "checkpoints")
+
+# Download files of at least SPOOL_MIN_SIZE bytes to a temp file in SPOOL_DIR
+# (default: the system's) before uploading them, instead of streaming them
+# straight through; frees the download early and retries skip the download
+SPOOL_TRANSFERS = os.environ.get("SPOOL_TRANSFERS", "0") == "1"
+SPOOL_DIR = os.environ.get("SPOOL_DIR")
+SPOOL_MIN_SIZE = int(os.environ.get("SPOOL_MIN_SIZE", 0))
+
+# Compression on the way to the upload target: "off", "gzip", "zstd" (needs the
+# zstandard package) or "auto" for zstd when installed and gzip otherwise. A file
+# of at least COMPRESSION_MIN_SIZE bytes is compressed unless its type is a
+# compressed one already or its first chunk does not shrink to
+# COMPRESSION_MAX_RATIO of its size; its name then gets a .gz or .zst suffix
+COMPRESSION = os.environ.get("COMPRESSION", "off")
+COMPRESSION_LEVEL = os.environ.get("COMPRESSION_LEVEL")  # the codec's default if unset
+COMPRESSION_MIN_SIZE = int(os.environ.get("COMPRESSION_MIN_SIZE", 64 * 1024))
+COMPRESSION_MAX_RATIO = float(os.environ.get("COMPRESSION_MAX_RATIO", 0.8))
+
+# /zip bundles the files sent until the next /zip into one archive with one link.
+# Members are deflated at ZIP_LEVEL on the same terms as above, whatever COMPRESSION is
+ZIP_MAX_FILES = int(os.environ.get("ZIP_MAX_FILES", 50))
+ZIP_LEVEL = int(os.environ.get("ZIP_LEVEL", 6))
+
+# Albums: items arriving within ALBUM_WINDOW seconds of each other are one batch,
+# uploaded ALBUM_PARALLEL at a time and answered with a single message
+ALBUM_WINDOW = float(os.environ.get("ALBUM_WINDOW", 0.5))
+ALBUM_PARALLEL = int(os.environ.get("ALBUM_PARALLEL", 5))
+
+# Live progress message, for files big enough to take a while
+PROGRESS_MIN_SIZE = int(os.environ.get("PROGRESS_MIN_SIZE", 5 * 1024 * 1024))
+PROGRESS_INTERVAL = float(os.environ.get("PROGRESS_INTERVAL", 3))
+
+# Update delivery: "polling" for development, "webhook" behind a public HTTPS endpoint
+BOT_MODE = os.environ.get("BOT_MODE", "polling")
+# Long polls return as soon as there is an update, so no pause is needed between them
+POLL_INTERVAL = float(os.environ.get("POLL_INTERVAL", 0))
+POLL_TIMEOUT = int(os.environ.get("POLL_TIMEOUT", 30))
+# Connections for other Bot API calls. A backlog is handled all at once after a
+# restart, and opening a connection for every reply would only slow it down
+BOT_API_CONNECTIONS = int(os.environ.get("BOT_API_CONNECTIONS", 32))
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")  # public URL Telegram posts updates to
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", 8443))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "")
+# Required in webhook mode: updates without it are refused, so no one else can post them
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get("WEBHOOK_MAX_CONNECTIONS", 40))
+
+# Outgoing Bot API calls (see dispatcher.py). Calls are made at most
+# BOT_API_RATE a second in all, and messages sent or edited at most
+# BOT_API_CHAT_RATE a second in a private chat and BOT_API_GROUP_PER_MINUTE a
+# minute in a group, after bursts of BOT_API_CHAT_BURST; 0 for no limit.
+# Replies go before progress edits, and 429s are waited out and the call made
+# again, unless Telegram asks for more than BOT_API_MAX_FLOOD_WAIT seconds.
+# With JOB_QUEUE_DB set the bot and its WORKER_PROCESSES workers share the
+# token, so each process gets an even share of BOT_API_RATE; the chat budgets
+# stay per process
+BOT_API_RATE = float(os.environ.get("BOT_API_RATE", 30))
+BOT_API_CHAT_RATE = float(os.environ.get("BOT_API_CHAT_RATE", 1))
+BOT_API_GROUP_PER_MINUTE = float(os.environ.get("BOT_API_GROUP_PER_MINUTE", 20))
+BOT_API_CHAT_BURST = int(os.environ.get("BOT_API_CHAT_BURST", 3))
+BOT_API_MAX_FLOOD_WAIT = float(os.environ.get("BOT_API_MAX_FLOOD_WAIT", 60))
+
+# More bots: TELEGRAM_TOKENS, comma-separated, runs one bot per token in this
+# process instead (polling only), each with its own Bot API connections and
+# budgets as above. Users stay with the bot they wrote to; in groups several
+# of them are in, each user's files go to one of them and move off one that
+# is flood limited or backed up, the others waiting up to SHARD_HANDOFF
+# seconds for it to take them (see shards.py)
+TELEGRAM_TOKENS = [t.strip() for t in os.environ.get("TELEGRAM_TOKENS", "").split(",") if t.strip()]
+SHARD_HANDOFF = float(os.environ.get("SHARD_HANDOFF", 2))
+
+# Shutdown: on SIGTERM or SIGINT, transfers in this process get SHUTDOWN_TIMEOUT
+# seconds to finish; whatever is left is kept in PENDING_JOBS_DB and resumed on
+# the next start, so that file should be on storage that survives a restart
+SHUTDOWN_TIMEOUT = float(os.environ.get("SHUTDOWN_TIMEOUT", 5))
+PENDING_JOBS_DB = os.environ.get("PENDING_JOBS_DB", "pending.db")
+
+# Prometheus metrics endpoint (see metrics.py); unset to not serve one. Worker
+# processes serve theirs on the ports after it (see worker.py)
+METRICS_PORT = os.environ.get("METRICS_PORT")  # e.g. 9464
+METRICS_LISTEN = os.environ.get("METRICS_LISTEN", "0.0.0.0")
+
+# Logging. Lines are written by a background thread, and beyond LOG_QUEUE_SIZE
+# waiting ones new lines are dropped rather than holding up the bot (0 writes
+# them right away instead). LOG_FORMAT=json writes one object per line. Either
+# way lines carry the id of the transfer they belong to. LOG_SAMPLE keeps only
+# a share of the lines of busy events or loggers, whole transfers at a time,
+# e.g. "httpx=0.1,api_response=0.1"; warnings and errors are always kept
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text")
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+LOG_SAMPLE = parse_rates(os.environ.get("LOG_SAMPLE", ""))
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", 10_000))
+
+def configure_logging():
+    """Set up logging as configured; worker processes call it again after the fork."""
+    setup_logging(LOG_FORMAT, LOG_LEVEL, LOG_SAMPLE, LOG_QUEUE_SIZE)
+
+configure_logging()
 logger = logging.getLogger(__name__)
 
-class TelegramFileStreamer:
-    def __init__(self, file_path: str):
-        self.response = requests.get(file_path, stream=True)
-        self.response.raise_for_status()
-        self.iterator = self.response.iter_content(chunk_size=8192)
-        self.total_size = int(self.response.headers.get('content-length', 0))
-        self.uploaded_size = 0
-
-    def read(self, chunk_size=None):
+def build_router(pool):
+    backends = [FilesVcBackend(pool, API_UPLOAD_URL, API_DOWNLOAD_URL)]
+    for upload_url, download_url in UPLOAD_MIRRORS:
+        backends.append(FilesVcBackend(pool, upload_url, download_url, name=httpx.URL(upload_url).host))
+    if RESUMABLE_UPLOAD_URL:
+        uploader = ResumableUploader(pool, RESUMABLE_UPLOAD_URL, CHECKPOINT_DIR,
+                                     UPLOAD_CHUNK_SIZE, UPLOAD_PARALLEL, UPLOAD_RETRIES)
+        backends.append(ResumableBackend(uploader))
+    return UploadRouter(backends, max_failures=ROUTER_MAX_FAILURES, cooldown=ROUTER_COOLDOWN)
+
+def create_services(bot_data, local_mode):
+    """What transfers need, shared by the bot process and the worker processes."""
+    bot_data['http_pool'] = HttpPool(HTTP_MAX_CONNECTIONS, HTTP_MAX_KEEPALIVE, HTTP_IDLE_TIMEOUT)
+    source = LocalBotApiSource if local_mode else BotApiSource
+    bot_data['file_source'] = source(bot_data['http_pool'], DOWNLOAD_RANGES, DOWNLOAD_RANGE_SIZE, DOWNLOAD_BUFFER)
+    bot_data['upload_router'] = build_router(bot_data['http_pool'])
+    bot_data['upload_cache'] = UploadCache(CACHE_DB, CACHE_MAX_ENTRIES, CACHE_TTL)
+    bot_data['upload_history'] = UploadHistory(HISTORY_DB)
+    bot_data['upload_history'].start()
+    bot_data['rate_limiter'] = RateLimiter(RATE_USER_FILES_PER_MINUTE, RATE_GLOBAL_FILES_PER_MINUTE,
+                                           RATE_USER_BYTES_PER_SECOND, RATE_GLOBAL_BYTES_PER_SECOND)
+    bot_data['codec'] = get_codec(COMPRESSION, COMPRESSION_LEVEL)
+    if PREFLIGHT:
+        bot_data['preflight'] = Preflight(bot_data['file_source'], bot_data['upload_router'],
+                                          HealthCheck(bot_data['http_pool'], HEALTH_CHECK_TTL), BLOCKED_TYPES)
+
+async def close_services(bot_data):
+    logger.info(f"Upload backends: {bot_data['upload_router'].stats()}")
+    logger.info(f"Rate limiter: {bot_data['rate_limiter'].stats()}")
+    await bot_data['http_pool'].aclose()
+    bot_data['upload_cache'].close()
+    await bot_data['upload_history'].close()
+
+def job_update(telegram_bot, job: dict) -> Update:
+    """Rebuild the Update a queued job came from, with just what replying to it needs."""
+    message = Message(
+        job['message_id'], datetime.now(timezone.utc), Chat(job['chat_id'], job['chat_type']),
+        from_user=User(job['user_id'], 'user', False),
+    )
+    message.set_bot(telegram_bot)
+    return Update(0, message=message)
+
+async def resume_pending(apps):
+    """Queue the jobs the last run had to leave unfinished when it stopped, each
+    answered by the bot, one of `apps`, that took it."""
+    if not os.path.exists(PENDING_JOBS_DB):
+        return
+    pending = SqliteJobQueue(PENDING_JOBS_DB)
+    jobs = await asyncio.to_thread(pending.take_all)
+    resumed = 0
+    for job in jobs:
+        app = apps[job.get('shard', 0)] if job.get('shard', 0) < len(apps) else apps[0]
+        update = job_update(app.bot, job)
+        context = CallbackContext(app, chat_id=job['chat_id'], user_id=job['user_id'])
         try:
-            chunk = next(self.iterator)
-            self.uploaded_size += len(chunk)
-            logger.info(f"Uploaded {self.uploaded_size} of {self.total_size} bytes")
-            return chunk
-        except StopIteration:
-            return b''
-
-    def close(self):
-        self.response.close()
+            app.bot_data['scheduler'].submit(
+                job['user_id'], lambda update=update, context=context, job=job: run_job(
+                    update, context, job['files'], job['album'], job.get('archive', False),
+                    transfer=job.get('transfer_id')), job
+            )
+        except QueueFull:
+            # Kept for the next start rather than dropped
+            await asyncio.to_thread(pending.put, job)
+            continue
+        resumed += 1
+    pending.close()
+    if jobs:
+        logger.info(f"Resumed {resumed} of {len(jobs)} jobs left over from the last run")
+
+async def export_job_queue(queue, interval=5.0):
+    """Keep the queue gauges current; the workers change JOB_QUEUE_DB too."""
+    while True:
+        stats = await asyncio.to_thread(queue.stats)
+        for state, count in stats.items():
+            JOB_QUEUE_JOBS.labels(state).set(count)
+        QUEUED.set(stats['ready'])
+        await asyncio.sleep(interval)
+
+async def start_services(app):
+    create_services(app.bot_data, app.bot.local_mode)
+    if JOB_QUEUE_DB:
+        app.bot_data['job_queue'] = SqliteJobQueue(JOB_QUEUE_DB)
+        # The workers build their limiter from the same environment, this only undoes earlier /limits changes
+        await asyncio.to_thread(app.bot_data['job_queue'].set_limits, app.bot_data['rate_limiter'].limits)
+    if RELAY_CACHE:
+        app.bot_data['relay'] = RelayCache(RELAY_DB, RELAY_MAX_ENTRIES, RELAY_MEMORY_ENTRIES, HISTORY_PAGE_SIZE)
+    app.bot_data['scheduler'] = TransferScheduler(TRANSFER_WORKERS, MAX_QUEUED, MAX_QUEUED_PER_USER)
+    app.bot_data['scheduler'].start()
+    app.bot_data['media_groups'] = MediaGroupCollector(submit_album, ALBUM_WINDOW)
+    if METRICS_PORT:
+        app.bot_data['metrics_server'] = MetricsServer(host=METRICS_LISTEN, port=int(METRICS_PORT))
+        await app.bot_data['metrics_server'].start()
+        if JOB_QUEUE_DB:
+            app.bot_data['job_queue_export'] = asyncio.create_task(export_job_queue(app.bot_data['job_queue']))
+
+async def post_init(app):
+    await start_services(app)
+    if not JOB_QUEUE_DB:
+        await resume_pending([app])
+
+async def post_stop(app):
+    """Updates no longer come in: let transfers finish for up to SHUTDOWN_TIMEOUT
+    seconds and keep the rest for the next start. The bot can still reply here."""
+    media_groups = app.bot_data['media_groups']
+    media_groups.flush()
+    await media_groups.join()
+    started = asyncio.get_running_loop().time()
+    left = await app.bot_data['scheduler'].drain(SHUTDOWN_TIMEOUT)
+    if left:
+        pending = SqliteJobQueue(PENDING_JOBS_DB)
+        for job in left:
+            await asyncio.to_thread(pending.put, job)
+        pending.close()
+        logger.warning(f"Kept {len(left)} unfinished jobs in {PENDING_JOBS_DB} for the next start")
+    logger.info(f"Drained in {asyncio.get_running_loop().time() - started:.1f}s")
+
+async def post_shutdown(app):
+    if 'job_queue_export' in app.bot_data:
+        app.bot_data['job_queue_export'].cancel()
+    if 'metrics_server' in app.bot_data:
+        await app.bot_data['metrics_server'].stop()
+    if 'job_queue' in app.bot_data:
+        app.bot_data['job_queue'].close()
+    if 'relay' in app.bot_data:
+        app.bot_data['relay'].close()
+    await close_services(app.bot_data)
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info("Start command received")
+    max_file_size = context.bot_data['file_source'].max_file_size
     await update.message.reply_text(
         "📤 Send me any file to get a download link!\n"
-        "Note: This bot can only handle files up to 20MB due to Telegram Bot API limitations.\n"
+        f"Note: This bot can only handle files up to {max_file_size // MB}MB due to Telegram Bot API limitations.\n"
         "Created by @Imebrahim"
     )
 
-async def handle_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    try:
-        if update.message.document:
-            file = update.message.document
-            filename = file.file_name
-            file_size = file.file_size
-            file_id = file.file_id
-        elif update.message.video:
-            file = update.message.video
-            filename = f"{file.file_name}.mp4"
-            file_size = file.file_size
-            file_id = file.file_id
-        elif update.message.photo:
-            file = update.message.photo[-1]
-            filename = f"{update.message.caption or 'photo'}.jpg"
-            file_size = file.file_size
-            file_id = file.file_id
-        else:
-            await update.message.reply_text("❌ Unsupported file type. Please send a document, video, or photo.")
-            return
-
-        logger.info(f"File name: {filename}")
-        logger.info(f"File size: {file_size} bytes")
-        logger.info(f"Max file size: {MAX_FILE_SIZE} bytes")
-
-        if file_size > MAX_FILE_SIZE:
-            logger.error(f"File size {file_size} bytes exceeds the maximum limit of {MAX_FILE_SIZE} bytes")
-            await update.message.reply_text("⚠️ File exceeds 20MB limit. Please send a smaller file.")
-            return
-
-        # Store the file_id for later use
-        context.user_data['file_id'] = file_id
-
-        # Use the file_id to get the file path
-        file_obj = await context.bot.get_file(file_id)
-        logger.info(f"File path: {file_obj.file_path}")
-
-        streamer = TelegramFileStreamer(file_obj.file_path)
-
-        files = {'file': (filename, streamer)}
-        response = requests.post(API_UPLOAD_URL, files=files)
-
-        logger.info(f"API Response: {response.status_code} - {response.text}")
-
-        if response.status_code == 200:
-            result = response.json()
-            if "debug_info" in result and "hash" in result["debug_info"]:
-                file_hash = result["debug_info"]["hash"]
-                download_url = f"https://files.vc/d/dl?hash={file_hash}"
-                await update.message.reply_text(
-                    f"✅ Upload successful!\n"
-                    f"🔗 Download link: {download_url}"
-                )
-            else:
-                await update.message.reply_text(f"❌ API Error: {result.get('message', 'Unknown error')}")
-        else:
-            await update.message.reply_text(f"❌ API Error: {response.text}")
-
-    except Exception as e:
-        logger.error(f"Error: {str(e)}")
-        await update.message.reply_text(f"⚠️ Error: {str(e)}")
-
-if __name__ == "__main__":
-    if not TELEGRAM_TOKEN:
-        logger.error("Missing TELEGRAM_TOKEN!")
-        exit(1)
-
-    app = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(MessageHandler(filters.Document.ALL | filters.VIDEO | filters.PHOTO, handle_file))
-
-    # Keep the bot running
-    app.run_polling(poll_interval=1.0)
-        self.response.close()
-
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    logger.info("Start command received")
+async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if 'job_queue' in context.bot_data:
+        stats = await asyncio.to_thread(context.bot_data['job_queue'].stats)
+        await update.message.reply_text(f"📊 Queue: {stats['ready']} waiting, {stats['claimed']} uploading")
+        return
+    stats = context.bot_data['scheduler'].stats()
     await update.message.reply_text(
-        "📤 Send me any file to get a download link!\n"
-        "Note: This bot can only handle files up to 20MB due to Telegram Bot API limitations.\n"
-        "Created by @Imebrahim"
+        f"📊 Queue: {stats['queued']} waiting, {stats['running']} uploading\n"
+        f"⏱ Average wait: {stats['wait_avg']:.1f}s (p95 {stats['wait_p95']:.1f}s)"
     )
 
-async def handle_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    try:
-        if update.message.document:
-            file = update.message.document
-            filename = file.file_name
-            file_size = file.file_size
-            file_id = file.file_id
-        elif update.message.video:
-            file = update.message.video
-            filename = f"{file.file_name}.mp4"
-            file_size = file.file_size
-            file_id = file.file_id
-        elif update.message.photo:
-            file = update.message.photo[-1]
-            filename = f"{update.message.caption or 'photo'}.jpg"
-            file_size = file.file_size
-            file_id = file.file_id
-        else:
-            await update.message.reply_text("❌ Unsupported file type. Please send a document, video, or photo.")
+async def limits(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/limits shows the rate limits; /limits <name> <value> changes one (admins only)."""
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("❌ Only admins can see or change the limits.")
+        return
+    limiter = context.bot_data['rate_limiter']
+    if context.args:
+        try:
+            name, value = context.args
+            limiter.configure(**{name: float(value)})
+        except ValueError as e:
+            await update.message.reply_text(f"❌ {e}\nUsage: /limits <name> <value>")
             return
-
-        logger.info(f"File name: {filename}")
-        logger.info(f"File size: {file_size} bytes")
-        logger.info(f"Max file size: {MAX_FILE_SIZE} bytes")
-
-        if file_size > MAX_FILE_SIZE:
-            logger.error(f"File size {file_size} bytes exceeds the maximum limit of {MAX_FILE_SIZE} bytes")
-            await update.message.reply_text("⚠️ File exceeds 20MB limit. Please send a smaller file.")
+        if 'job_queue' in context.bot_data:
+            # Where the worker processes, which do the transfers, read it from
+            await asyncio.to_thread(context.bot_data['job_queue'].set_limits, {name: limiter.limits[name]})
+    lines = [f"{name}: {value:g}" if value else f"{name}: off" for name, value in limiter.limits.items()]
+    await update.message.reply_text("🚦 Rate limits\n" + "\n".join(lines))
+
+async def zip_files(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/zip starts collecting files for an archive, /zip again uploads it, /zip cancel drops it."""
+    files = context.user_data.pop('zip', None)
+    if context.args and context.args[0] == "cancel":
+        await update.message.reply_text("📦 Archive cancelled." if files is not None else "📦 No archive to cancel.")
+        return
+    if files is None:
+        context.user_data['zip'] = []
+        await update.message.reply_text(
+            f"📦 Send up to {ZIP_MAX_FILES} files, then /zip again to get them as one archive with one link."
+        )
+        return
+    if not files:
+        await update.message.reply_text("📦 No files were sent, so there is no archive.")
+        return
+    await submit(update, context, files, archive=True)
+
+async def get_shared(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/get <code> sends a file again by its file_id; /get alone lists the codes of this chat's files."""
+    relay = context.bot_data.get('relay')
+    if relay is None:
+        await update.message.reply_text("❌ Share codes are not enabled on this bot.")
+        return
+    if not context.args:
+        files = await asyncio.to_thread(relay.recent, update.effective_chat.id, HISTORY_PAGE_SIZE)
+        if not files:
+            await update.message.reply_text("♻️ Usage: /get <code>, with the code from an upload's answer.")
             return
+        lines = [f"• {f['name']} ({format_size(f['size'])}): /get {f['code']}" for f in files]
+        await update.message.reply_text("♻️ Latest files in this chat:\n" + "\n".join(lines))
+        return
+
+    code = context.args[0].lower()
+    entry = await asyncio.to_thread(relay.get, code)
+    if entry is None:
+        RELAY_LOOKUPS.labels('miss').inc()
+        await update.message.reply_text(f"❌ No file with the code {code}.")
+        return
+    send = {'document': update.message.reply_document, 'video': update.message.reply_video,
+            'photo': update.message.reply_photo}[entry['kind']]
+    try:
+        with STAGE_SECONDS.labels('relay').time():
+            message = await send(entry['file_id'])
+    except BadRequest as e:
+        if "file" not in str(e).lower():
+            raise
+        # Telegram no longer takes the file_id, e.g. the file was deleted
+        logger.warning(f"Share code {code} is stale: {e}")
+        RELAY_LOOKUPS.labels('stale').inc()
+        await asyncio.to_thread(relay.forget, code)
+        await update.message.reply_text("❌ This file is no longer available. Send it again to get a new code.")
+        return
+    RELAY_LOOKUPS.labels(entry['source']).inc()
+    RELAY_BYTES.inc(entry['size'])
+    # What Telegram answered with is the latest valid file_id
+    details = file_details(message)
+    if details:
+        await asyncio.to_thread(relay.remember, update.effective_chat.id, entry['file_unique_id'], details[2],
+                                entry['kind'], entry['name'], entry['size'])
+
+def share_line(file_unique_id):
+    """The reply line with a file's /get code, when share codes are on."""
+    return f"♻️ Share code: /get {share_code(file_unique_id)}\n" if RELAY_CACHE else ""
+
+def file_kind(message):
+    """How a message's file is sent again by file_id: "document", "video" or "photo"."""
+    return "document" if message.document else "video" if message.video else "photo"
+
+def file_details(message):
+    """(filename, file_size, file_id, file_unique_id) of a message's file, or None."""
+    if message.document:
+        file = message.document
+        filename = normalize_name(file.file_name, file.mime_type, "document")
+    elif message.video:
+        file = message.video
+        filename = normalize_name(file.file_name, file.mime_type or "video/mp4", "video")
+    elif message.photo:
+        file = message.photo[-1]
+        filename = normalize_name(f"{message.caption or 'photo'}.jpg", default="photo")
+    else:
+        return None
+    return filename, file.file_size, file.file_id, file.file_unique_id
+
+def format_size(size):
+    for unit in ("B", "KB", "MB"):
+        if size < 1024:
+            return f"{size:.0f}{unit}" if unit == "B" else f"{size:.1f}{unit}"
+        size /= 1024
+    return f"{size:.1f}GB"
+
+def format_files(files):
+    return "\n".join(f"• {f['name']} ({format_size(f['size'])})\n  {f['download_url']}" for f in files)
+
+async def myfiles(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    page = max(int(context.args[0]) if context.args and context.args[0].isdigit() else 1, 1)
+    history = context.bot_data['upload_history']
+    files, total = await history.page(update.effective_user.id, page, HISTORY_PAGE_SIZE)
+    pages = max(1, -(-total // HISTORY_PAGE_SIZE))
+    if not files:
+        await update.message.reply_text("📂 No files here yet." if total == 0 else f"📂 There are only {pages} pages.")
+        return
+    footer = f"\n\nNext: /myfiles {page + 1}" if page < pages else ""
+    await update.message.reply_text(
+        f"📂 Your files, page {page}/{pages} ({total} total):\n{format_files(files)}{footer}",
+        disable_web_page_preview=True,
+    )
 
-        # Store the file_id for later use
-        context.user_data['file_id'] = file_id
-
-        # Use the file_id to get the file path
-        file_obj = await context.bot.get_file(file_id)
-        logger.info(f"File path: {file_obj.file_path}")
-
-        streamer = TelegramFileStreamer(file_obj.file_path)
-
-        files = {'file': (filename, streamer)}
-        response = requests.post(API_UPLOAD_URL, files=files)
-
-        logger.info(f"API Response: {response.status_code} - {response.text}")
-
-        if response.status_code == 200:
-            result = response.json()
-            if "debug_info" in result and "hash" in result["debug_info"]:
-                file_hash = result["debug_info"]["hash"]
-                download_url = f"https://files.vc/d/dl?hash={file_hash}"
-                await update.message.reply_text(
-                    f"✅ Upload successful!\n"
-                    f"🔗 Download link: {download_url}"
-                )
-            else:
-                await update.message.reply_text(f"❌ API Error: {result.get('message', 'Unknown error')}")
-        else:
-            await update.message.reply_text(f"❌ API Error: {response.text}")
-
-    except Exception as e:
-        logger.error(f"Error: {str(e)}")
-        await update.message.reply_text(f"⚠️ Error: {str(e)}")
-
-if __name__ == "__main__":
-    if not TELEGRAM_TOKEN:
-        logger.error("Missing TELEGRAM_TOKEN!")
-        exit(1)
-
-    app = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(MessageHandler(filters.Document.ALL | filters.VIDEO | filters.PHOTO, handle_file))
-
-    # Keep the bot running
-    app.run_polling(poll_interval=1.0)
-        self.response.close()
-
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    logger.info("Start command received")
+async def search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text = " ".join(context.args or [])
+    if not text:
+        await update.message.reply_text("🔍 Usage: /search <part of a file name>")
+        return
+    files = await context.bot_data['upload_history'].search(update.effective_user.id, text, HISTORY_PAGE_SIZE)
+    if not files:
+        await update.message.reply_text(f"🔍 No files matching \"{text}\".")
+        return
     await update.message.reply_text(
-        "📤 Send me any file to get a download link!\n"
-        "Note: This bot can only handle files up to 20MB due to Telegram Bot API limitations.\n"
-        "Created by @Imebrahim"
+        f"🔍 Latest files matching \"{text}\":\n{format_files(files)}",
+        disable_web_page_preview=True,
     )
 
 async def handle_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    new_transfer_id()
     try:
-        if update.message.document:
-            file = update.message.document
-            filename = file.file_name
-            file_size = file.file_size
-            file_id = file.file_id
-        elif update.message.video:
-            file = update.message.video
-            filename = f"{file.file_name}.mp4"
-            file_size = file.file_size
-            file_id = file.file_id
-        elif update.message.photo:
-            file = update.message.photo[-1]
-            filename = f"{update.message.caption or 'photo'}.jpg"
-            file_size = file.file_size
-            file_id = file.file_id
-        else:
+        details = file_details(update.message)
+        if details is None:
             await update.message.reply_text("❌ Unsupported file type. Please send a document, video, or photo.")
             return
-
-        logger.info(f"File name: {filename}")
-        logger.info(f"File size: {file_size} bytes")
-        logger.info(f"Max file size: {MAX_FILE_SIZE} bytes")
-
-        if file_size > MAX_FILE_SIZE:
-            logger.error(f"File size {file_size} bytes exceeds the maximum limit of {MAX_FILE_SIZE} bytes")
-            await update.message.reply_text("⚠️ File exceeds 20MB limit. Please send a smaller file.")
+        filename, file_size, file_id, file_unique_id = details
+
+        # Kept for /get whether or not the file can be uploaded
+        if 'relay' in context.bot_data:
+            await asyncio.to_thread(context.bot_data['relay'].remember, update.effective_chat.id, file_unique_id,
+                                    file_id, file_kind(update.message), filename, file_size)
+
+        logger.info("File %s, %d bytes", filename, file_size, extra={'event': 'file'})
+        max_file_size = context.bot_data['file_source'].max_file_size
+
+        if file_size > max_file_size:
+            logger.error("File size %d bytes exceeds the maximum limit of %d bytes", file_size, max_file_size,
+                         extra={'event': 'too_large'})
+            ERRORS.labels('FileTooLarge').inc()
+            await update.message.reply_text(
+                f"⚠️ File exceeds {max_file_size // MB}MB limit. Please send a smaller file.\n"
+                f"{share_line(file_unique_id)}".rstrip()
+            )
             return
 
-        # Store the file_id for later use
-        context.user_data['file_id'] = file_id
-
-        # Use the file_id to get the file path
-        file_obj = await context.bot.get_file(file_id)
-        logger.info(f"File path: {file_obj.file_path}")
-
-        streamer = TelegramFileStreamer(file_obj.file_path)
-
-        files = {'file': (filename, streamer)}
-        response = requests.post(API_UPLOAD_URL, files=files)
-
-        logger.info(f"API Response: {response.status_code} - {response.text}")
-
-        if response.status_code == 200:
-            result = response.json()
-            if "debug_info" in result and "hash" in result["debug_info"]:
-                file_hash = result["debug_info"]["hash"]
-                download_url = f"https://files.vc/d/dl?hash={file_hash}"
-                await update.message.reply_text(
-                    f"✅ Upload successful!\n"
-                    f"🔗 Download link: {download_url}"
-                )
-            else:
-                await update.message.reply_text(f"❌ API Error: {result.get('message', 'Unknown error')}")
-        else:
-            await update.message.reply_text(f"❌ API Error: {response.text}")
-
-    except Exception as e:
-        logger.error(f"Error: {str(e)}")
-        await update.message.reply_text(f"⚠️ Error: {str(e)}")
-
-if __name__ == "__main__":
-    if not TELEGRAM_TOKEN:
-        logger.error("Missing TELEGRAM_TOKEN!")
-        exit(1)
-
-    app = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(MessageHandler(filters.Document.ALL | filters.VIDEO | filters.PHOTO, handle_file))
-
-    # Keep the bot running
-    app.run_polling(poll_interval=1.0)
-        self.response.close()
-
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    logger.info("Start command received")
-    await update.message.reply_text(
-        "📤 Send me any file to get a download link!\n"
-        "Note: This bot can only handle files up to 20MB due to Telegram Bot API limitations.\n"
-        "Created by @Imebrahim"
-    )
-
-async def handle_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    try:
-        if update.message.document:
-            file = update.message.document
-            filename = file.file_name
-            file_size = file.file_size
-            file_id = file.file_id
-        elif update.message.video:
-            file = update.message.video
-            filename = f"{file.file_name}.mp4"
-            file_size = file.file_size
-            file_id = file.file_id
-        elif update.message.photo:
-            file = update.message.photo[-1]
-            filename = f"{update.message.caption or 'photo'}.jpg"
-            file_size = file.file_size
-            file_id = file.file_id
-        else:
-            await update.message.reply_text("❌ Unsupported file type. Please send a document, video, or photo.")
+        retry_after = context.bot_data['rate_limiter'].admit(update.effective_user.id)
+        if retry_after:
+            logger.warning("Rate limited user %s", update.effective_user.id, extra={'event': 'rate_limited'})
+            ERRORS.labels('RateLimited').inc()
+            await update.message.reply_text(f"🚦 You're sending files too fast. Try again in {int(retry_after) + 1}s.")
             return
 
-        logger.info(f"File name: {filename}")
-        logger.info(f"File size: {file_size} bytes")
-        logger.info(f"Max file size: {MAX_FILE_SIZE} bytes")
+        # After /zip, files are only collected until the archive is uploaded
+        if 'zip' in context.user_data:
+            files = context.user_data['zip']
+            if len(files) >= ZIP_MAX_FILES:
+                await update.message.reply_text(f"⚠️ An archive holds up to {ZIP_MAX_FILES} files. Send /zip to upload it.")
+                return
+            files.append(details)
+            if not update.message.media_group_id:
+                await update.message.reply_text(f"📦 Added to the archive ({len(files)}/{ZIP_MAX_FILES}). Send /zip when done.")
+            return
 
-        if file_size > MAX_FILE_SIZE:
-            logger.error(f"File size {file_size} bytes exceeds the maximum limit of {MAX_FILE_SIZE} bytes")
-            await update.message.reply_text("⚠️ File exceeds 20MB limit. Please send a smaller file.")
+        # Albums arrive one update per file; they are uploaded and answered together
+        if update.message.media_group_id:
+            context.bot_data['media_groups'].add(update.message.media_group_id, (update, context, details))
             return
 
         # Store the file_id for later use
         context.user_data['file_id'] = file_id
 
-        # Use the file_id to get the file path
-        file_obj = await context.bot.get_file(file_id)
-        logger.info(f"File path: {file_obj.file_path}")
-
-        streamer = TelegramFileStreamer(file_obj.file_path)
-
-        files = {'file': (filename, streamer)}
-        response = requests.post(API_UPLOAD_URL, files=files)
+        # Files that were already uploaded are answered without moving any bytes
+        cache = context.bot_data['upload_cache']
+        cached = await asyncio.to_thread(cache.get, f"uid:{file_unique_id}")
+        if cached:
+            logger.info("Cache hit for %s", file_unique_id, extra={'event': 'cache_hit'})
+            remember(update, context, filename, file_size, file_unique_id, "cache", cached['file_hash'],
+                     cached['download_url'])
+            await update.message.reply_text(
+                f"✅ Upload successful!\n"
+                f"{share_line(file_unique_id)}"
+                f"🔗 Download link: {cached['download_url']}"
+            )
+            return
 
-        logger.info(f"API Response: {response.status_code} - {response.text}")
-
-        if response.status_code == 200:
-            result = response.json()
-            if "debug_info" in result and "hash" in result["debug_info"]:
-                file_hash = result["debug_info"]["hash"]
-                download_url = f"https://files.vc/d/dl?hash={file_hash}"
-                await update.message.reply_text(
-                    f"✅ Upload successful!\n"
-                    f"🔗 Download link: {download_url}"
-                )
-            else:
-                await update.message.reply_text(f"❌ API Error: {result.get('message', 'Unknown error')}")
-        else:
-            await update.message.reply_text(f"❌ API Error: {response.text}")
+        await submit(update, context, [details], checks=start_preflight(update, context, details))
 
     except Exception as e:
         logger.error(f"Error: {str(e)}")
+        ERRORS.labels(type(e).__name__).inc()
         await update.message.reply_text(f"⚠️ Error: {str(e)}")
 
-if __name__ == "__main__":
-    if not TELEGRAM_TOKEN:
-        logger.error("Missing TELEGRAM_TOKEN!")
-        exit(1)
-
-    app = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(MessageHandler(filters.Document.ALL | filters.VIDEO | filters.PHOTO, handle_file))
-
-    # Keep the bot running
-    app.run_polling(poll_interval=1.0)
-        self.response.close()
-
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    logger.info("Start command received")
-    await update.message.reply_text(
-        "📤 Send me any file to get a download link!\n"
-        "Note: This bot can only handle files up to 20MB due to Telegram Bot API limitations.\n"
-        "Created by @Imebrahim"
-    )
+def start_preflight(update: Update, context: ContextTypes.DEFAULT_TYPE, details):
+    """Run the pre-flight checks of a file in the background while it waits in the queue,
+    answering right away if it is rejected. The task's result is the preflight.Checked,
+    or None once rejected. Returns None when there are no checks to run here."""
+    preflight = context.bot_data.get('preflight')
+    if preflight is None or 'job_queue' in context.bot_data:
+        # Worker processes run the checks themselves when they take the job
+        return None
 
-async def handle_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    async def check():
+        try:
+            return await preflight.check(context.bot, *details)
+        except Rejected as e:
+            await update.message.reply_text(f"🚫 {e}")
+            return None
+
+    return asyncio.ensure_future(check())
+
+async def submit(update: Update, context: ContextTypes.DEFAULT_TYPE, files, album=False, archive=False, checks=None):
+    """Queue the transfer of `files`, one tuple of file_details() each, for this process's
+    workers or, with JOB_QUEUE_DB set, for the worker processes (see worker.py).
+    With `archive`, they are uploaded as one zip. `checks` is the pre-flight task
+    of a single file, see start_preflight()."""
+    job_queue = context.bot_data.get('job_queue')
+    job = {
+        'chat_id': update.effective_chat.id, 'chat_type': update.effective_chat.type,
+        'user_id': update.effective_user.id, 'message_id': update.message.message_id,
+        'files': files, 'album': album, 'archive': archive, 'transfer_id': transfer_id.get() or new_transfer_id(),
+        'shard': context.bot_data.get('shard', 0),
+    }
     try:
-        if update.message.document:
-            file = update.message.document
-            filename = file.file_name
-            file_size = file.file_size
-            file_id = file.file_id
-        elif update.message.video:
-            file = update.message.video
-            filename = f"{file.file_name}.mp4"
-            file_size = file.file_size
-            file_id = file.file_id
-        elif update.message.photo:
-            file = update.message.photo[-1]
-            filename = f"{update.message.caption or 'photo'}.jpg"
-            file_size = file.file_size
-            file_id = file.file_id
+        if job_queue:
+            position = await asyncio.to_thread(job_queue.put, job)
         else:
-            await update.message.reply_text("❌ Unsupported file type. Please send a document, video, or photo.")
-            return
-
-        logger.info(f"File name: {filename}")
-        logger.info(f"File size: {file_size} bytes")
-        logger.info(f"Max file size: {MAX_FILE_SIZE} bytes")
-
-        if file_size > MAX_FILE_SIZE:
-            logger.error(f"File size {file_size} bytes exceeds the maximum limit of {MAX_FILE_SIZE} bytes")
-            await update.message.reply_text("⚠️ File exceeds 20MB limit. Please send a smaller file.")
-            return
-
-        # Store the file_id for later use
-        context.user_data['file_id'] = file_id
-
-        # Use the file_id to get the file path
-        file_obj = await context.bot.get_file(file_id)
-        logger.info(f"File path: {file_obj.file_path}")
-
-        streamer = TelegramFileStreamer(file_obj.file_path)
-
-        files = {'file': (filename, streamer)}
-        response = requests.post(API_UPLOAD_URL, files=files)
-
-        logger.info(f"API Response: {response.status_code} - {response.text}")
-
-        if response.status_code == 200:
-            result = response.json()
-            if "debug_info" in result and "hash" in result["debug_info"]:
-                file_hash = result["debug_info"]["hash"]
-                download_url = f"https://files.vc/d/dl?hash={file_hash}"
-                await update.message.reply_text(
-                    f"✅ Upload successful!\n"
-                    f"🔗 Download link: {download_url}"
-                )
-            else:
-                await update.message.reply_text(f"❌ API Error: {result.get('message', 'Unknown error')}")
-        else:
-            await update.message.reply_text(f"❌ API Error: {response.text}")
-
+            position = context.bot_data['scheduler'].submit(
+                update.effective_user.id,
+                lambda: run_job(update, context, files, album, archive, checks, job['transfer_id']), job
+            )
+    except QueueFull:
+        if checks:
+            checks.cancel()
+        logger.warning(f"Queue full, rejected {len(files)} files from user {update.effective_user.id}")
+        ERRORS.labels('QueueFull').inc()
+        await update.message.reply_text("🚦 Too many files in the queue right now. Please try again in a few minutes.")
+        return
+
+    if position:
+        await update.message.reply_text(f"⏳ You're #{position} in queue.")
+
+async def submit_album(items):
+    update, context, _ = items[0]
+    files = [details for _, _, details in items]
+    context.user_data['file_ids'] = [file_id for _, _, file_id, _ in files]
+    try:
+        await submit(update, context, files, album=True)
     except Exception as e:
         logger.error(f"Error: {str(e)}")
         await update.message.reply_text(f"⚠️ Error: {str(e)}")
 
-if __name__ == "__main__":
-    if not TELEGRAM_TOKEN:
-        logger.error("Missing TELEGRAM_TOKEN!")
-        exit(1)
-
-    app = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(MessageHandler(filters.Document.ALL | filters.VIDEO | filters.PHOTO, handle_file))
-
-    # Keep the bot running
-    app.run_polling(poll_interval=1.0)
-        self.response.close()
-
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    logger.info("Start command received")
-    await update.message.reply_text(
-        "📤 Send me any file to get a download link!\n"
-        "Note: This bot can only handle files up to 20MB due to Telegram Bot API limitations.\n"
-        "Created by @Imebrahim"
-    )
-
-async def handle_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def run_job(update: Update, context: ContextTypes.DEFAULT_TYPE, files, album, archive=False, checks=None,
+                  transfer=None):
+    """Run a queued job; `transfer` is the transfer id it was queued with, for its log lines."""
+    transfer_id.set(transfer or new_transfer_id())
     try:
-        if update.message.document:
-            file = update.message.document
-            filename = file.file_name
-            file_size = file.file_size
-            file_id = file.file_id
-        elif update.message.video:
-            file = update.message.video
-            filename = f"{file.file_name}.mp4"
-            file_size = file.file_size
-            file_id = file.file_id
-        elif update.message.photo:
-            file = update.message.photo[-1]
-            filename = f"{update.message.caption or 'photo'}.jpg"
-            file_size = file.file_size
-            file_id = file.file_id
+        if archive:
+            await upload_archive(update, context, files)
+        elif album:
+            await upload_album(update, context, files)
         else:
-            await update.message.reply_text("❌ Unsupported file type. Please send a document, video, or photo.")
-            return
-
-        logger.info(f"File name: {filename}")
-        logger.info(f"File size: {file_size} bytes")
-        logger.info(f"Max file size: {MAX_FILE_SIZE} bytes")
-
-        if file_size > MAX_FILE_SIZE:
-            logger.error(f"File size {file_size} bytes exceeds the maximum limit of {MAX_FILE_SIZE} bytes")
-            await update.message.reply_text("⚠️ File exceeds 20MB limit. Please send a smaller file.")
-            return
-
-        # Store the file_id for later use
-        context.user_data['file_id'] = file_id
-
-        # Use the file_id to get the file path
-        file_obj = await context.bot.get_file(file_id)
-        logger.info(f"File path: {file_obj.file_path}")
-
-        streamer = TelegramFileStreamer(file_obj.file_path)
-
-        files = {'file': (filename, streamer)}
-        response = requests.post(API_UPLOAD_URL, files=files)
-
-        logger.info(f"API Response: {response.status_code} - {response.text}")
-
-        if response.status_code == 200:
-            result = response.json()
-            if "debug_info" in result and "hash" in result["debug_info"]:
-                file_hash = result["debug_info"]["hash"]
-                download_url = f"https://files.vc/d/dl?hash={file_hash}"
-                await update.message.reply_text(
-                    f"✅ Upload successful!\n"
-                    f"🔗 Download link: {download_url}"
-                )
-            else:
-                await update.message.reply_text(f"❌ API Error: {result.get('message', 'Unknown error')}")
-        else:
-            await update.message.reply_text(f"❌ API Error: {response.text}")
+            await upload_file(update, context, *files[0], checks=checks)
+    except asyncio.CancelledError:
+        # Shutting down; the job was kept and runs again once the bot is back
+        try:
+            await update.message.reply_text("⏳ The bot is restarting, your upload will continue shortly.")
+        except Exception as e:
+            logger.warning(f"Could not tell the user about the restart: {e}")
+        raise
+
+def remember(update: Update, context: ContextTypes.DEFAULT_TYPE, filename, file_size, file_unique_id, backend,
+             file_hash, download_url):
+    context.bot_data['upload_history'].record(
+        update.effective_user.id, file_unique_id, filename, file_size, backend, file_hash, download_url
+    )
 
+async def transfer_file(context: ContextTypes.DEFAULT_TYPE, file_id, file_unique_id, filename, file_size, progress=None,
+                        throttle=None, file_path=None):
+    # Use the file_id to get the file path, unless the pre-flight checks did
+    if file_path is None:
+        with STAGE_SECONDS.labels('get_file').time():
+            file_path = (await context.bot.get_file(file_id)).file_path
+    logger.info("File path: %s", file_path, extra={'event': 'file_path'})
+
+    source = context.bot_data['file_source']
+    router = context.bot_data['upload_router']
+    cache = context.bot_data['upload_cache']
+    cache_keys = [f"uid:{file_unique_id}"]
+    spool = None
+    # Files a local Bot API server left on this machine are on disk already
+    if SPOOL_TRANSFERS and file_size >= SPOOL_MIN_SIZE and not os.path.isfile(file_path):
+        with STAGE_SECONDS.labels('spool').time():
+            spool = source = await Spool.download(source, file_path, SPOOL_DIR)
+    codec = context.bot_data['codec']
+    if codec and file_size >= COMPRESSION_MIN_SIZE and not compressed_type(filename):
+        source = CompressingSource(source, codec, COMPRESSION_MAX_RATIO)
+    try:
+        if spool:
+            # The same content under another file_unique_id, e.g. sent again as a new upload
+            content_hash = spool.sha256.hexdigest()
+            cached = await asyncio.to_thread(cache.get, f"sha256:{content_hash}")
+            if cached:
+                logger.info("Cache hit for content %s", content_hash, extra={'event': 'cache_hit'})
+                await asyncio.to_thread(cache.put, cache_keys, cached['file_hash'], cached['download_url'], file_size)
+                return UploadResult("cache", cached['file_hash'], cached['download_url'], content_hash)
+            cache_keys.append(f"sha256:{content_hash}")
+        result = await router.upload(source, file_path, filename, file_size, file_unique_id, progress, throttle)
+    finally:
+        if spool:
+            spool.close()
+    logger.info("Uploaded %s to %s", filename, result.backend, extra={'event': 'uploaded'})
+
+    await asyncio.to_thread(cache.put, cache_keys, result.file_hash, result.download_url, file_size)
+    return result
+
+async def upload_file(update: Update, context: ContextTypes.DEFAULT_TYPE, filename, file_size, file_id, file_unique_id,
+                      checks=None):
+    progress = None
+    reply = update.message.reply_text
+    file_path = None
+    IN_FLIGHT.inc()
+    try:
+        if checks:
+            checked = await checks
+            if checked is None:
+                # Rejected, and the user was told while the file waited
+                return
+            filename, file_path = checked.filename, checked.file_path
+        elif 'preflight' in context.bot_data:
+            checked = await context.bot_data['preflight'].check(context.bot, filename, file_size, file_id,
+                                                                file_unique_id)
+            filename, file_path = checked.filename, checked.file_path
+
+        if file_size >= PROGRESS_MIN_SIZE:
+            # The progress message is edited in place and finally replaced by the result
+            progress_message = await update.message.reply_text("⏳ Uploading... 0%")
+            reply = progress_message.edit_text
+
+            async def show_progress(done, total):
+                with progress_lane():
+                    await progress_message.edit_text(f"⏳ Uploading... {done * 100 // (total or file_size)}%")
+
+            progress = ProgressReporter(show_progress, interval=PROGRESS_INTERVAL, overlap=True)
+
+        throttle = context.bot_data['rate_limiter'].shaper(update.effective_user.id)
+        result = await transfer_file(context, file_id, file_unique_id, filename, file_size, progress, throttle,
+                                     file_path)
+        remember(update, context, filename + result.suffix, file_size, file_unique_id, result.backend,
+                 result.file_hash, result.download_url)
+        if progress:
+            await progress.close()
+        compressed = f"🗜 Compressed to {filename}{result.suffix}\n" if result.suffix else ""
+        with STAGE_SECONDS.labels('reply').time():
+            await reply(
+                f"✅ Upload successful!\n"
+                f"{compressed}"
+                f"{share_line(file_unique_id)}"
+                f"🔗 Download link: {result.download_url}"
+            )
+
+    except Rejected as e:
+        await reply(f"🚫 {e}")
+    except UploadError as e:
+        logger.error(f"API Error: {str(e)}")
+        ERRORS.labels(type(e).__name__).inc()
+        if progress:
+            await progress.close()
+        await reply(f"❌ API Error: {str(e)}")
     except Exception as e:
         logger.error(f"Error: {str(e)}")
-        await update.message.reply_text(f"⚠️ Error: {str(e)}")
-
-if __name__ == "__main__":
-    if not TELEGRAM_TOKEN:
-        logger.error("Missing TELEGRAM_TOKEN!")
-        exit(1)
-
-    app = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(MessageHandler(filters.Document.ALL | filters.VIDEO | filters.PHOTO, handle_file))
-
-    # Keep the bot running
-    app.run_polling(poll_interval=1.0)
-        "Note: This bot can only handle files up to 20MB due to Telegram Bot API limitations.\n"
-        "Created by @Imebrahim"
-    )
-
-async def handle_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        ERRORS.labels(type(e).__name__).inc()
+        if progress:
+            await progress.close()
+        await reply(f"⚠️ Error: {str(e)}")
+    finally:
+        IN_FLIGHT.dec()
+
+async def upload_album(update: Update, context: ContextTypes.DEFAULT_TYPE, files):
+    """Upload an album's files side by side and answer with one message listing every link."""
+    reply = update.message.reply_text
+    if sum(file_size for _, file_size, _, _ in files) >= PROGRESS_MIN_SIZE:
+        progress_message = await update.message.reply_text(f"⏳ Uploading {len(files)} files...")
+        reply = progress_message.edit_text
+    cache = context.bot_data['upload_cache']
+    preflight = context.bot_data.get('preflight')
+    throttle = context.bot_data['rate_limiter'].shaper(update.effective_user.id)
+    slots = asyncio.Semaphore(ALBUM_PARALLEL)
+
+    async def upload_one(filename, file_size, file_id, file_unique_id):
+        async with slots:
+            IN_FLIGHT.inc()
+            try:
+                cached = await asyncio.to_thread(cache.get, f"uid:{file_unique_id}")
+                if cached:
+                    remember(update, context, filename, file_size, file_unique_id, "cache", cached['file_hash'],
+                             cached['download_url'])
+                    return True, f"🔗 {filename}: {cached['download_url']}"
+                file_path = None
+                if preflight:
+                    checked = await preflight.check(context.bot, filename, file_size, file_id, file_unique_id)
+                    filename, file_path = checked.filename, checked.file_path
+                result = await transfer_file(context, file_id, file_unique_id, filename, file_size, throttle=throttle,
+                                             file_path=file_path)
+                filename += result.suffix
+                remember(update, context, filename, file_size, file_unique_id, result.backend, result.file_hash,
+                         result.download_url)
+                return True, f"🔗 {filename}: {result.download_url}"
+            except Rejected as e:
+                return False, f"🚫 {filename}: {e}"
+            except Exception as e:
+                logger.error(f"Error uploading {filename}: {str(e)}")
+                ERRORS.labels(type(e).__name__).inc()
+                return False, f"❌ {filename}: {str(e)}"
+            finally:
+                IN_FLIGHT.dec()
+
+    results = await asyncio.gather(*(upload_one(*details) for details in files))
+    uploaded = sum(1 for ok, _ in results if ok)
+    header = "✅ Upload successful!" if uploaded == len(files) else f"⚠️ Uploaded {uploaded} of {len(files)} files."
+    with STAGE_SECONDS.labels('reply').time():
+        await reply("\n".join([header, *(line for _, line in results)]))
+
+async def upload_archive(update: Update, context: ContextTypes.DEFAULT_TYPE, files):
+    """Upload files as one zip, built while they are downloaded, and answer with its link."""
+    progress = None
+    reply = update.message.reply_text
+    skipped = []
+    IN_FLIGHT.inc()
     try:
-        if update.message.document:
-            file = update.message.document
-            filename = file.file_name
-            file_size = file.file_size
-            file_id = file.file_id
-        elif update.message.video:
-            file = update.message.video
-            filename = f"{file.file_name}.mp4"
-            file_size = file.file_size
-            file_id = file.file_id
-        elif update.message.photo:
-            file = update.message.photo[-1]
-            filename = f"{update.message.caption or 'photo'}.jpg"
-            file_size = file.file_size
-            file_id = file.file_id
+        preflight = context.bot_data.get('preflight')
+        if preflight:
+            # Files that cannot be uploaded are left out rather than failing the whole archive
+            results = await asyncio.gather(*(preflight.check(context.bot, *details) for details in files),
+                                           return_exceptions=True)
+            for result in results:
+                if isinstance(result, Exception) and not isinstance(result, Rejected):
+                    raise result
+            skipped = [f"🚫 {details[0]}: {result}" for details, result in zip(files, results)
+                       if isinstance(result, Rejected)]
+            if len(skipped) == len(files):
+                raise results[0]
+            checked = [(details, result) for details, result in zip(files, results) if not isinstance(result, Rejected)]
+            files = [details for details, _ in checked]
+            entries = [(result.filename, result.file_path) for _, result in checked]
         else:
-            await update.message.reply_text("❌ Unsupported file type. Please send a document, video, or photo.")
-            return
-
-        logger.info(f"File name: {filename}")
-        logger.info(f"File size: {file_size} bytes")
-        logger.info(f"Max file size: {MAX_FILE_SIZE} bytes")
-
-        if file_size > MAX_FILE_SIZE:
-            logger.error(f"File size {file_size} bytes exceeds the maximum limit of {MAX_FILE_SIZE} bytes")
-            await update.message.reply_text("⚠️ File exceeds 20MB limit. Please send a smaller file.")
-            return
-
-        # Store the file_id for later use
-        context.user_data['file_id'] = file_id
-
-        # Use the file_id to get the file path
-        file_obj = await context.bot.get_file(file_id)
-        logger.info(f"File path: {file_obj.file_path}")
-
-        streamer = TelegramFileStreamer(file_obj.file_path)
-
-        files = {'file': (filename, streamer)}
-        response = requests.post(API_UPLOAD_URL, files=files)
-
-        logger.info(f"API Response: {response.status_code} - {response.text}")
-
-        if response.status_code == 200:
-            result = response.json()
-            if "debug_info" in result and "hash" in result["debug_info"]:
-                file_hash = result["debug_info"]["hash"]
-                download_url = f"https://files.vc/d/dl?hash={file_hash}"
-                await update.message.reply_text(
-                    f"✅ Upload successful!\n"
-                    f"🔗 Download link: {download_url}"
-                )
-            else:
-                await update.message.reply_text(f"❌ API Error: {result.get('message', 'Unknown error')}")
-        else:
-            await update.message.reply_text(f"❌ API Error: {response.text}")
-
+            with STAGE_SECONDS.labels('get_file').time():
+                file_objs = await asyncio.gather(*(context.bot.get_file(file_id) for _, _, file_id, _ in files))
+            entries = [(filename, file_obj.file_path) for (filename, _, _, _), file_obj in zip(files, file_objs)]
+        total_size = sum(file_size for _, file_size, _, _ in files)
+        name = f"{len(files)} files.zip"
+
+        if total_size >= PROGRESS_MIN_SIZE:
+            progress_message = await update.message.reply_text(f"⏳ Archiving {len(files)} files... 0%")
+            reply = progress_message.edit_text
+
+            async def show_progress(done, total):
+                with progress_lane():
+                    await progress_message.edit_text(f"⏳ Archiving {len(files)} files... {done * 100 // total}%")
+
+            progress = ProgressReporter(show_progress, interval=PROGRESS_INTERVAL, overlap=True)
+
+        source = ArchiveSource(context.bot_data['file_source'], entries, [f[1] for f in files], ZIP_LEVEL,
+                               COMPRESSION_MAX_RATIO)
+        throttle = context.bot_data['rate_limiter'].shaper(update.effective_user.id)
+        result = await context.bot_data['upload_router'].upload(source, None, name, total_size, None, progress,
+                                                                throttle)
+        logger.info("Uploaded %s to %s", name, result.backend, extra={'event': 'uploaded'})
+        remember(update, context, name, total_size, f"zip:{result.file_hash}", result.backend, result.file_hash,
+                 result.download_url)
+        if progress:
+            await progress.close()
+        with STAGE_SECONDS.labels('reply').time():
+            await reply("\n".join([
+                "✅ Upload successful!",
+                f"📦 {name}",
+                *skipped,
+                f"🔗 Download link: {result.download_url}",
+            ]))
+
+    except Rejected as e:
+        await reply(f"🚫 {e}")
+    except UploadError as e:
+        logger.error(f"API Error: {str(e)}")
+        ERRORS.labels(type(e).__name__).inc()
+        if progress:
+            await progress.close()
+        await reply(f"❌ API Error: {str(e)}")
     except Exception as e:
         logger.error(f"Error: {str(e)}")
-        await update.message.reply_text(f"⚠️ Error: {str(e)}")
+        ERRORS.labels(type(e).__name__).inc()
+        if progress:
+            await progress.close()
+        await reply(f"⚠️ Error: {str(e)}")
+    finally:
+        IN_FLIGHT.dec()
+
+def sharded(callback, shards: ShardRouter, shard: int):
+    """Handle only the updates `shards` gives to bot number `shard`."""
+    async def handle(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        # Only the bot named in /command@bot gets to see it as a command, so it is not for sharing out
+        text = update.effective_message.text if update.effective_message else None
+        command = text.split(maxsplit=1)[0].lower() if text and text.startswith('/') else ''
+        addressed = bool(context.bot.username) and command.endswith(f"@{context.bot.username.lower()}")
+        if await shards.take(shard, update, addressed):
+            await callback(update, context)
+    return handle
+
+def bot_api_request(shards=None, shard=0) -> BotApiDispatcher:
+    """Where a bot's Bot API calls but getUpdates go through; with `shards`, those of bot number `shard`."""
+    rate = BOT_API_RATE / (WORKER_PROCESSES + 1) if JOB_QUEUE_DB else BOT_API_RATE
+    budgets = (rate, BOT_API_CHAT_RATE, BOT_API_GROUP_PER_MINUTE / 60, BOT_API_CHAT_BURST, BOT_API_MAX_FLOOD_WAIT)
+    # Every client would otherwise load the CA bundle again, slowing startup
+    kwargs = {'connection_pool_size': BOT_API_CONNECTIONS, 'httpx_kwargs': {'verify': ssl_context()}}
+    if shards:
+        return ShardRequest(shards, shard, *budgets, **kwargs)
+    return BotApiDispatcher(*budgets, **kwargs)
+
+def build_application(token, base_url=BOT_API_URL, base_file_url=BOT_API_FILE_URL, local_mode=BOT_API_LOCAL,
+                      shards=None, shard=0):
+    """The bot for `token`; with `shards`, bot number `shard` of several (see run_shards)."""
+    builder = (
+        ApplicationBuilder()
+        .token(token)
+        # Transfers are awaited, so updates can be handled concurrently
+        .concurrent_updates(True)
+        .request(bot_api_request(shards, shard))
+        .get_updates_request(HTTPXRequest(connection_pool_size=1, httpx_kwargs={'verify': ssl_context()}))
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+    )
+    if base_url:
+        builder = builder.base_url(base_url).base_file_url(base_file_url or base_url).local_mode(local_mode)
+    app = builder.build()
+    app.add_handler(CommandHandler("start", start))
+    app.add_handler(CommandHandler("status", status))
+    app.add_handler(CommandHandler("myfiles", myfiles))
+    app.add_handler(CommandHandler("search", search))
+    app.add_handler(CommandHandler("limits", limits))
+    app.add_handler(CommandHandler("zip", zip_files))
+    app.add_handler(CommandHandler("get", get_shared))
+    app.add_handler(MessageHandler(filters.Document.ALL | filters.VIDEO | filters.PHOTO, handle_file))
+    if shards:
+        for handler in app.handlers[0]:
+            handler.callback = sharded(handler.callback, shards, shard)
+    return app
+
+async def run_shards(tokens):
+    """Run a bot for each token in this process until SIGTERM or SIGINT. They share
+    the services and the transfer workers; share codes, being file_ids, are kept
+    per bot, in RELAY_DB with the bot's number added for all but the first."""
+    shards = ShardRouter(len(tokens), SHARD_HANDOFF)
+    apps = [build_application(token, shards=shards, shard=shard) for shard, token in enumerate(tokens)]
+    stopping = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        asyncio.get_running_loop().add_signal_handler(sig, stopping.set)
+
+    first = apps[0]
+    for app in apps:
+        await app.initialize()
+    await start_services(first)
+    for shard, app in enumerate(apps):
+        if shard:
+            app.bot_data.update(first.bot_data)
+            if RELAY_CACHE:
+                root, extension = os.path.splitext(RELAY_DB)
+                app.bot_data['relay'] = RelayCache(f"{root}.{shard}{extension}", RELAY_MAX_ENTRIES,
+                                                   RELAY_MEMORY_ENTRIES, HISTORY_PAGE_SIZE)
+        app.bot_data['shard'] = shard
+    if not JOB_QUEUE_DB:
+        await resume_pending(apps)
+    try:
+        for app in apps:
+            await app.updater.start_polling(poll_interval=POLL_INTERVAL, timeout=POLL_TIMEOUT)
+            await app.start()
+        logger.info(f"Running {len(apps)} bots")
+        await stopping.wait()
+    finally:
+        for app in apps:
+            if app.updater.running:
+                await app.updater.stop()
+        for app in apps:
+            if app.running:
+                await app.stop()
+        await post_stop(first)
+        for app in apps:
+            await app.shutdown()
+            if app is not first and 'relay' in app.bot_data:
+                app.bot_data['relay'].close()
+        await post_shutdown(first)
 
 if __name__ == "__main__":
-    if not TELEGRAM_TOKEN:
+    if not TELEGRAM_TOKEN and not TELEGRAM_TOKENS:
         logger.error("Missing TELEGRAM_TOKEN!")
         exit(1)
 
-    app = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(MessageHandler(filters.Document.ALL | filters.VIDEO | filters.PHOTO, handle_file))
+    if TELEGRAM_TOKENS:
+        if BOT_MODE == "webhook":
+            logger.error("TELEGRAM_TOKENS needs BOT_MODE=polling!")
+            exit(1)
+        asyncio.run(run_shards(TELEGRAM_TOKENS))
+        exit(0)
+
+    app = build_application(TELEGRAM_TOKEN)
 
     # Keep the bot running
-    app.run_polling(poll_interval=1.0)
+    if BOT_MODE == "webhook":
+        if not WEBHOOK_URL:
+            logger.error("Missing WEBHOOK_URL!")
+            exit(1)
+        if not WEBHOOK_SECRET:
+            logger.error("Missing WEBHOOK_SECRET!")
+            exit(1)
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+        )
+    else:
+        app.run_polling(poll_interval=POLL_INTERVAL, timeout=POLL_TIMEOUT)
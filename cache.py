@@ -0,0 +1,85 @@
+import time
+import sqlite3
+import logging
+import threading
+from metrics import CACHE_LOOKUPS, CACHE_SAVED_BYTES
+
+logger = logging.getLogger(__name__)
+
+
+class UploadCache:
+    """Remembers where a file was already uploaded so it is never transferred twice.
+
+    Entries are keyed by Telegram's file_unique_id ("uid:...") and, for
+    transfers spooled to disk, where the hash is known before the upload, by
+    the sha256 of the content ("sha256:..."). The table is bounded: entries
+    older than `ttl` seconds are ignored and the least recently used ones are
+    evicted once there are more than `max_entries` (checked every 1% of that
+    in writes).
+    """
+
+    def __init__(self, path: str, max_entries=100_000, ttl=30 * 24 * 3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.writes = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS uploads ("
+            " key TEXT PRIMARY KEY, file_hash TEXT NOT NULL, download_url TEXT NOT NULL,"
+            " size INTEGER NOT NULL, created REAL NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS uploads_last_used ON uploads (last_used)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS uploads_created ON uploads (created)")
+        self.db.commit()
+
+    def get(self, key: str):
+        now = time.time()
+        with self.lock:
+            row = self.db.execute(
+                "SELECT file_hash, download_url, size FROM uploads WHERE key = ? AND created > ?",
+                (key, now - self.ttl),
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                CACHE_LOOKUPS.labels('miss').inc()
+                return None
+            self.db.execute("UPDATE uploads SET last_used = ? WHERE key = ?", (now, key))
+            self.db.commit()
+            self.hits += 1
+            self.bytes_saved += row[2]
+            CACHE_LOOKUPS.labels('hit').inc()
+            CACHE_SAVED_BYTES.inc(row[2])
+        return {'file_hash': row[0], 'download_url': row[1], 'size': row[2]}
+
+    def put(self, keys, file_hash: str, download_url: str, size: int):
+        now = time.time()
+        with self.lock:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO uploads VALUES (?, ?, ?, ?, ?, ?)",
+                [(key, file_hash, download_url, size, now, now) for key in keys],
+            )
+            # Eviction walks the whole index, so it runs every 1% of the table's
+            # size in writes, which it may overshoot by as much; get() ignores
+            # expired entries meanwhile
+            self.writes += 1
+            if self.writes % max(1, self.max_entries // 100) == 0:
+                self.db.execute("DELETE FROM uploads WHERE created <= ?", (now - self.ttl,))
+                self.db.execute(
+                    "DELETE FROM uploads WHERE key IN ("
+                    " SELECT key FROM uploads ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,),
+                )
+            self.db.commit()
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'bytes_saved': self.bytes_saved}
+
+    def close(self):
+        logger.info(f"Upload cache: {self.stats()}")
+        with self.lock:
+            self.db.close()
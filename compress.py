@@ -0,0 +1,318 @@
+import time
+import zlib
+import asyncio
+import logging
+import zipfile
+import mimetypes
+from metrics import STAGE_SECONDS
+from transfer import FileStreamer
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+# Formats that are compressed already and not worth another pass, by MIME type prefix
+COMPRESSED_TYPES = (
+    'image/jpeg', 'image/png', 'image/gif', 'image/webp', 'image/heic', 'video/', 'audio/', 'font/woff',
+    'application/zip', 'application/gzip', 'application/x-gzip', 'application/x-bzip2', 'application/x-xz',
+    'application/x-7z-compressed', 'application/x-rar', 'application/vnd.rar', 'application/zstd',
+    'application/java-archive', 'application/vnd.android.package-archive', 'application/epub+zip',
+    'application/vnd.openxmlformats-officedocument', 'application/vnd.oasis.opendocument', 'application/pdf',
+)
+
+# How much of the first chunk is test-compressed to decide on the rest
+PROBE_SIZE = 64 * 1024
+
+
+class Codec:
+    """A compression format for whole-file streams, with the suffix its files get."""
+
+    def __init__(self, name: str, suffix: str, new_compressor, level: int):
+        self.name = name
+        self.suffix = suffix
+        self.new_compressor = new_compressor
+        self.level = level
+
+    def compressor(self):
+        """A fresh object with compress(data) and flush(), as zlib.compressobj() returns."""
+        return self.new_compressor(self.level)
+
+
+def gzip_compressor(level):
+    return zlib.compressobj(level, zlib.DEFLATED, 31)
+
+
+def zstd_compressor(level):
+    return zstandard.ZstdCompressor(level=level).compressobj()
+
+
+def get_codec(name: str, level=None):
+    """The Codec for a COMPRESSION setting, or None for "off".
+
+    "auto" is zstd when the zstandard package is installed and gzip otherwise.
+    Levels default to ones that keep up with a fast upload.
+    """
+    if name == "off":
+        return None
+    if name == "auto":
+        name = "zstd" if zstandard else "gzip"
+    if name == "gzip":
+        return Codec(name, ".gz", gzip_compressor, 3 if level is None else int(level))
+    if name == "zstd":
+        if zstandard is None:
+            raise ValueError("zstd compression needs the zstandard package")
+        return Codec(name, ".zst", zstd_compressor, 3 if level is None else int(level))
+    raise ValueError(f"Unknown compression {name!r}, expected off, auto, gzip or zstd")
+
+
+def compressed_type(filename: str) -> bool:
+    """Whether the name says the file is compressed already, e.g. a photo, video or archive."""
+    kind, encoding = mimetypes.guess_type(filename, strict=False)
+    return encoding is not None or (kind is not None and kind.startswith(COMPRESSED_TYPES))
+
+
+def probe(sample) -> float:
+    """Size of `sample` after a quick compression, relative to before; 1.0 for nothing."""
+    if not sample:
+        return 1.0
+    return len(zlib.compress(sample[:PROBE_SIZE], 1)) / len(sample[:PROBE_SIZE])
+
+
+class PipelinedStreamer(FileStreamer):
+    """A streamer whose read() runs in worker threads, started for the next
+    chunk while the current one is being sent so the two overlap."""
+
+    async def __aiter__(self):
+        pending = asyncio.ensure_future(self.read(self.chunk_size))
+        try:
+            while chunk := await pending:
+                pending = asyncio.ensure_future(self.read(self.chunk_size))
+                if self.throttle:
+                    await self.throttle(len(chunk))
+                yield chunk
+        finally:
+            pending.cancel()
+
+
+class CompressingStreamer(PipelinedStreamer):
+    """Compresses another streamer's content on the way, in a worker thread.
+
+    open() reads the first chunk and test-compresses it: content that does not
+    shrink to `max_ratio` of its size, already compressed or encrypted say, is
+    passed through as it is and `suffix` stays empty. The size of compressed
+    output is not known in advance, so total_size is then 0. The hash and the
+    progress are those of the original content, counted by the inner streamer.
+    """
+
+    def __init__(self, inner: FileStreamer, codec: Codec, max_ratio: float):
+        super().__init__()
+        self.inner = inner
+        self.codec = codec
+        self.max_ratio = max_ratio
+        self.sha256 = inner.sha256
+        self.compressor = None
+        self.compressing = False
+        self._first = b''
+
+    hash_chunks = False
+
+    async def open(self):
+        self.chunk_size = self.inner.chunk_size
+        self._first = await self.inner.read(self.chunk_size)
+        ratio = await asyncio.to_thread(probe, self._first)
+        if ratio <= self.max_ratio:
+            self.compressing = True
+            self.compressor = self.codec.compressor()
+            self.suffix = self.codec.suffix
+        else:
+            self.total_size = self.inner.total_size
+        logger.info("Compression probe: %.2f, %s", ratio, self.codec.name if self.compressing else "sending as is",
+                    extra={'event': 'compression'})
+        return self
+
+    async def _next_input(self):
+        if self._first:
+            chunk, self._first = self._first, b''
+            return chunk
+        return await self.inner.read(self.chunk_size)
+
+    async def read(self, chunk_size=-1) -> bytes:
+        """The next piece of output; its size depends on how well the input compresses."""
+        if not self.compressing:
+            chunk = await self._next_input()
+        else:
+            chunk = b''
+            while not chunk and self.compressor is not None:
+                data = await self._next_input()
+                if data:
+                    chunk = await asyncio.to_thread(self.compressor.compress, data)
+                else:
+                    chunk, self.compressor = self.compressor.flush(), None
+        # Hashing and progress happen in the inner streamer
+        self.uploaded_size += len(chunk)
+        return chunk
+
+    async def close(self):
+        await self.inner.close()
+
+
+class CompressingSource:
+    """Wraps a source so that what is opened from it is compressed (see CompressingStreamer).
+
+    There is no read_range(): compressed output cannot be read from an offset,
+    so backends that read by range are passed over for these files.
+    """
+
+    def __init__(self, source, codec: Codec, max_ratio: float):
+        self.source = source
+        self.codec = codec
+        self.max_ratio = max_ratio
+        self.name = source.name
+
+    async def open(self, file_path: str, progress=None):
+        inner = await self.source.open(file_path, progress)
+        try:
+            return await CompressingStreamer(inner, self.codec, self.max_ratio).open()
+        except BaseException:
+            await inner.close()
+            raise
+
+
+class _Sink:
+    """Write-only file for zipfile, holding what it is given until it is taken."""
+
+    def __init__(self):
+        self.data = bytearray()
+
+    def write(self, data) -> int:
+        self.data += data
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self) -> bytes:
+        data = bytes(self.data)
+        self.data.clear()
+        return data
+
+
+def unique_names(names) -> list:
+    """`names` with repeats numbered, "a.txt", "a (2).txt", as archive members must differ."""
+    seen = set()
+    unique = []
+    for name in names:
+        stem, dot, extension = name.rpartition('.')
+        if not stem:
+            stem, dot, extension = name, '', ''
+        candidate, n = name, 1
+        while candidate in seen:
+            n += 1
+            candidate = f"{stem} ({n}){dot}{extension}"
+        seen.add(candidate)
+        unique.append(candidate)
+    return unique
+
+
+class ArchiveStreamer(PipelinedStreamer):
+    """A zip archive of several files, produced while they are downloaded one after another.
+
+    Members are deflated when compressed_type() and probe() say it pays off
+    and stored otherwise. Their sizes and checksums follow their data, as zip
+    allows, so nothing has to be known up front and total_size is 0. Progress
+    is counted in bytes downloaded, against the sum of `sizes`.
+    """
+
+    def __init__(self, source, entries, sizes, level: int, max_ratio: float, progress=None):
+        super().__init__()
+        self.source = source
+        self.entries = iter(entries)
+        self.level = level
+        self.max_ratio = max_ratio
+        self.report = progress
+        self.read_size = 0
+        self.read_total = sum(sizes)
+        self.sink = _Sink()
+        self.zip = None
+        self.member = None
+        self.writer = None
+        self.members = 0
+
+    async def open(self):
+        self.zip = zipfile.ZipFile(self.sink, 'w')
+        return self
+
+    async def _start_member(self, name, file_path):
+        self.member = await self.source.open(file_path)
+        # The archive's first byte is timed, not each member's
+        self.member.times_first_byte = False
+        self.chunk_size = self.member.chunk_size
+        first = await self.member.read(self.chunk_size)
+        if not self.members:
+            STAGE_SECONDS.labels('first_byte').observe(time.monotonic() - self.started)
+        info = zipfile.ZipInfo(name, time.localtime()[:6])
+        info.external_attr = 0o644 << 16
+        if not compressed_type(name) and await asyncio.to_thread(probe, first) <= self.max_ratio:
+            info.compress_type = zipfile.ZIP_DEFLATED
+            # Only settable per member through this attribute
+            info._compresslevel = self.level
+        self.writer = self.zip.open(info, 'w')
+        self.members += 1
+        return first
+
+    async def _end_member(self):
+        await asyncio.to_thread(self.writer.close)
+        await self.member.close()
+        self.member = self.writer = None
+
+    async def read(self, chunk_size=-1) -> bytes:
+        while not self.sink.data and self.zip is not None:
+            if self.member is None:
+                entry = next(self.entries, None)
+                if entry is None:
+                    # Writes the central directory
+                    await asyncio.to_thread(self.zip.close)
+                    self.zip = None
+                    break
+                data = await self._start_member(*entry)
+            else:
+                data = await self.member.read(self.chunk_size)
+            if not data:
+                await self._end_member()
+                continue
+            await asyncio.to_thread(self.writer.write, data)
+            self.read_size += len(data)
+            if self.report:
+                self.report.update(self.read_size, self.read_total)
+        # Progress was reported per member above, in bytes read rather than sent
+        chunk = self.sink.take()
+        self.uploaded_size += len(chunk)
+        self.sha256.update(chunk)
+        return chunk
+
+    async def close(self):
+        if self.member is not None:
+            await self.member.close()
+
+
+class ArchiveSource:
+    """A zip of several (name, file_path) entries from `source` as one file to upload
+    (see ArchiveStreamer); the file_path given to open() is ignored. Like
+    CompressingSource, it cannot be read by range."""
+
+    name = "archive"
+
+    def __init__(self, source, entries, sizes, level=6, max_ratio=0.8):
+        names = unique_names(name for name, _ in entries)
+        self.source = source
+        self.entries = [(name, file_path) for name, (_, file_path) in zip(names, entries)]
+        self.sizes = list(sizes)
+        self.level = level
+        self.max_ratio = max_ratio
+
+    async def open(self, file_path=None, progress=None):
+        streamer = ArchiveStreamer(self.source, self.entries, self.sizes, self.level, self.max_ratio, progress)
+        return await streamer.open()
@@ -0,0 +1,205 @@
+import time
+import asyncio
+import logging
+import contextlib
+import contextvars
+from collections import OrderedDict, deque
+from telegram.error import RetryAfter
+from telegram.request import HTTPXRequest
+from metrics import BOT_API_DROPPED, BOT_API_FLOOD_WAITS, BOT_API_QUEUED, BOT_API_WAIT
+from ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Lanes, in the order calls waiting for the same budget go in
+REPLY, PROGRESS = 0, 1
+LANES = ('reply', 'progress')
+
+_lane = contextvars.ContextVar('lane', default=REPLY)
+
+
+@contextlib.contextmanager
+def progress_lane():
+    """Bot API calls made inside go in the progress lane (see BotApiDispatcher)."""
+    token = _lane.set(PROGRESS)
+    try:
+        yield
+    finally:
+        _lane.reset(token)
+
+
+def retry_seconds(error: RetryAfter) -> float:
+    """A RetryAfter's wait in seconds, whether this PTB version gives an int or a timedelta."""
+    retry_after = error.retry_after
+    return retry_after.total_seconds() if hasattr(retry_after, 'total_seconds') else float(retry_after)
+
+
+class _Call:
+    __slots__ = ('lane', 'chat_id', 'key', 'turn', 'replaced')
+
+    def __init__(self, lane, chat_id, key):
+        self.lane = lane
+        self.chat_id = chat_id
+        self.key = key
+        self.turn = asyncio.Event()
+        self.replaced = False
+
+
+class BotApiDispatcher(HTTPXRequest):
+    """Every outgoing Bot API call of one bot, kept within Telegram's flood limits.
+
+    Calls wait their turn: at most `rate` a second in all, and those sending
+    into a chat (with a chat_id) at most `chat_rate` a second in one private
+    chat and `group_rate` in a group, after bursts of `chat_burst`; 0 is no
+    limit.
+    Calls in the reply lane go before those in the progress lane (see
+    progress_lane()), and a progress edit still waiting is dropped when a
+    newer edit of the same message comes, answering True as Telegram does
+    for edits it returns no message for. A 429 holds back the chat it was
+    for, or every call if it was for none, for its retry_after, then the
+    call is made again; only a retry_after over `max_flood_wait` is raised.
+    """
+
+    def __init__(self, rate=30.0, chat_rate=1.0, group_rate=20 / 60, chat_burst=3, max_flood_wait=60.0,
+                 *args, max_chats=10_000, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.rate = rate
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self.max_flood_wait = max_flood_wait
+        self.max_chats = max_chats
+        self.budget = TokenBucket(1, time.monotonic())
+        self.chats = OrderedDict()
+        self.held = {}
+        self.held_all = 0.0
+        self.lanes = (deque(), deque())
+        self.edits = {}
+        self.waiting = {}
+        self.wakeup = asyncio.Event()
+        self.pump = None
+
+    async def post(self, url, request_data=None, *args, **kwargs):
+        parameters = request_data.parameters if request_data else {}
+        chat_id = parameters.get('chat_id')
+        key = (chat_id, parameters.get('message_id')) if url.endswith('/editMessageText') else None
+        lane = _lane.get()
+        while True:
+            if not await self._wait_turn(_Call(lane, chat_id, key)):
+                return True
+            try:
+                return await super().post(url, request_data, *args, **kwargs)
+            except RetryAfter as e:
+                retry_after = retry_seconds(e)
+                self.flooded(retry_after, chat_id)
+                if retry_after > self.max_flood_wait:
+                    BOT_API_DROPPED.labels('flood').inc()
+                    raise
+                BOT_API_FLOOD_WAITS.inc()
+
+    def backlog(self, chat_id=None) -> float:
+        """About how long a call into `chat_id`, or into no chat, made now would wait for its turn."""
+        now = time.monotonic()
+        wait = self.held_all - now
+        if chat_id is not None:
+            bucket, rate = self._chat_budget(chat_id, now)
+            wait = max(wait, self.held.get(chat_id, now) - now)
+            if rate:
+                wait = max(wait, (self.waiting.get(chat_id, 0) + 1 - bucket.tokens) / rate)
+        return max(wait, 0.0)
+
+    def flooded(self, retry_after: float, chat_id=None):
+        """Telegram told this bot to wait `retry_after` seconds, for `chat_id` or for any call."""
+        logger.warning(f"Flood limited for {retry_after:g}s" + (f" in chat {chat_id}" if chat_id is not None else ""))
+        now = time.monotonic()
+        if chat_id is None:
+            self.held_all = max(self.held_all, now + retry_after)
+            return
+        self.held[chat_id] = max(self.held.get(chat_id, 0.0), now + retry_after)
+        # Afterwards the chat goes on at its rate, without another burst
+        bucket, rate = self._chat_budget(chat_id, now)
+        bucket.tokens = min(bucket.tokens, 1 - retry_after * rate)
+
+    async def _wait_turn(self, call: _Call) -> bool:
+        """Wait until `call` may be made; False if a newer edit replaced it meanwhile."""
+        if call.key:
+            waiting = self.edits.get(call.key)
+            if waiting is not None and waiting.lane == PROGRESS:
+                waiting.replaced = True
+                waiting.turn.set()
+                BOT_API_DROPPED.labels('coalesced').inc()
+            self.edits[call.key] = call
+        if call.chat_id is not None:
+            self.waiting[call.chat_id] = self.waiting.get(call.chat_id, 0) + 1
+        self.lanes[call.lane].append(call)
+        BOT_API_QUEUED.labels(LANES[call.lane]).inc()
+        if self.pump is None or self.pump.done():
+            self.pump = asyncio.ensure_future(self._pump())
+        self.wakeup.set()
+        started = time.monotonic()
+        try:
+            await call.turn.wait()
+        finally:
+            # Set as well when the caller gave up, so the pump skips it
+            call.turn.set()
+            BOT_API_QUEUED.labels(LANES[call.lane]).dec()
+            if call.chat_id is not None:
+                self.waiting[call.chat_id] -= 1
+                if not self.waiting[call.chat_id]:
+                    del self.waiting[call.chat_id]
+            if call.key and self.edits.get(call.key) is call:
+                del self.edits[call.key]
+        BOT_API_WAIT.labels(LANES[call.lane]).observe(time.monotonic() - started)
+        return not call.replaced
+
+    async def _pump(self):
+        while any(self.lanes):
+            self.wakeup.clear()
+            delay = self._release(time.monotonic())
+            if delay:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+
+    def _release(self, now: float):
+        """Let the first waiting call whose chat has budget go. Returns 0 if one
+        went, otherwise how long until one may, or None with nothing left waiting."""
+        if self.held_all > now:
+            return self.held_all - now
+        if self.rate:
+            self.budget.refill(self.rate, 1, now)
+            if self.budget.tokens < 1:
+                return (1 - self.budget.tokens) / self.rate
+        delay = None
+        for lane in self.lanes:
+            while lane and lane[0].turn.is_set():
+                lane.popleft()
+            for call in lane:
+                if call.turn.is_set():
+                    continue
+                bucket, rate = self._chat_budget(call.chat_id, now) if call.chat_id is not None else (None, 0)
+                wait = max(self.held.get(call.chat_id, now) - now, (1 - bucket.tokens) / rate if rate else 0)
+                if wait <= 0:
+                    self.held.pop(call.chat_id, None)
+                    if bucket:
+                        bucket.tokens -= 1
+                    self.budget.tokens -= 1
+                    call.turn.set()
+                    return 0
+                delay = wait if delay is None else min(delay, wait)
+        return delay
+
+    def _chat_budget(self, chat_id, now):
+        # Groups and channels have negative ids, or are given by @username
+        rate = self.group_rate if str(chat_id).startswith(('-', '@')) else self.chat_rate
+        bucket = self.chats.get(chat_id)
+        if bucket is None:
+            bucket = self.chats[chat_id] = TokenBucket(self.chat_burst, now)
+            if len(self.chats) > self.max_chats:
+                self.chats.popitem(last=False)
+        else:
+            self.chats.move_to_end(chat_id)
+        if rate:
+            bucket.refill(rate, self.chat_burst, now)
+        return bucket, rate
@@ -0,0 +1,119 @@
+import time
+import asyncio
+import sqlite3
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class UploadHistory:
+    """Every upload a user made, kept on disk for /myfiles and /search.
+
+    Uploads are recorded in memory and written in batches by a background
+    task, at most `flush_interval` seconds later or as soon as `batch_size`
+    rows are waiting. Lookups flush first, waiting out a write already under
+    way, so a user always sees their latest upload. Queries walk the (user_id, id, name) index, so their cost depends
+    on the size of one user's history, not the whole table, and a name search
+    never has to read the rows it skips.
+    """
+
+    def __init__(self, path: str, batch_size=200, flush_interval=1.0):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.pending = []
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS history ("
+            " id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, file_unique_id TEXT NOT NULL,"
+            " name TEXT NOT NULL, size INTEGER NOT NULL, backend TEXT NOT NULL, file_hash TEXT NOT NULL,"
+            " download_url TEXT NOT NULL, created REAL NOT NULL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS history_user ON history (user_id, id, name)")
+        self.db.commit()
+        self._wakeup = asyncio.Event()
+        # Held while a batch is written, so a flush returns only once it is in the table
+        self._flushing = asyncio.Lock()
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._flusher())
+
+    def record(self, user_id: int, file_unique_id: str, name: str, size: int, backend: str, file_hash: str,
+               download_url: str):
+        self.pending.append((user_id, file_unique_id, name, size, backend, file_hash, download_url, time.time()))
+        if len(self.pending) >= self.batch_size:
+            self._wakeup.set()
+
+    async def _flusher(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except sqlite3.Error as e:
+                logger.error(f"Writing upload history failed: {e}")
+
+    async def flush(self):
+        async with self._flushing:
+            if self.pending:
+                rows, self.pending = self.pending, []
+                await asyncio.to_thread(self._write, rows)
+
+    def _write(self, rows):
+        with self.lock:
+            self.db.executemany(
+                "INSERT INTO history (user_id, file_unique_id, name, size, backend, file_hash, download_url, created)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            self.db.commit()
+
+    def _query(self, sql, params):
+        return [
+            {'name': row[0], 'size': row[1], 'download_url': row[2], 'created': row[3]}
+            for row in self.db.execute(sql, params)
+        ]
+
+    def _page(self, user_id, page, page_size):
+        with self.lock:
+            files = self._query(
+                "SELECT name, size, download_url, created FROM history WHERE user_id = ?"
+                " ORDER BY id DESC LIMIT ? OFFSET ?",
+                (user_id, page_size, (page - 1) * page_size),
+            )
+            total = self.db.execute("SELECT COUNT(*) FROM history WHERE user_id = ?", (user_id,)).fetchone()[0]
+        return files, total
+
+    def _search(self, user_id, pattern, limit):
+        with self.lock:
+            return self._query(
+                "SELECT name, size, download_url, created FROM history WHERE user_id = ? AND name LIKE ? ESCAPE '\\'"
+                " ORDER BY id DESC LIMIT ?",
+                (user_id, pattern, limit),
+            )
+
+    async def page(self, user_id: int, page: int, page_size=10):
+        """Returns (files on that page, newest first; total number of files)."""
+        await self.flush()
+        return await asyncio.to_thread(self._page, user_id, page, page_size)
+
+    async def search(self, user_id: int, text: str, limit=10):
+        """The user's newest files whose name contains `text`, case-insensitively."""
+        await self.flush()
+        pattern = '%' + text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        return await asyncio.to_thread(self._search, user_id, pattern, limit)
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        await self.flush()
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,166 @@
+import json
+import time
+import sqlite3
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class JobQueue:
+    """Transfer jobs handed from the ingress process to worker processes.
+
+    A claimed job is leased to one worker. It is done once acked; if the
+    worker dies first the lease runs out and the job is handed out again.
+    """
+
+    def put(self, payload: dict) -> int:
+        """Queue a job; returns how many jobs are ahead of it."""
+        raise NotImplementedError
+
+    def claim(self, worker: str, lease: float):
+        """Lease the oldest available job as (job_id, payload, created), or None.
+
+        `created` is the time.time() the job was put, for the time it waited.
+        """
+        raise NotImplementedError
+
+    def extend(self, job_id: int, worker: str, lease: float) -> bool:
+        """Keep a long-running job leased; False if it was lost to another worker."""
+        raise NotImplementedError
+
+    def ack(self, job_id: int, worker: str):
+        raise NotImplementedError
+
+    def release(self, job_id: int, worker: str):
+        """Hand a claimed job back unfinished, e.g. on shutdown, so it is redelivered right away."""
+        raise NotImplementedError
+
+    def take_all(self) -> list:
+        """Remove every job that is not claimed and return their payloads, oldest first."""
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        raise NotImplementedError
+
+    def set_limits(self, limits: dict):
+        """Store rate limits by name for every process sharing the queue."""
+        raise NotImplementedError
+
+    def limits(self) -> dict:
+        """The rate limits last stored with set_limits()."""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class SqliteJobQueue(JobQueue):
+    """JobQueue in a SQLite file that every process on the host opens.
+
+    Claims happen in an IMMEDIATE transaction, so two workers can never lease
+    the same job. A job that was handed out `max_attempts` times without
+    being acked is set aside as dead rather than retried forever.
+    """
+
+    def __init__(self, path: str, max_attempts=3):
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id INTEGER PRIMARY KEY, payload TEXT NOT NULL, state TEXT NOT NULL DEFAULT 'ready',"
+            " worker TEXT, lease_until REAL NOT NULL DEFAULT 0, attempts INTEGER NOT NULL DEFAULT 0,"
+            " created REAL NOT NULL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, lease_until, id)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS limits (name TEXT PRIMARY KEY, value REAL NOT NULL)")
+
+    def put(self, payload):
+        with self.lock:
+            self.db.execute("INSERT INTO jobs (payload, created) VALUES (?, ?)", (json.dumps(payload), time.time()))
+            return self.db.execute("SELECT COUNT(*) FROM jobs WHERE state = 'ready'").fetchone()[0] - 1
+
+    def claim(self, worker, lease):
+        now = time.time()
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                dead = self.db.execute(
+                    "UPDATE jobs SET state = 'dead' WHERE state = 'claimed' AND lease_until < ? AND attempts >= ?",
+                    (now, self.max_attempts),
+                ).rowcount
+                if dead:
+                    logger.error(f"Gave up on {dead} jobs handed out {self.max_attempts} times without finishing")
+                row = self.db.execute(
+                    "SELECT id, payload, attempts, created FROM jobs WHERE state = 'ready'"
+                    " OR (state = 'claimed' AND lease_until < ?) ORDER BY id LIMIT 1",
+                    (now,),
+                ).fetchone()
+                if row is None:
+                    self.db.execute("COMMIT")
+                    return None
+                if row[2]:
+                    logger.warning(f"Redelivering job {row[0]} (attempt {row[2] + 1})")
+                self.db.execute(
+                    "UPDATE jobs SET state = 'claimed', worker = ?, lease_until = ?, attempts = attempts + 1"
+                    " WHERE id = ?",
+                    (worker, now + lease, row[0]),
+                )
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+        return row[0], json.loads(row[1]), row[3]
+
+    def extend(self, job_id, worker, lease):
+        with self.lock:
+            cursor = self.db.execute(
+                "UPDATE jobs SET lease_until = ? WHERE id = ? AND worker = ? AND state = 'claimed'",
+                (time.time() + lease, job_id, worker),
+            )
+            return cursor.rowcount == 1
+
+    def ack(self, job_id, worker):
+        with self.lock:
+            self.db.execute("DELETE FROM jobs WHERE id = ? AND worker = ?", (job_id, worker))
+
+    def release(self, job_id, worker):
+        with self.lock:
+            # Not counted as an attempt, the job did not fail
+            self.db.execute(
+                "UPDATE jobs SET state = 'ready', worker = NULL, lease_until = 0, attempts = attempts - 1"
+                " WHERE id = ? AND worker = ? AND state = 'claimed'",
+                (job_id, worker),
+            )
+
+    def take_all(self):
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self.db.execute("SELECT id, payload FROM jobs WHERE state = 'ready' ORDER BY id").fetchall()
+                self.db.execute("DELETE FROM jobs WHERE state = 'ready'")
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+        return [json.loads(payload) for _, payload in rows]
+
+    def stats(self):
+        with self.lock:
+            counts = dict(self.db.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+        return {'ready': counts.get('ready', 0), 'claimed': counts.get('claimed', 0), 'dead': counts.get('dead', 0)}
+
+    def set_limits(self, limits):
+        with self.lock:
+            self.db.executemany("INSERT OR REPLACE INTO limits (name, value) VALUES (?, ?)", limits.items())
+
+    def limits(self):
+        with self.lock:
+            return dict(self.db.execute("SELECT name, value FROM limits").fetchall())
+
+    def close(self):
+        with self.lock:
+            self.db.close()
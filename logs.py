@@ -0,0 +1,146 @@
+import sys
+import json
+import zlib
+import queue
+import atexit
+import random
+import logging
+import secrets
+import contextvars
+import logging.handlers
+from datetime import datetime, timezone
+from metrics import LOG_LINES_DROPPED
+
+# Correlation id of the transfer being handled, on every line logged while it is;
+# tasks started from there inherit it
+transfer_id = contextvars.ContextVar('transfer_id', default=None)
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(transfer)s%(message)s'
+
+# Attributes every LogRecord has; anything else on a record came in through `extra`
+RECORD_FIELDS = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'transfer', 'transfer_id'}
+
+_listener = None
+
+
+def new_transfer_id() -> str:
+    """Start a new transfer id for the current task and return it."""
+    value = secrets.token_hex(4)
+    transfer_id.set(value)
+    return value
+
+
+def parse_rates(text: str) -> dict:
+    """LOG_SAMPLE's "name=rate,..." as {name: rate}, names being events or loggers."""
+    rates = {}
+    for item in text.split(","):
+        event, _, rate = item.partition("=")
+        if event.strip():
+            rates[event.strip()] = float(rate)
+    return rates
+
+
+class RecordFilter(logging.Filter):
+    """Tags records with the current transfer id, and keeps only a share of
+    those whose `event` (given with extra={'event': ...}), or else logger
+    name, has a rate in `sample`. The share is taken by transfer id, so the
+    lines of a transfer are kept or dropped together. Warnings and above are
+    always kept."""
+
+    def __init__(self, sample=None):
+        super().__init__()
+        self.sample = sample or {}
+
+    def filter(self, record) -> bool:
+        record.transfer_id = current = transfer_id.get()
+        rate = self.sample.get(getattr(record, 'event', record.name))
+        if rate is None or record.levelno >= logging.WARNING:
+            return True
+        roll = zlib.crc32(current.encode()) / 2**32 if current else random.random()
+        if roll < rate:
+            return True
+        LOG_LINES_DROPPED.labels('sampled').inc()
+        return False
+
+
+class AsyncHandler(logging.handlers.QueueHandler):
+    """Hands records to a QueueListener's thread, which formats and writes them.
+
+    Unlike QueueHandler it does not format in the caller: the message is only
+    put together, from the record's msg and args, once the thread gets to it.
+    A full queue drops the record instead of waiting.
+    """
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_LINES_DROPPED.labels('queue_full').inc()
+
+
+class TextFormatter(logging.Formatter):
+    """The plain format, with the transfer id in brackets on lines that have one."""
+
+    def format(self, record) -> str:
+        current = getattr(record, 'transfer_id', None)
+        record.transfer = f"[{current}] " if current else ''
+        return super().format(record)
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, message, transfer id and any extra fields."""
+
+    def format(self, record) -> str:
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        if getattr(record, 'transfer_id', None):
+            entry['transfer_id'] = record.transfer_id
+        entry.update((key, value) for key, value in vars(record).items() if key not in RECORD_FIELDS)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def setup_logging(fmt="text", level="INFO", sample=None, queue_size=10_000, stream=None):
+    """Replace the root logger's handlers with ones writing `fmt` ("text" or
+    "json") to `stream`, stderr by default.
+
+    With a `queue_size`, lines go through an AsyncHandler to a writer thread,
+    holding up to that many before dropping new ones; 0 writes them in the
+    caller. Call again in a forked process, which does not inherit the thread.
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.setLevel(level)
+
+    output = logging.StreamHandler(stream or sys.stderr)
+    output.setFormatter(JsonFormatter() if fmt == "json" else TextFormatter(TEXT_FORMAT))
+    if not queue_size:
+        output.addFilter(RecordFilter(sample))
+        root.addHandler(output)
+        return None
+    handler = AsyncHandler(queue.Queue(queue_size))
+    handler.addFilter(RecordFilter(sample))
+    root.addHandler(handler)
+    _listener = logging.handlers.QueueListener(handler.queue, output)
+    _listener.start()
+    return _listener
+
+
+@atexit.register
+def _flush():
+    # Whatever is still queued is written before the process exits
+    if _listener is not None:
+        _listener.stop()
@@ -0,0 +1,251 @@
+import math
+import time
+import asyncio
+import logging
+from bisect import bisect_left
+
+logger = logging.getLogger(__name__)
+
+# Seconds, from a cache hit answered on the loop to a transfer of a large file
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _format_labels(names, values, extra=()) -> str:
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value) -> str:
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """A metric family; label values select a child holding the actual numbers.
+
+    Children are created on first use and cached, so the hot path is one dict
+    lookup plus an addition.
+    """
+
+    kind = 'untyped'
+
+    def __init__(self, name: str, help: str, labels=(), registry=None):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.children = {}
+        (REGISTRY if registry is None else registry).register(self)
+        if not self.label_names:
+            # Exported as zero from the start rather than appearing on first use
+            self.labels()
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            if len(values) != len(self.label_names):
+                raise ValueError(f"{self.name} takes labels {self.label_names}, got {values}")
+            child = self.children[values] = self._child()
+        return child
+
+    def _child(self):
+        raise NotImplementedError
+
+    def samples(self):
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines += [f"{name}{labels} {_format_value(value)}" for name, labels, value in self.samples()]
+        return '\n'.join(lines)
+
+
+class _Value:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def _child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def samples(self):
+        for values, child in self.children.items():
+            yield self.name, _format_labels(self.label_names, values), child.value
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, amount=1):
+        self.labels().dec(amount)
+
+    def set(self, value):
+        self.labels().set(value)
+
+
+class _Timer:
+    __slots__ = ('child', 'started')
+
+    def __init__(self, child):
+        self.child = child
+
+    def __enter__(self):
+        self.started = time.monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        self.child.observe(time.monotonic() - self.started)
+
+
+class _Buckets:
+    __slots__ = ('bounds', 'counts', 'sum')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def time(self) -> _Timer:
+        return _Timer(self)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, labels=(), buckets=DEFAULT_BUCKETS, registry=None):
+        self.bounds = tuple(sorted(buckets))
+        super().__init__(name, help, labels, registry)
+
+    def _child(self):
+        return _Buckets(self.bounds)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def time(self) -> _Timer:
+        return self.labels().time()
+
+    def samples(self):
+        for values, child in self.children.items():
+            cumulative = 0
+            for bound, count in zip((*self.bounds, math.inf), child.counts):
+                cumulative += count
+                yield (f"{self.name}_bucket", _format_labels(self.label_names, values, [('le', _format_value(bound))]),
+                       cumulative)
+            yield f"{self.name}_sum", _format_labels(self.label_names, values), child.sum
+            yield f"{self.name}_count", _format_labels(self.label_names, values), cumulative
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric: Metric):
+        if metric.name in self.metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self.metrics[metric.name] = metric
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format."""
+        return '\n'.join(metric.render() for metric in self.metrics.values()) + '\n'
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = Histogram('upload_stage_seconds', "Time spent in each stage of handling a file", ['stage'])
+BACKEND_BYTES = Counter('backend_uploaded_bytes_total', "Bytes uploaded, per backend", ['backend'])
+BACKEND_SECONDS = Counter('backend_upload_seconds_total', "Time spent uploading, per backend", ['backend'])
+BACKEND_FAILURES = Counter('backend_failures_total', "Failed upload attempts, per backend", ['backend'])
+ERRORS = Counter('upload_errors_total', "Files that could not be uploaded, by error type", ['type'])
+IN_FLIGHT = Gauge('transfers_in_flight', "Transfers currently running")
+QUEUED = Gauge('transfers_queued', "Transfers waiting for a worker")
+JOB_QUEUE_JOBS = Gauge('job_queue_jobs', "Jobs in JOB_QUEUE_DB, by state: ready, claimed or dead", ['state'])
+RELAY_LOOKUPS = Counter('relay_lookups_total', "/get share code lookups, by result: memory, disk, miss or stale",
+                        ['result'])
+RELAY_BYTES = Counter('relay_sent_bytes_total', "Bytes sent again by Telegram file_id instead of transferred")
+CACHE_LOOKUPS = Counter('upload_cache_lookups_total', "Upload cache lookups, by result: hit or miss", ['result'])
+CACHE_SAVED_BYTES = Counter('upload_cache_saved_bytes_total', "Bytes not transferred again thanks to an upload "
+                            "cache hit")
+POOL_REQUESTS = Counter('http_pool_requests_total', "Requests through the connection pool, per host", ['host'])
+POOL_CONNECTIONS = Counter('http_pool_connections_total', "Connections the pool had to open, per host; the "
+                           "other requests reused one", ['host'])
+LOG_LINES_DROPPED = Counter('log_lines_dropped_total', "Log lines not written, by reason: sampled or queue_full",
+                            ['reason'])
+PREFLIGHT_REJECTS = Counter('preflight_rejects_total', "Files turned away by the pre-flight checks before any "
+                            "transfer, by reason: blocked_type, unavailable or destination_down", ['reason'])
+
+SHARD_MESSAGES = Counter('shard_messages_total', "Messages taken, per bot and how: private, home (the user's own "
+                         "bot in a group), moved (off a flood limited or backed up bot), handoff or addressed "
+                         "(a /command@bot)", ['shard', 'route'])
+SHARD_FLOODS = Counter('shard_floods_total', "429 answers from the Bot API, per bot", ['shard'])
+
+BOT_API_QUEUED = Gauge('bot_api_calls_queued', "Bot API calls waiting for their turn, per lane: reply or progress",
+                       ['lane'])
+BOT_API_WAIT = Histogram('bot_api_wait_seconds', "Time Bot API calls waited for their turn, per lane", ['lane'])
+BOT_API_DROPPED = Counter('bot_api_calls_dropped_total', "Bot API calls not made, by reason: coalesced (a newer "
+                          "edit of the message came) or flood (a retry_after too long to wait)", ['reason'])
+BOT_API_FLOOD_WAITS = Counter('bot_api_flood_waits_total', "429 answers from the Bot API waited out and retried")
+
+
+class MetricsServer:
+    """Serves GET /metrics over plain HTTP for a Prometheus scraper."""
+
+    def __init__(self, registry=REGISTRY, host='0.0.0.0', port=9464):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._serve, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        logger.info(f"Metrics on http://{self.host}:{self.port}/metrics")
+
+    async def stop(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+
+    async def _serve(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()).strip():
+                pass
+            parts = request_line.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+                status, body = '200 OK', self.registry.render().encode()
+            else:
+                status, body = '404 Not Found', b'not found\n'
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
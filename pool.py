@@ -0,0 +1,75 @@
+import logging
+import httpx
+from metrics import POOL_CONNECTIONS, POOL_REQUESTS
+from transfer import TRANSFER_TIMEOUT, ssl_context
+
+logger = logging.getLogger(__name__)
+
+
+class PoolStats:
+    def __init__(self):
+        self.requests = 0
+        # A miss is a request that had to open a new connection
+        self.misses = 0
+
+    @property
+    def hits(self):
+        return self.requests - self.misses
+
+    def as_dict(self):
+        return {'requests': self.requests, 'hits': self.hits, 'misses': self.misses}
+
+
+class CountingTransport(httpx.AsyncHTTPTransport):
+    """httpx transport that records how often a pooled connection was reused."""
+
+    def __init__(self, stats: PoolStats, host='', **kwargs):
+        super().__init__(**kwargs)
+        self.stats = stats
+        self.requests = POOL_REQUESTS.labels(host)
+        connections = POOL_CONNECTIONS.labels(host)
+        create_connection = self._pool.create_connection
+
+        def counting_create_connection(origin):
+            stats.misses += 1
+            connections.inc()
+            return create_connection(origin)
+
+        self._pool.create_connection = counting_create_connection
+
+    async def handle_async_request(self, request):
+        self.stats.requests += 1
+        self.requests.inc()
+        return await super().handle_async_request(request)
+
+
+class HttpPool:
+    """One keep-alive client per upstream host, shared by every transfer in the process."""
+
+    def __init__(self, max_connections=20, max_keepalive=10, idle_timeout=60.0, timeout=TRANSFER_TIMEOUT):
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive,
+            keepalive_expiry=idle_timeout,
+        )
+        self.timeout = timeout
+        self.clients = {}
+        self.host_stats = {}
+
+    def client_for(self, url: str) -> httpx.AsyncClient:
+        host = httpx.URL(url).netloc.decode()
+        client = self.clients.get(host)
+        if client is None:
+            stats = self.host_stats[host] = PoolStats()
+            transport = CountingTransport(stats, host, limits=self.limits, verify=ssl_context())
+            client = self.clients[host] = httpx.AsyncClient(transport=transport, timeout=self.timeout)
+        return client
+
+    def stats(self) -> dict:
+        return {host: stats.as_dict() for host, stats in self.host_stats.items()}
+
+    async def aclose(self):
+        for host, client in self.clients.items():
+            logger.info(f"Connection pool {host}: {self.host_stats[host].as_dict()}")
+            await client.aclose()
+        self.clients.clear()
@@ -0,0 +1,208 @@
+import re
+import time
+import asyncio
+import logging
+import mimetypes
+import unicodedata
+import httpx
+from telegram.error import BadRequest, TelegramError
+from metrics import PREFLIGHT_REJECTS, STAGE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Longest file name most file systems and the upload hosts take, in UTF-8 bytes
+MAX_NAME_BYTES = 255
+# Bytes read from the start of a file to tell its type
+SNIFF_SIZE = 4096
+
+# (offset, signature, MIME type), the first match wins
+SIGNATURES = [
+    (0, b'\xff\xd8\xff', 'image/jpeg'),
+    (0, b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (0, b'GIF87a', 'image/gif'),
+    (0, b'GIF89a', 'image/gif'),
+    (0, b'%PDF-', 'application/pdf'),
+    (0, b'PK\x03\x04', 'application/zip'),
+    (0, b'PK\x05\x06', 'application/zip'),
+    (0, b'\x1f\x8b', 'application/gzip'),
+    (0, b'BZh', 'application/x-bzip2'),
+    (0, b'\xfd7zXZ\x00', 'application/x-xz'),
+    (0, b'(\xb5/\xfd', 'application/zstd'),
+    (0, b"7z\xbc\xaf'\x1c", 'application/x-7z-compressed'),
+    (0, b'Rar!\x1a\x07', 'application/vnd.rar'),
+    (0, b'\x1aE\xdf\xa3', 'video/x-matroska'),
+    (0, b'OggS', 'audio/ogg'),
+    (0, b'ID3', 'audio/mpeg'),
+    (0, b'fLaC', 'audio/flac'),
+    (0, b'MZ', 'application/x-msdownload'),
+    (0, b'\x7fELF', 'application/x-executable'),
+    (0, b'#!', 'text/x-shellscript'),
+    (4, b'ftypqt', 'video/quicktime'),
+    (4, b'ftypM4A', 'audio/mp4'),
+    (4, b'ftyp', 'video/mp4'),
+]
+RIFF_TYPES = {b'WEBP': 'image/webp', b'WAVE': 'audio/wav', b'AVI ': 'video/x-msvideo'}
+
+
+class Rejected(Exception):
+    """A file that cannot be uploaded, found before it was transferred. The
+    message is shown to the user, `reason` labels the reject metric."""
+
+    def __init__(self, reason: str, message: str):
+        super().__init__(message)
+        self.reason = reason
+
+
+def normalize_name(name, mime_type=None, default="file") -> str:
+    """A file name that is safe to upload and show.
+
+    Directories, control and reserved characters are removed. Only a missing
+    name, or one with nothing left after that, becomes `default`; a real name
+    such as "none.txt" is kept. An extension for `mime_type` is added when
+    there is none, and the stem is shortened to fit MAX_NAME_BYTES.
+    """
+    name = unicodedata.normalize('NFC', str(name or ''))
+    name = name.replace('\\', '/').rsplit('/', 1)[-1]
+    name = ''.join(c if c.isprintable() else ' ' for c in name)
+    name = re.sub(r'[<>:"|?*]', '_', ' '.join(name.split())).strip('. ')
+    stem, dot, extension = name.rpartition('.')
+    if not dot:
+        stem, extension = name, ''
+    if not extension and mime_type:
+        extension = (mimetypes.guess_extension(mime_type, strict=False) or '').lstrip('.')
+    suffix = f".{extension}" if extension else ''
+    room = MAX_NAME_BYTES - len(suffix.encode())
+    stem = stem.encode()[:room].decode(errors='ignore').rstrip() or default
+    return stem + suffix
+
+
+def sniff(head: bytes):
+    """The MIME type the first bytes of a file show, or None if they match nothing known."""
+    if head[:4] == b'RIFF' and head[8:12] in RIFF_TYPES:
+        return RIFF_TYPES[head[8:12]]
+    for offset, signature, mime_type in SIGNATURES:
+        if head[offset:offset + len(signature)] == signature:
+            return mime_type
+    return None
+
+
+class HealthCheck:
+    """Whether upload hosts answer at all, probed with a HEAD request at most
+    every `ttl` seconds each. Callers arriving while a probe runs share it.
+    Any answer below 500 counts as healthy, a 405 for the HEAD included."""
+
+    def __init__(self, pool, ttl=30.0, timeout=5.0):
+        self.pool = pool
+        self.ttl = ttl
+        self.timeout = timeout
+        self.probes = {}
+        self.probed = 0
+
+    async def healthy(self, url: str) -> bool:
+        checked, probe = self.probes.get(url, (0.0, None))
+        if probe is None or time.monotonic() - checked >= self.ttl:
+            probe = asyncio.ensure_future(self._probe(url))
+            self.probes[url] = (time.monotonic(), probe)
+        # One caller giving up must not cancel the probe for the others
+        return await asyncio.shield(probe)
+
+    async def _probe(self, url: str) -> bool:
+        self.probed += 1
+        try:
+            response = await self.pool.client_for(url).head(url, timeout=self.timeout)
+        except httpx.HTTPError as e:
+            logger.warning(f"Health probe of {url} failed: {e}")
+            return False
+        if response.status_code >= 500:
+            logger.warning(f"Health probe of {url} answered {response.status_code}")
+            return False
+        return True
+
+
+def refused(error: Exception) -> bool:
+    """Whether failing to get at a file was a definite no, rather than a blip
+    (a timeout, a dropped connection, a 429 or a 5xx) that may not recur."""
+    if isinstance(error, httpx.HTTPStatusError):
+        return 400 <= error.response.status_code < 500 and error.response.status_code != 429
+    return isinstance(error, BadRequest)
+
+
+class Checked:
+    """What the pre-flight checks found out about a file that can be uploaded."""
+
+    def __init__(self, filename: str, file_path: str, mime_type=None):
+        self.filename = filename
+        self.file_path = file_path
+        self.mime_type = mime_type
+
+
+class Preflight:
+    """Cheap checks before a file is transferred, so doomed ones cost no transfer.
+
+    check() resolves the file's path, reads its first SNIFF_SIZE bytes with a
+    Range request to learn its type, and checks that at least one upload
+    backend answers (see HealthCheck). Types starting with one of
+    `blocked_types`, by name or by content, are refused. It is meant to run
+    while the file waits in the queue; the path it resolved is reused for the
+    transfer. A file Telegram refuses is rejected, but one it could not be
+    asked about just then (see refused()) goes on to the transfer unchecked.
+    """
+
+    def __init__(self, source, router, health: HealthCheck, blocked_types=()):
+        self.source = source
+        self.router = router
+        self.health = health
+        self.blocked_types = tuple(t.strip().lower() for t in blocked_types if t.strip())
+        self.checked = 0
+
+    def blocked(self, mime_type) -> bool:
+        return bool(mime_type and self.blocked_types and mime_type.lower().startswith(self.blocked_types))
+
+    async def destination_up(self) -> bool:
+        urls = [backend.health_url for backend in self.router.backends]
+        if not all(urls):
+            # A backend that cannot be probed is given the benefit of the doubt
+            return True
+        return any(await asyncio.gather(*(self.health.healthy(url) for url in urls)))
+
+    async def check(self, bot, filename, file_size, file_id, file_unique_id) -> Checked:
+        """Raises Rejected when the file cannot be uploaded."""
+        self.checked += 1
+        try:
+            with STAGE_SECONDS.labels('preflight').time():
+                return await self._check(bot, filename, file_size, file_id)
+        except Rejected as e:
+            logger.info("Pre-flight rejected %s: %s", filename, e.reason, extra={'event': 'preflight_rejected'})
+            PREFLIGHT_REJECTS.labels(e.reason).inc()
+            raise
+
+    async def _check(self, bot, filename, file_size, file_id) -> Checked:
+        named_type, _ = mimetypes.guess_type(filename, strict=False)
+        if self.blocked(named_type):
+            raise Rejected('blocked_type', f"Files of type {named_type} are not accepted.")
+        destination = asyncio.ensure_future(self.destination_up())
+        file_path = None
+        try:
+            try:
+                file_path = (await bot.get_file(file_id)).file_path
+                head = b''
+                if file_size:
+                    head = await self.source.read_range(file_path, 0, min(SNIFF_SIZE, file_size))
+            except (TelegramError, httpx.HTTPError, OSError) as e:
+                if refused(e):
+                    logger.warning(f"Pre-flight could not read {filename}: {e}")
+                    raise Rejected('unavailable', "Telegram could not provide this file. Please send it again.")
+                # Left unchecked to the transfer, which gets the path itself if it is still missing
+                logger.warning(f"Pre-flight could not check {filename}, transferring it unchecked: {e}")
+                return Checked(filename, file_path)
+            sniffed = sniff(head)
+            if self.blocked(sniffed):
+                raise Rejected('blocked_type', f"Files of type {sniffed} are not accepted.")
+            if not await destination:
+                raise Rejected('destination_down',
+                               "The upload service is not reachable right now. Please try again later.")
+        finally:
+            destination.cancel()
+        if sniffed and '.' not in filename:
+            filename = normalize_name(filename, sniffed)
+        return Checked(filename, file_path, sniffed or named_type)
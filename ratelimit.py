@@ -0,0 +1,152 @@
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+LIMITS = ('user_files_per_minute', 'global_files_per_minute', 'user_bytes_per_second', 'global_bytes_per_second')
+
+
+class TokenBucket:
+    """Tokens refill at `rate` per second up to `burst`. The rate is passed in
+    on every call, so changing a limit applies to existing buckets at once."""
+
+    __slots__ = ('tokens', 'stamp')
+
+    def __init__(self, tokens: float, now: float):
+        self.tokens = tokens
+        self.stamp = now
+
+    def refill(self, rate: float, burst: float, now: float):
+        self.tokens = min(burst, self.tokens + (now - self.stamp) * rate)
+        self.stamp = now
+
+
+class UserBuckets:
+    __slots__ = ('files', 'bytes', 'seen')
+
+    def __init__(self, files_burst, bytes_burst, now):
+        self.files = TokenBucket(files_burst, now)
+        self.bytes = TokenBucket(bytes_burst, now)
+        self.seen = now
+
+
+class RateLimiter:
+    """Token-bucket limits on files per minute (admission) and bytes per second
+    (shaping), for every user and for the bot as a whole. A limit of 0 is off.
+
+    Files over the limit are turned away by admit(). Bytes are never refused;
+    shaper() returns a function a transfer awaits per chunk, which sleeps just
+    long enough to keep the user's and the global rate, so a heavy user slows
+    down instead of failing. A user's buckets are dropped once they have been
+    idle for `idle_timeout` (by then they would be full again anyway), oldest
+    first, and there are never more than `max_users` of them.
+    """
+
+    def __init__(self, user_files_per_minute=0, global_files_per_minute=0, user_bytes_per_second=0,
+                 global_bytes_per_second=0, idle_timeout=600.0, max_users=100_000):
+        self.limits = {}
+        self.idle_timeout = idle_timeout
+        self.max_users = max_users
+        self.users = OrderedDict()
+        now = time.monotonic()
+        self.global_files = TokenBucket(0, now)
+        self.global_bytes = TokenBucket(0, now)
+        self.admitted = 0
+        self.rejected = 0
+        self.throttled = 0.0
+        self.configure(user_files_per_minute=user_files_per_minute, global_files_per_minute=global_files_per_minute,
+                       user_bytes_per_second=user_bytes_per_second, global_bytes_per_second=global_bytes_per_second)
+        self.global_files.tokens = self.limits['global_files_per_minute']
+        self.global_bytes.tokens = self.limits['global_bytes_per_second']
+
+    def configure(self, **limits):
+        """Change limits while running, e.g. configure(user_bytes_per_second=5_000_000)."""
+        for name, value in limits.items():
+            if name not in LIMITS:
+                raise ValueError(f"Unknown limit {name!r}, expected one of {', '.join(LIMITS)}")
+            if value < 0:
+                raise ValueError(f"{name} must not be negative")
+            self.limits[name] = float(value)
+        logger.info(f"Rate limits: {self.limits}")
+
+    def _buckets(self, user_id, now) -> UserBuckets:
+        buckets = self.users.get(user_id)
+        if buckets is None:
+            buckets = self.users[user_id] = UserBuckets(
+                self.limits['user_files_per_minute'], self.limits['user_bytes_per_second'], now)
+        else:
+            buckets.seen = now
+            self.users.move_to_end(user_id)
+        # Least recently seen first, so this stops at the first user still active
+        while self.users:
+            oldest = next(iter(self.users.values()))
+            if now - oldest.seen < self.idle_timeout and len(self.users) <= self.max_users:
+                break
+            self.users.popitem(last=False)
+        return buckets
+
+    def admit(self, user_id) -> float:
+        """Take a file from the user's and the global allowance. Returns 0 if it
+        may go ahead, otherwise how many seconds until it could."""
+        user_limit = self.limits['user_files_per_minute']
+        global_limit = self.limits['global_files_per_minute']
+        if not user_limit and not global_limit:
+            self.admitted += 1
+            return 0.0
+        now = time.monotonic()
+        wait = 0.0
+        buckets = self._buckets(user_id, now)
+        if user_limit:
+            buckets.files.refill(user_limit / 60, user_limit, now)
+            if buckets.files.tokens < 1:
+                wait = (1 - buckets.files.tokens) * 60 / user_limit
+        if global_limit:
+            self.global_files.refill(global_limit / 60, global_limit, now)
+            if self.global_files.tokens < 1:
+                wait = max(wait, (1 - self.global_files.tokens) * 60 / global_limit)
+        if wait:
+            self.rejected += 1
+            return wait
+        if user_limit:
+            buckets.files.tokens -= 1
+        if global_limit:
+            self.global_files.tokens -= 1
+        self.admitted += 1
+        return 0.0
+
+    async def throttle(self, user_id, size: int):
+        """Account for `size` bytes sent on behalf of the user, sleeping if that
+        puts them or the bot over the byte rate. Buckets may go into debt, so
+        concurrent transfers share the rate instead of all waiting for a refill."""
+        user_rate = self.limits['user_bytes_per_second']
+        global_rate = self.limits['global_bytes_per_second']
+        if not user_rate and not global_rate:
+            return
+        now = time.monotonic()
+        wait = 0.0
+        if user_rate:
+            bucket = self._buckets(user_id, now).bytes
+            bucket.refill(user_rate, user_rate, now)
+            bucket.tokens -= size
+            if bucket.tokens < 0:
+                wait = -bucket.tokens / user_rate
+        if global_rate:
+            self.global_bytes.refill(global_rate, global_rate, now)
+            self.global_bytes.tokens -= size
+            if self.global_bytes.tokens < 0:
+                wait = max(wait, -self.global_bytes.tokens / global_rate)
+        if wait:
+            self.throttled += wait
+            await asyncio.sleep(wait)
+
+    def shaper(self, user_id):
+        """The per-chunk hook transfers take as `throttle`."""
+        async def throttle(size):
+            await self.throttle(user_id, size)
+        return throttle
+
+    def stats(self) -> dict:
+        return {'admitted': self.admitted, 'rejected': self.rejected, 'throttled_seconds': round(self.throttled, 1),
+                'users': len(self.users)}
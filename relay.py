@@ -0,0 +1,143 @@
+import time
+import base64
+import sqlite3
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def share_code(file_unique_id: str) -> str:
+    """The short code /get takes for a file; the same file always gets the same one.
+
+    50 bits of a hash, so codes cannot be guessed and collisions are unlikely
+    to ever happen at the table sizes used here.
+    """
+    digest = hashlib.blake2b(file_unique_id.encode(), digest_size=10).digest()
+    return base64.b32encode(digest).decode().lower()[:10]
+
+
+class RelayCache:
+    """The latest Telegram file_id of each file the bot has seen, by share code.
+
+    A bot can send a file again by its file_id without the bytes going
+    anywhere, so /get answers from here with no transfer at all. Entries are
+    looked up in memory first, an LRU of `memory_entries`, then on disk, where
+    the least recently used beyond `max_entries` are evicted (hits in memory
+    do not count as uses there). Each chat also
+    keeps its `chat_entries` most recently seen files for listing.
+    """
+
+    def __init__(self, path: str, max_entries=100_000, memory_entries=10_000, chat_entries=20):
+        self.max_entries = max_entries
+        self.memory_entries = memory_entries
+        self.chat_entries = chat_entries
+        self.memory = OrderedDict()
+        self.writes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS relay ("
+            " code TEXT PRIMARY KEY, file_unique_id TEXT NOT NULL, file_id TEXT NOT NULL, kind TEXT NOT NULL,"
+            " name TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS relay_last_used ON relay (last_used)")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS relay_chats ("
+            " chat_id INTEGER NOT NULL, code TEXT NOT NULL, seen REAL NOT NULL, PRIMARY KEY (chat_id, code))"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS relay_chats_seen ON relay_chats (chat_id, seen)")
+        self.db.commit()
+
+    def _keep(self, code: str, entry: dict):
+        self.memory[code] = entry
+        self.memory.move_to_end(code)
+        while len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
+
+    def remember(self, chat_id: int, file_unique_id: str, file_id: str, kind: str, name: str, size: int) -> str:
+        """Store the file_id a file was just seen with in `chat_id`; returns its share code.
+
+        `kind` is what sends it again: "document", "video" or "photo".
+        """
+        code = share_code(file_unique_id)
+        now = time.time()
+        entry = {'file_unique_id': file_unique_id, 'file_id': file_id, 'kind': kind, 'name': name, 'size': size}
+        with self.lock:
+            self._keep(code, entry)
+            self.db.execute("INSERT OR REPLACE INTO relay VALUES (?, ?, ?, ?, ?, ?, ?)",
+                            (code, file_unique_id, file_id, kind, name, size, now))
+            self.db.execute("INSERT OR REPLACE INTO relay_chats VALUES (?, ?, ?)", (chat_id, code, now))
+            self.db.execute(
+                "DELETE FROM relay_chats WHERE chat_id = ? AND code IN ("
+                " SELECT code FROM relay_chats WHERE chat_id = ? ORDER BY seen DESC LIMIT -1 OFFSET ?)",
+                (chat_id, chat_id, self.chat_entries),
+            )
+            # Eviction walks the whole index, so it runs every 1% of the table's
+            # size in writes, which it may overshoot by as much
+            self.writes += 1
+            if self.writes % max(1, self.max_entries // 100) == 0:
+                self.db.execute(
+                    "DELETE FROM relay WHERE code IN ("
+                    " SELECT code FROM relay ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,),
+                )
+            self.db.commit()
+        return code
+
+    def get(self, code: str):
+        """The entry for a share code, with where it was found as 'source', or None."""
+        with self.lock:
+            entry = self.memory.get(code)
+            if entry is not None:
+                self.memory.move_to_end(code)
+                self.hits += 1
+                return {**entry, 'source': 'memory'}
+            row = self.db.execute(
+                "SELECT file_unique_id, file_id, kind, name, size FROM relay WHERE code = ?", (code,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.db.execute("UPDATE relay SET last_used = ? WHERE code = ?", (time.time(), code))
+            self.db.commit()
+            entry = dict(zip(('file_unique_id', 'file_id', 'kind', 'name', 'size'), row))
+            self._keep(code, entry)
+            self.hits += 1
+            self.disk_hits += 1
+        return {**entry, 'source': 'disk'}
+
+    def forget(self, code: str):
+        """Drop a code whose file_id Telegram no longer accepts."""
+        with self.lock:
+            self.memory.pop(code, None)
+            self.db.execute("DELETE FROM relay WHERE code = ?", (code,))
+            self.db.execute("DELETE FROM relay_chats WHERE code = ?", (code,))
+            self.db.commit()
+
+    def recent(self, chat_id: int, limit: int) -> list:
+        """The files last seen in a chat, newest first, with their codes."""
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT r.code, r.name, r.size FROM relay_chats c JOIN relay r ON r.code = c.code"
+                " WHERE c.chat_id = ? ORDER BY c.seen DESC LIMIT ?",
+                (chat_id, limit),
+            ).fetchall()
+        return [{'code': code, 'name': name, 'size': size} for code, name, size in rows]
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else None, 'in_memory': len(self.memory)}
+
+    def close(self):
+        logger.info(f"Relay cache: {self.stats()}")
+        with self.lock:
+            self.db.close()
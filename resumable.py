@@ -0,0 +1,166 @@
+import os
+import json
+import random
+import asyncio
+import logging
+import httpx
+
+logger = logging.getLogger(__name__)
+
+
+class SessionExpired(Exception):
+    pass
+
+
+class Checkpoint:
+    """Upload session state persisted as a small JSON file, so a restarted
+    process resumes with the chunks that are still missing."""
+
+    def __init__(self, directory: str, key: str):
+        safe_key = "".join(c if c.isalnum() or c in '-_' else '_' for c in key)
+        self.path = os.path.join(directory, f"{safe_key}.json")
+        self.upload_id = None
+        self.size = 0
+        self.chunk_size = 0
+        self.done = set()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return self
+        self.upload_id = state['upload_id']
+        self.size = state['size']
+        self.chunk_size = state['chunk_size']
+        self.done = set(state['done'])
+        return self
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        state = {'upload_id': self.upload_id, 'size': self.size, 'chunk_size': self.chunk_size,
+                 'done': sorted(self.done)}
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.path)
+
+    def delete(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class ResumableUploader:
+    """Uploads a file in ranges to a target speaking a small chunked protocol:
+
+        POST {url}                      {"filename", "size"} -> {"upload_id"}
+        PUT  {url}/{upload_id}          one chunk, with Content-Range: bytes a-b/size
+        POST {url}/{upload_id}/complete -> the final JSON result
+
+    Up to `parallel` chunks are in flight at once. A failed chunk is retried
+    with exponential backoff, and finished chunks are checkpointed under `key`
+    so an interrupted upload only sends what is missing when it runs again.
+    The checkpoint is removed once the upload completes or fails for good.
+    """
+
+    def __init__(self, pool, url: str, checkpoint_dir: str, chunk_size=8 * 1024 * 1024, parallel=4,
+                 retries=5, backoff=0.5):
+        self.pool = pool
+        self.url = url.rstrip('/')
+        self.checkpoint_dir = checkpoint_dir
+        self.chunk_size = chunk_size
+        self.parallel = parallel
+        self.retries = retries
+        self.backoff = backoff
+        self.retried = 0
+
+    async def upload(self, key: str, filename: str, size: int, read_range, progress=None) -> httpx.Response:
+        """`read_range(offset, length)` must return that slice of the file's bytes."""
+        checkpoint = await asyncio.to_thread(Checkpoint(self.checkpoint_dir, key).load)
+        if checkpoint.upload_id and (checkpoint.size, checkpoint.chunk_size) != (size, self.chunk_size):
+            checkpoint = Checkpoint(self.checkpoint_dir, key)
+        try:
+            try:
+                return await self._upload(checkpoint, filename, size, read_range, progress)
+            except SessionExpired:
+                logger.warning(f"Upload session {checkpoint.upload_id} for {key} expired, starting over")
+                await asyncio.to_thread(checkpoint.delete)
+                checkpoint = Checkpoint(self.checkpoint_dir, key)
+                try:
+                    return await self._upload(checkpoint, filename, size, read_range, progress)
+                except SessionExpired:
+                    # An IOError, so the router tries the next backend
+                    raise IOError(f"Upload session for {key} expired again after starting over") from None
+        except Exception:
+            # Nothing will resume it; only an interrupted (cancelled) upload keeps its checkpoint
+            await asyncio.to_thread(checkpoint.delete)
+            raise
+
+    async def _upload(self, checkpoint, filename, size, read_range, progress):
+        client = self.pool.client_for(self.url)
+        if not checkpoint.upload_id:
+            response = await self._retrying(client.post, self.url, json={'filename': filename, 'size': size})
+            checkpoint.upload_id = response.json()['upload_id']
+            checkpoint.size = size
+            checkpoint.chunk_size = self.chunk_size
+            await asyncio.to_thread(checkpoint.save)
+        else:
+            logger.info(f"Resuming upload {checkpoint.upload_id}: {len(checkpoint.done)} chunks already sent")
+
+        chunks = range((size + self.chunk_size - 1) // self.chunk_size)
+        missing = [index for index in chunks if index not in checkpoint.done]
+        slots = asyncio.Semaphore(self.parallel)
+        save_lock = asyncio.Lock()
+
+        async def send_chunk(index):
+            offset = index * self.chunk_size
+            length = min(self.chunk_size, size - offset)
+            async with slots:
+                await self._retrying(self._put_chunk, client, checkpoint.upload_id, offset, length, size, read_range)
+            async with save_lock:
+                checkpoint.done.add(index)
+                await asyncio.to_thread(checkpoint.save)
+            if progress:
+                progress.update(min(size, len(checkpoint.done) * self.chunk_size), size)
+
+        tasks = [asyncio.create_task(send_chunk(index)) for index in missing]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        response = await self._retrying(client.post, f"{self.url}/{checkpoint.upload_id}/complete")
+        await asyncio.to_thread(checkpoint.delete)
+        return response
+
+    async def _put_chunk(self, client, upload_id, offset, length, size, read_range):
+        data = await read_range(offset, length)
+        if len(data) != length:
+            raise IOError(f"Short read at {offset}: got {len(data)} of {length} bytes")
+        headers = {'Content-Range': f"bytes {offset}-{offset + length - 1}/{size}"}
+        return await client.put(f"{self.url}/{upload_id}", content=data, headers=headers)
+
+    async def _retrying(self, func, *args, **kwargs) -> httpx.Response:
+        for attempt in range(self.retries + 1):
+            try:
+                response = await func(*args, **kwargs)
+                if response.status_code == 404:
+                    raise SessionExpired()
+                response.raise_for_status()
+                return response
+            except httpx.HTTPStatusError as e:
+                # Also covers the source failing to hand out a range
+                if e.response.status_code < 500 and e.response.status_code != 429:
+                    raise
+                error = f"HTTP {e.response.status_code}"
+            except (httpx.TransportError, IOError) as e:
+                error = str(e) or type(e).__name__
+            if attempt == self.retries:
+                raise IOError(f"Upload failed after {self.retries} retries: {error}")
+            self.retried += 1
+            delay = self.backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+            logger.warning(f"Upload request failed ({error}), retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
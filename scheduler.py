@@ -0,0 +1,149 @@
+import time
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from metrics import QUEUED, STAGE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, user_id, func, payload=None):
+        self.user_id = user_id
+        self.func = func
+        self.payload = payload
+        self.enqueued = time.monotonic()
+
+
+class TransferScheduler:
+    """Bounded job queue drained by a fixed number of workers.
+
+    Every user has their own FIFO and workers take jobs from the users in
+    round-robin order, so a user with a long backlog only delays their own
+    files.
+    """
+
+    def __init__(self, workers=4, max_queued=100, max_queued_per_user=20):
+        self.workers = workers
+        self.max_queued = max_queued
+        self.max_queued_per_user = max_queued_per_user
+        self.queues = OrderedDict()
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.rejected = 0
+        self.waits = deque(maxlen=1000)
+        self.closed = False
+        self._running = set()
+        self._ready = asyncio.Semaphore(0)
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._tasks = []
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        logger.info(f"Scheduler: {self.stats()}")
+
+    async def drain(self, timeout: float) -> list:
+        """Stop taking jobs and give the queued and running ones `timeout` seconds
+        to finish, then stop. Returns the payloads of the jobs that did not
+        finish, running ones (now cancelled) first."""
+        self.closed = True
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"{self.running} running and {self.queued} queued jobs left after {timeout:.0f}s")
+        left = [job.payload for job in self._running]
+        left += [job.payload for queue in self.queues.values() for job in queue]
+        await self.stop()
+        return [payload for payload in left if payload is not None]
+
+    def submit(self, user_id, func, payload=None) -> int:
+        """Queue `func()` for `user_id`. `payload` describes the job for drain().
+
+        Returns the job's place in line, or 0 if a worker will pick it up right
+        away. Raises QueueFull when the global or per-user limit is reached, or
+        once draining has begun.
+        """
+        queue = self.queues.get(user_id)
+        if self.closed or self.queued >= self.max_queued or (queue and len(queue) >= self.max_queued_per_user):
+            self.rejected += 1
+            raise QueueFull()
+        if queue is None:
+            queue = self.queues[user_id] = deque()
+        queue.append(Job(user_id, func, payload))
+        self.queued += 1
+        QUEUED.inc()
+        self._idle.clear()
+        position = self._position(user_id, len(queue) - 1)
+        self._ready.release()
+        idle = self.workers - self.running
+        return max(0, position - idle)
+
+    def _position(self, user_id, index) -> int:
+        # Jobs served before this one: each user ahead in the rotation gets up
+        # to index + 1 turns first, each user behind it up to index turns
+        ahead = index
+        before = True
+        for other, queue in self.queues.items():
+            if other == user_id:
+                before = False
+                continue
+            ahead += min(len(queue), index + 1 if before else index)
+        return ahead + 1
+
+    def _next_job(self) -> Job:
+        user_id, queue = next(iter(self.queues.items()))
+        job = queue.popleft()
+        if queue:
+            self.queues.move_to_end(user_id)
+        else:
+            del self.queues[user_id]
+        self.queued -= 1
+        QUEUED.dec()
+        return job
+
+    async def _worker(self):
+        while True:
+            await self._ready.acquire()
+            job = self._next_job()
+            wait = time.monotonic() - job.enqueued
+            self.waits.append(wait)
+            STAGE_SECONDS.labels('queue_wait').observe(wait)
+            self.running += 1
+            self._running.add(job)
+            try:
+                await job.func()
+            except Exception:
+                logger.exception(f"Job for user {job.user_id} failed")
+            finally:
+                self._running.discard(job)
+                self.running -= 1
+                self.completed += 1
+                if not self.queued and not self.running:
+                    self._idle.set()
+
+    async def join(self):
+        """Wait until every queued job has finished."""
+        await self._idle.wait()
+
+    def stats(self) -> dict:
+        waits = sorted(self.waits)
+        return {
+            'queued': self.queued,
+            'running': self.running,
+            'completed': self.completed,
+            'rejected': self.rejected,
+            'wait_avg': sum(waits) / len(waits) if waits else 0.0,
+            'wait_p95': waits[int(len(waits) * 0.95)] if waits else 0.0,
+        }
@@ -0,0 +1,125 @@
+import time
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from dispatcher import BotApiDispatcher
+from metrics import SHARD_FLOODS, SHARD_MESSAGES
+
+logger = logging.getLogger(__name__)
+
+
+def rank(user_id: int, shards) -> list:
+    """`shards` ordered by rendezvous hash with the user: the same user always
+    gets the same order, and a shard joining or leaving only moves the users
+    that rank it first."""
+    def weight(shard):
+        return hashlib.blake2b(f"{user_id}:{shard}".encode(), digest_size=8).digest()
+    return sorted(shards, key=weight)
+
+
+class _Claim:
+    """Which shard took a message, once one has."""
+
+    __slots__ = ('shard', 'taken')
+
+    def __init__(self):
+        self.shard = None
+        self.taken = asyncio.Event()
+
+
+class ShardRouter:
+    """Decides which of several bots handles a message, when more than one got it.
+
+    A private chat only ever reaches the bot the user wrote to, and Telegram
+    file_ids only work for the bot that received them, so those messages stay
+    where they are. In a group every member bot (with privacy mode off) gets
+    its own copy of each message. The first bot in the user's rank() takes
+    it, so a user sticks to one bot. A bot answered with a 429 is skipped
+    until its retry_after has passed, in the chat the 429 was for or, if it
+    was for none, everywhere, and so is one whose ShardRequest has so many
+    calls waiting for the chat's budget that a new one would wait more than
+    `handoff`; that moves its users' new messages to their next bot
+    meanwhile. Other copies wait up to `handoff` seconds for
+    the chosen bot's; if it does not come, the first of them to give up takes
+    the message, and the chosen bot is taken for not being in the group until
+    a message of the group reaches it. A command naming one bot, as in
+    /myfiles@bot, only reaches that bot's handlers, so that bot takes it.
+    """
+
+    def __init__(self, shards: int, handoff=2.0, max_messages=10_000):
+        self.shards = shards
+        self.handoff = handoff
+        self.max_messages = max_messages
+        self.absent = {}
+        self.claims = OrderedDict()
+        self.cooling = {}
+        self.requests = {}
+
+    def flood(self, shard: int, retry_after: float, chat_id=None):
+        """The Bot API told `shard` to wait `retry_after` seconds, in `chat_id` or everywhere."""
+        until = time.monotonic() + retry_after
+        self.cooling[shard, chat_id] = max(self.cooling.get((shard, chat_id), 0.0), until)
+        SHARD_FLOODS.labels(str(shard)).inc()
+
+    def healthy(self, shard: int, chat_id=None) -> bool:
+        now = time.monotonic()
+        if now < self.cooling.get((shard, None), 0.0) or now < self.cooling.get((shard, chat_id), 0.0):
+            return False
+        request = self.requests.get(shard)
+        return request is None or request.backlog(chat_id) <= self.handoff
+
+    async def take(self, shard: int, update, addressed=False) -> bool:
+        """Whether `shard` handles its copy of `update`. Call once per copy;
+        `addressed` for a command naming this bot, which the others ignore."""
+        chat, user, message = update.effective_chat, update.effective_user, update.effective_message
+        if chat is None or chat.type == chat.PRIVATE or user is None or message is None:
+            SHARD_MESSAGES.labels(str(shard), 'private').inc()
+            return True
+        absent = self.absent.setdefault(chat.id, set())
+        absent.discard(shard)
+        key = (chat.id, message.message_id)
+        claim = self.claims.get(key)
+        if claim is None:
+            claim = self.claims[key] = _Claim()
+            if len(self.claims) > self.max_messages:
+                self.claims.popitem(last=False)
+        if addressed:
+            # No other copy is coming, so nothing is learned about the other bots either
+            if claim.shard is not None:
+                return False
+            return self._claim(claim, shard, 'addressed')
+        ranked = rank(user.id, [candidate for candidate in range(self.shards) if candidate not in absent])
+        owner = next((candidate for candidate in ranked if self.healthy(candidate, chat.id)), ranked[0])
+        if claim.shard is None and shard == owner:
+            return self._claim(claim, shard, 'home' if shard == ranked[0] else 'moved')
+        try:
+            await asyncio.wait_for(claim.taken.wait(), self.handoff)
+        except asyncio.TimeoutError:
+            pass
+        if claim.shard is not None:
+            return False
+        if owner != shard:
+            absent.add(owner)
+        return self._claim(claim, shard, 'handoff')
+
+    def _claim(self, claim, shard, route) -> bool:
+        claim.shard = shard
+        claim.taken.set()
+        SHARD_MESSAGES.labels(str(shard), route).inc()
+        return True
+
+
+class ShardRequest(BotApiDispatcher):
+    """The Bot API calls of one bot of several, telling the ShardRouter about 429s
+    and letting it see how many are waiting."""
+
+    def __init__(self, router: ShardRouter, shard: int, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.router = router
+        self.shard = shard
+        router.requests[shard] = self
+
+    def flooded(self, retry_after: float, chat_id=None):
+        super().flooded(retry_after, chat_id)
+        self.router.flood(self.shard, retry_after, chat_id)
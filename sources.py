@@ -0,0 +1,74 @@
+import os
+import asyncio
+from transfer import LocalFileStreamer, RangedFileStreamer, TelegramFileStreamer
+
+MB = 1024 * 1024
+
+
+class BotApiSource:
+    """Files fetched from api.telegram.org, which only serves bots files up to 20MB.
+
+    With `max_ranges` above 1, files are downloaded as parallel Range requests
+    (see RangedFileStreamer), otherwise over a single stream.
+    """
+
+    name = "telegram"
+    max_file_size = 20 * MB
+
+    def __init__(self, pool, max_ranges=1, range_size=2 * MB, buffer_size=32 * MB):
+        self.pool = pool
+        self.max_ranges = max_ranges
+        self.range_size = range_size
+        self.buffer_size = buffer_size
+
+    async def open(self, file_path: str, progress=None):
+        client = self.pool.client_for(file_path)
+        if self.max_ranges > 1:
+            streamer = RangedFileStreamer(client, file_path, progress, self.max_ranges, self.range_size,
+                                          self.buffer_size)
+        else:
+            streamer = TelegramFileStreamer(client, file_path, progress)
+        return await streamer.open()
+
+    async def read_range(self, file_path: str, offset: int, length: int) -> bytes:
+        end = offset + length - 1
+        client = self.pool.client_for(file_path)
+        async with client.stream("GET", file_path, headers={'Range': f"bytes={offset}-{end}"}) as response:
+            response.raise_for_status()
+            if response.status_code == 206:
+                return await response.aread()
+            # The server ignored the Range header and sends the whole file: read only up to the range
+            data = bytearray()
+            async for chunk in response.aiter_bytes():
+                data += chunk
+                if len(data) > end:
+                    break
+            return bytes(data[offset:end + 1])
+
+
+class LocalBotApiSource(BotApiSource):
+    """Files fetched through a self-hosted Bot API server running with --local.
+
+    That server hands out files up to 2000MB as absolute paths in its working
+    directory. When the directory is mounted here the file is read from disk,
+    otherwise the path is fetched over HTTP from the file URL PTB built for it,
+    which should point at a server exposing that directory.
+    """
+
+    name = "local"
+    max_file_size = 2000 * MB
+
+    async def open(self, file_path: str, progress=None):
+        if os.path.isfile(file_path):
+            return await LocalFileStreamer(file_path, progress).open()
+        return await super().open(file_path, progress)
+
+    async def read_range(self, file_path: str, offset: int, length: int) -> bytes:
+        if os.path.isfile(file_path):
+            return await asyncio.to_thread(read_file_range, file_path, offset, length)
+        return await super().read_range(file_path, offset, length)
+
+
+def read_file_range(path: str, offset: int, length: int) -> bytes:
+    with open(path, 'rb') as f:
+        return os.pread(f.fileno(), length, offset)
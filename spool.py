@@ -0,0 +1,56 @@
+import os
+import asyncio
+import logging
+import tempfile
+from transfer import MappedFileStreamer
+
+logger = logging.getLogger(__name__)
+
+
+class Spool:
+    """A download written in full to a temp file before it is uploaded.
+
+    The Telegram connection is done with as soon as the file is on disk, even
+    if the upload is slower, and a failed upload attempt can be retried (or
+    tried on the next backend) from the file instead of downloading it again.
+    The spool is a source for its one file: uploads read it through a memory
+    map, so memory stays flat whatever the size.
+
+    The temp file is unlinked from the start and goes away with close(), or
+    with the process.
+    """
+
+    name = "spool"
+    # Its download was timed to the first byte already (see FileStreamer)
+    times_first_byte = False
+
+    def __init__(self, file, size: int, sha256):
+        self.file = file
+        self.size = size
+        self.sha256 = sha256
+
+    @classmethod
+    async def download(cls, source, file_path: str, directory=None) -> "Spool":
+        file = await asyncio.to_thread(tempfile.TemporaryFile, dir=directory)
+        try:
+            streamer = await source.open(file_path)
+            try:
+                async for chunk in streamer:
+                    await asyncio.to_thread(file.write, chunk)
+            finally:
+                await streamer.close()
+            await asyncio.to_thread(file.flush)
+        except BaseException:
+            file.close()
+            raise
+        logger.info("Spooled %d bytes of %s", streamer.uploaded_size, file_path, extra={'event': 'spooled'})
+        return cls(file, streamer.uploaded_size, streamer.sha256)
+
+    async def open(self, file_path: str = None, progress=None):
+        return await MappedFileStreamer(self.file, progress, self.sha256.copy()).open()
+
+    async def read_range(self, file_path: str, offset: int, length: int) -> bytes:
+        return await asyncio.to_thread(os.pread, self.file.fileno(), length, offset)
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,438 @@
+import os
+import ssl
+import mmap
+import time
+import uuid
+import asyncio
+import hashlib
+import functools
+import logging
+import certifi
+import httpx
+from metrics import STAGE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Uploads can take a while for the server to acknowledge once the body is sent,
+# so only the connect phase gets a short timeout.
+TRANSFER_TIMEOUT = httpx.Timeout(120.0, connect=10.0)
+
+# Chunks scale with the file so a transfer is around 64 chunks, within these bounds
+MIN_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 1024 * 1024
+
+# Tries per range of a parallel download before the whole transfer fails
+RANGE_ATTEMPTS = 2
+# Ranges are made long enough for the wait before their first byte to be about
+# this fraction of their time, as each range waits once
+RANGE_WAIT_SHARE = 0.1
+
+
+@functools.cache
+def ssl_context() -> ssl.SSLContext:
+    # Loading the CA bundle takes tens of milliseconds of blocking work, so it
+    # is done once, when the first client is created rather than at import
+    return ssl.create_default_context(cafile=certifi.where())
+
+
+def chunk_size_for(total_size: int) -> int:
+    return min(MAX_CHUNK_SIZE, max(MIN_CHUNK_SIZE, total_size // 64))
+
+
+class SourceError(Exception):
+    """Reading the file from where it comes from failed, rather than sending it on."""
+
+
+class ProgressReporter:
+    """Throttles progress updates to at most one per `interval` seconds or per
+    `step` of the file, whichever comes first.
+
+    The callback is a coroutine function taking (done, total). It runs in the
+    background so a slow callback never holds up the transfer; updates that
+    arrive while it is still running are dropped, unless `overlap` is set
+    because something further on keeps only the newest of those still
+    waiting (as BotApiDispatcher does with progress edits).
+    """
+
+    def __init__(self, callback, interval=3.0, step=None, overlap=False):
+        self.callback = callback
+        self.interval = interval
+        self.step = step
+        self.overlap = overlap
+        self.last_time = time.monotonic()
+        self.last_fraction = 0.0
+        self.pending = []
+
+    def update(self, done: int, total: int):
+        now = time.monotonic()
+        fraction = done / total if total else 0.0
+        due = now - self.last_time >= self.interval
+        if self.step and fraction - self.last_fraction >= self.step:
+            due = True
+        self.pending = [task for task in self.pending if not task.done()]
+        if not due or (self.pending and not self.overlap):
+            return
+        self.last_time = now
+        self.last_fraction = fraction
+        self.pending.append(asyncio.create_task(self._report(done, total)))
+
+    async def _report(self, done, total):
+        try:
+            await self.callback(done, total)
+        except Exception as e:
+            # A missed progress update is harmless, e.g. an edit that changed nothing
+            logger.debug(f"Progress callback failed: {e}")
+
+    async def close(self):
+        # Let in-flight updates land before the caller writes its final state
+        if self.pending:
+            await asyncio.gather(*self.pending, return_exceptions=True)
+
+
+class FileStreamer:
+    """Bookkeeping shared by every download: byte count, content hash and progress.
+
+    `throttle`, if set, is a coroutine function awaited with the size of each
+    chunk before it is passed on, e.g. RateLimiter.shaper().
+    """
+
+    def __init__(self, progress: ProgressReporter = None, throttle=None):
+        self.progress = progress
+        self.throttle = throttle
+        self.total_size = 0
+        self.uploaded_size = 0
+        self.chunk_size = MIN_CHUNK_SIZE
+        self.sha256 = hashlib.sha256()
+        self.started = time.monotonic()
+
+    # Off for sources that already know the hash of their content
+    hash_chunks = True
+    # Added to the uploaded file's name, e.g. ".gz" when the content is compressed on the way
+    suffix = ''
+    # Off where the transfer's first byte is timed elsewhere, so it is timed once per transfer
+    times_first_byte = True
+
+    def _consumed(self, chunk: bytes):
+        if not self.uploaded_size and self.times_first_byte:
+            STAGE_SECONDS.labels('first_byte').observe(time.monotonic() - self.started)
+        self.uploaded_size += len(chunk)
+        if self.hash_chunks:
+            self.sha256.update(chunk)
+        if self.progress:
+            self.progress.update(self.uploaded_size, self.total_size)
+
+    async def read(self, chunk_size=-1) -> bytes:
+        raise NotImplementedError
+
+    async def __aiter__(self):
+        while chunk := await self.read(self.chunk_size):
+            if self.throttle:
+                await self.throttle(len(chunk))
+            yield chunk
+
+    async def close(self):
+        pass
+
+
+class TelegramFileStreamer(FileStreamer):
+    def __init__(self, client: httpx.AsyncClient, file_path: str, progress: ProgressReporter = None):
+        super().__init__(progress)
+        self.client = client
+        self.file_path = file_path
+        self.response = None
+        self._stream = None
+        self._buffer = bytearray()
+
+    async def open(self):
+        request = self.client.build_request("GET", self.file_path)
+        self.response = await self.client.send(request, stream=True)
+        self.response.raise_for_status()
+        self.total_size = int(self.response.headers.get('content-length', 0))
+        self.chunk_size = chunk_size_for(self.total_size)
+        self._stream = self.response.aiter_bytes()
+        return self
+
+    async def read(self, chunk_size=-1) -> bytes:
+        """Return up to chunk_size bytes (everything left if negative), b'' at the end."""
+        while chunk_size < 0 or len(self._buffer) < chunk_size:
+            data = await anext(self._stream, b'')
+            if not data:
+                break
+            self._buffer += data
+        if chunk_size < 0 or chunk_size >= len(self._buffer):
+            chunk = bytes(self._buffer)
+            self._buffer.clear()
+        else:
+            chunk = bytes(self._buffer[:chunk_size])
+            del self._buffer[:chunk_size]
+        if chunk:
+            self._consumed(chunk)
+        return chunk
+
+    async def close(self):
+        if self.response is not None:
+            await self.response.aclose()
+
+
+class RangedFileStreamer(TelegramFileStreamer):
+    """Downloads a file as concurrent HTTP Range requests and hands the bytes on in order.
+
+    One connection's throughput is capped by its window over the round trip,
+    so a high-latency link only fills up with several. The first request asks
+    for the first `range_size` bytes; a server that ignores Range answers with
+    the whole file, which is then streamed as by TelegramFileStreamer.
+
+    Otherwise the first range's wait for its first byte and its throughput
+    after that set the size of the others, at least `range_size` and long
+    enough that the wait is a small share of each (RANGE_WAIT_SHARE). They are
+    fetched `width` at a time. Once a whole `width` of them finished since the
+    last change, the width doubles (up to `max_ranges`) if each still got most
+    of what the first range got alone: connections are then limited each on
+    their own rather than sharing a bottleneck. It shrinks by one when they
+    got less than half. Ranges that arrive ahead of their turn wait in a
+    reorder buffer, and no range is started that would not fit in
+    `buffer_size` bytes together with the ones waiting.
+    """
+
+    def __init__(self, client: httpx.AsyncClient, file_path: str, progress: ProgressReporter = None, max_ranges=8,
+                 range_size=2 * 1024 * 1024, buffer_size=32 * 1024 * 1024):
+        super().__init__(client, file_path, progress)
+        self.max_ranges = max_ranges
+        self.range_size = range_size
+        self.buffer_size = buffer_size
+        self.width = min(2, max_ranges)
+        self.parallel = False
+        self.ranges = []  # (start, end) of every range after the first, end exclusive
+        self.fetches = {}  # range index -> task, running or done but not read yet
+        self.started_ranges = 0
+        self.read_ranges = 0
+        self.current = memoryview(b'')
+        self.single_rate = None
+        self.rates = []  # bytes/sec of each range finished at the current width
+
+    async def open(self):
+        headers = {'Range': f"bytes=0-{self.range_size - 1}"}
+        started = time.monotonic()
+        self.response = await self.client.send(self.client.build_request("GET", self.file_path, headers=headers),
+                                               stream=True)
+        self.response.raise_for_status()
+        wait = time.monotonic() - started
+        if self.response.status_code != 206:
+            logger.info("No range support for %s, downloading as one stream", self.file_path,
+                        extra={'event': 'no_ranges'})
+            self.total_size = int(self.response.headers.get('content-length', 0))
+            self.chunk_size = chunk_size_for(self.total_size)
+            self._stream = self.response.aiter_bytes()
+            return self
+        self.parallel = True
+        self.total_size = int(self.response.headers['content-range'].rsplit('/', 1)[1])
+        self.chunk_size = chunk_size_for(self.total_size)
+        first = await self.response.aread()
+        await self.response.aclose()
+        self.single_rate = len(first) / max(time.monotonic() - started - wait, 1e-6)
+        self.current = memoryview(first)
+        wait_bound = int(self.single_rate * wait * (1 - RANGE_WAIT_SHARE) / RANGE_WAIT_SHARE)
+        self.range_size = max(self.range_size, min(wait_bound, self.buffer_size // 4))
+        self.ranges = [(start, min(start + self.range_size, self.total_size))
+                       for start in range(len(first), self.total_size, self.range_size)]
+        self._start_fetches()
+        return self
+
+    def _start_fetches(self):
+        # The range being read takes a slot of the buffer too
+        slots = max(1, min(self.width, self.buffer_size // self.range_size - 1))
+        while self.started_ranges < len(self.ranges) and len(self.fetches) < slots:
+            start, end = self.ranges[self.started_ranges]
+            self.fetches[self.started_ranges] = asyncio.create_task(self._fetch(start, end))
+            self.started_ranges += 1
+
+    async def _fetch(self, start: int, end: int) -> bytes:
+        for attempt in range(1, RANGE_ATTEMPTS + 1):
+            try:
+                async with self.client.stream("GET", self.file_path,
+                                              headers={'Range': f"bytes={start}-{end - 1}"}) as response:
+                    response.raise_for_status()
+                    first_byte = time.monotonic()
+                    content = await response.aread()
+                if response.status_code != 206 or len(content) != end - start:
+                    raise httpx.RemoteProtocolError(f"Asked for bytes {start}-{end - 1}, got {response.status_code} "
+                                                    f"with {len(content)} bytes")
+            except httpx.HTTPError as e:
+                if attempt == RANGE_ATTEMPTS:
+                    raise
+                logger.warning(f"Range {start}-{end - 1} of {self.file_path} failed, retrying: {e}")
+                continue
+            self._adapt(len(content) / max(time.monotonic() - first_byte, 1e-6))
+            return content
+
+    def _adapt(self, rate: float):
+        self.rates.append(rate)
+        if len(self.rates) < self.width:
+            return
+        rate = sum(self.rates) / len(self.rates)
+        self.rates.clear()
+        if rate >= 0.8 * self.single_rate and self.width < self.max_ranges:
+            self.width = min(self.width * 2, self.max_ranges)
+        elif rate < 0.5 * self.single_rate and self.width > 1:
+            self.width -= 1
+
+    async def read(self, chunk_size=-1):
+        if not self.parallel:
+            return await super().read(chunk_size)
+        if not self.current:
+            if self.read_ranges >= len(self.ranges):
+                return b''
+            self.current = memoryview(await self.fetches.pop(self.read_ranges))
+            self.read_ranges += 1
+            self._start_fetches()
+        size = len(self.current) if chunk_size < 0 else min(chunk_size, len(self.current))
+        chunk, self.current = self.current[:size], self.current[size:]
+        self._consumed(chunk)
+        return chunk
+
+    async def close(self):
+        for task in self.fetches.values():
+            task.cancel()
+        await asyncio.gather(*self.fetches.values(), return_exceptions=True)
+        self.fetches.clear()
+        if self.parallel:
+            logger.info("Downloaded %s in %d ranges, %d at a time at the end", self.file_path, len(self.ranges) + 1,
+                        self.width, extra={'event': 'ranges'})
+        await super().close()
+
+
+class LocalFileStreamer(FileStreamer):
+    """Reads a file on disk, e.g. one stored by a local Bot API server, off the event loop."""
+
+    def __init__(self, path: str, progress: ProgressReporter = None):
+        super().__init__(progress)
+        self.path = path
+        self.file = None
+
+    async def open(self):
+        self.file = await asyncio.to_thread(open, self.path, 'rb')
+        self.total_size = os.fstat(self.file.fileno()).st_size
+        self.chunk_size = chunk_size_for(self.total_size)
+        return self
+
+    async def read(self, chunk_size=-1) -> bytes:
+        chunk = await asyncio.to_thread(self.file.read, chunk_size)
+        if chunk:
+            self._consumed(chunk)
+        return chunk
+
+    async def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+class MappedFileStreamer(FileStreamer):
+    """Reads an open file through a memory map, handing out views of it rather than copies.
+
+    Pages that were already passed on are dropped from the map as it goes, so
+    resident memory stays at about a chunk whatever the file size. `sha256`
+    may be a hash of the content computed earlier, which is then not redone.
+    """
+
+    def __init__(self, file, progress: ProgressReporter = None, sha256=None):
+        super().__init__(progress)
+        self.file = file
+        self.map = None
+        self.offset = 0
+        if sha256 is not None:
+            self.sha256 = sha256
+            self.hash_chunks = False
+
+    # Only ever reads a download spooled to disk, which was timed as it came in
+    times_first_byte = False
+
+    async def open(self):
+        self.total_size = os.fstat(self.file.fileno()).st_size
+        self.chunk_size = chunk_size_for(self.total_size)
+        if self.total_size:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.map.madvise(mmap.MADV_SEQUENTIAL)
+        return self
+
+    async def read(self, chunk_size=-1) -> memoryview:
+        if self.map is None or self.offset >= self.total_size:
+            return b''
+        # Whatever was returned before has been written out by now
+        done = self.offset - self.offset % mmap.PAGESIZE
+        if done:
+            self.map.madvise(mmap.MADV_DONTNEED, 0, done)
+        end = self.total_size if chunk_size < 0 else min(self.total_size, self.offset + chunk_size)
+        chunk = memoryview(self.map)[self.offset:end]
+        self.offset = end
+        self._consumed(chunk)
+        return chunk
+
+    async def close(self):
+        if self.map is not None:
+            try:
+                self.map.close()
+            except BufferError:
+                # A view is still referenced somewhere; the map is closed once it is collected
+                pass
+
+
+def _quote(value: str) -> str:
+    # Same escaping httpx applies to multipart form parameters
+    return value.replace('\\', '\\\\').replace('"', '%22').replace('\r', '%0D').replace('\n', '%0A')
+
+
+class MultipartStream:
+    """Single-file multipart/form-data body that is produced while the source is read."""
+
+    def __init__(self, field: str, filename: str, source, size: int = 0):
+        self.boundary = uuid.uuid4().hex
+        self.source = source
+        self.size = size
+        self.head = (
+            f'--{self.boundary}\r\n'
+            f'Content-Disposition: form-data; name="{_quote(field)}"; filename="{_quote(filename)}"\r\n'
+            f'Content-Type: application/octet-stream\r\n\r\n'
+        ).encode()
+        self.tail = f'\r\n--{self.boundary}--\r\n'.encode()
+        self.sent_at = None
+
+    @property
+    def headers(self) -> dict:
+        headers = {'Content-Type': f'multipart/form-data; boundary={self.boundary}'}
+        if self.size:
+            headers['Content-Length'] = str(len(self.head) + self.size + len(self.tail))
+        return headers
+
+    async def __aiter__(self):
+        yield self.head
+        chunks = aiter(self.source)
+        while True:
+            try:
+                chunk = await anext(chunks)
+            except StopAsyncIteration:
+                break
+            except SourceError:
+                raise
+            except Exception as e:
+                # Told apart from the upload failing, which httpx raises outside this loop
+                raise SourceError(str(e) or type(e).__name__) from e
+            yield chunk
+        yield self.tail
+        self.sent_at = time.monotonic()
+
+
+async def stream_upload(pool, streamer: FileStreamer, filename: str, upload_url: str):
+    """Pipe an opened download straight into a multipart upload, closing it afterwards.
+
+    Returns the upload response, the sha256 of the bytes that were sent and how
+    long the server took to answer once the body was complete.
+    """
+    try:
+        body = MultipartStream('file', filename + streamer.suffix, streamer, streamer.total_size)
+        response = await pool.client_for(upload_url).post(upload_url, content=body, headers=body.headers)
+        latency = time.monotonic() - (body.sent_at or time.monotonic())
+        logger.info("Transferred %d of %d bytes", streamer.uploaded_size, streamer.total_size,
+                    extra={'event': 'transferred'})
+        return response, streamer.sha256.hexdigest(), latency
+    finally:
+        await streamer.close()
@@ -0,0 +1,173 @@
+"""Transfer worker processes for a bot running with JOB_QUEUE_DB set.
+
+The bot process only takes updates and queues transfer jobs; these processes
+claim them, transfer the files and answer the user. Run as many as the host
+has cores and bandwidth for, next to the bot:
+
+    JOB_QUEUE_DB=jobs.db python bot.py
+    JOB_QUEUE_DB=jobs.db python worker.py --processes 4
+
+With METRICS_PORT set each process serves its own /metrics, worker n on
+METRICS_PORT + n (counting from 1), for the transfers it ran; the bot serves
+the job queue depth on METRICS_PORT itself. Rate limits changed with /limits
+are stored in the queue and picked up within LIMITS_POLL_INTERVAL seconds.
+
+Budgets stay per process otherwise. BOT_API_RATE is split evenly between the
+bot and WORKER_PROCESSES workers, so start as many as that says; the Bot API
+chat budgets and RATE_GLOBAL_BYTES_PER_SECOND apply to each process alone.
+"""
+import os
+import socket
+import time
+import signal
+import asyncio
+import logging
+import argparse
+import contextlib
+import multiprocessing
+from telegram import Bot
+
+import bot
+from jobqueue import SqliteJobQueue
+from metrics import STAGE_SECONDS, MetricsServer
+
+logger = logging.getLogger(__name__)
+
+# How long an idle worker waits before asking the queue again
+IDLE_POLL_INTERVAL = 0.2
+# How often the rate limits the bot stores in the queue (/limits) are read again
+LIMITS_POLL_INTERVAL = 5.0
+
+
+class WorkerContext:
+    """Stands in for the CallbackContext the bot's transfer functions expect."""
+
+    def __init__(self, telegram_bot: Bot, bot_data: dict):
+        self.bot = telegram_bot
+        self.bot_data = bot_data
+        self.user_data = {}
+
+
+async def keep_leased(queue, job_id, name, lease):
+    while True:
+        await asyncio.sleep(lease / 3)
+        if not await asyncio.to_thread(queue.extend, job_id, name, lease):
+            logger.warning(f"Lost the lease on job {job_id}, another worker may run it too")
+            return
+
+
+async def follow_limits(queue, limiter):
+    while True:
+        limits = await asyncio.to_thread(queue.limits)
+        changed = {name: value for name, value in limits.items() if limiter.limits.get(name) != value}
+        if changed:
+            limiter.configure(**changed)
+        await asyncio.sleep(LIMITS_POLL_INTERVAL)
+
+
+async def work(queue, contexts, name, lease, stopping):
+    while not stopping.is_set():
+        claimed = await asyncio.to_thread(queue.claim, name, lease)
+        if claimed is None:
+            try:
+                await asyncio.wait_for(stopping.wait(), IDLE_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        job_id, job, created = claimed
+        STAGE_SECONDS.labels('queue_wait').observe(max(0.0, time.time() - created))
+        # Answered by the bot the job came in through
+        context = contexts[job.get('shard', 0)] if job.get('shard', 0) < len(contexts) else contexts[0]
+        keepalive = asyncio.create_task(keep_leased(queue, job_id, name, lease))
+        try:
+            await bot.run_job(bot.job_update(context.bot, job), context, job['files'], job['album'],
+                              job.get('archive', False), transfer=job.get('transfer_id'))
+        except asyncio.CancelledError:
+            # Out of time on shutdown; handed back so another worker takes it over now
+            queue.release(job_id, name)
+            raise
+        except Exception:
+            # Left unacked, so it is retried once the lease runs out
+            logger.exception(f"Job {job_id} failed")
+            continue
+        finally:
+            keepalive.cancel()
+        await asyncio.to_thread(queue.ack, job_id, name)
+
+
+async def run_worker(queue_path, concurrency, lease, tokens, base_url=None, base_file_url=None, local_mode=False,
+                     metrics_port=None):
+    name = f"{socket.gethostname()}:{os.getpid()}"
+    stopping = asyncio.Event()
+    # On SIGTERM the jobs in hand get SHUTDOWN_TIMEOUT seconds to finish
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stopping.set)
+    kwargs = {'base_url': base_url, 'base_file_url': base_file_url or base_url} if base_url else {}
+    queue = SqliteJobQueue(queue_path)
+    async with contextlib.AsyncExitStack() as bots:
+        bot_data = {}
+        contexts = []
+        for token in tokens:
+            telegram_bot = Bot(token, request=bot.bot_api_request(), local_mode=local_mode, **kwargs)
+            contexts.append(WorkerContext(await bots.enter_async_context(telegram_bot), bot_data))
+        bot.create_services(bot_data, local_mode)
+        if metrics_port:
+            metrics_server = MetricsServer(host=bot.METRICS_LISTEN, port=metrics_port)
+            await metrics_server.start()
+            bots.push_async_callback(metrics_server.stop)
+        logger.info(f"Worker {name} started with {concurrency} transfer slots")
+        workers = [asyncio.create_task(work(queue, contexts, name, lease, stopping)) for _ in range(concurrency)]
+        limits = asyncio.create_task(follow_limits(queue, bot_data['rate_limiter']))
+        try:
+            await stopping.wait()
+            _, unfinished = await asyncio.wait(workers, timeout=bot.SHUTDOWN_TIMEOUT)
+            for task in unfinished:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+        finally:
+            limits.cancel()
+            await bot.close_services(bot_data)
+            queue.close()
+    logger.info(f"Worker {name} stopped")
+
+
+def worker_main(*args):
+    # Leave SIGINT to the parent, which turns it into SIGTERM for everyone
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    bot.configure_logging()
+    asyncio.run(run_worker(*args))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--processes', type=int, default=bot.WORKER_PROCESSES)
+    parser.add_argument('--concurrency', type=int, default=bot.WORKER_CONCURRENCY, help="transfers per process")
+    args = parser.parse_args()
+    tokens = bot.TELEGRAM_TOKENS or [bot.TELEGRAM_TOKEN]
+    if not all(tokens) or not bot.JOB_QUEUE_DB:
+        logger.error("Missing TELEGRAM_TOKEN or JOB_QUEUE_DB!")
+        exit(1)
+    if args.processes > bot.WORKER_PROCESSES:
+        logger.warning(f"BOT_API_RATE is split between {bot.WORKER_PROCESSES + 1} processes, not "
+                       f"{args.processes + 1}; set WORKER_PROCESSES instead of --processes")
+
+    worker_args = (bot.JOB_QUEUE_DB, args.concurrency, bot.JOB_LEASE, tokens,
+                   bot.BOT_API_URL, bot.BOT_API_FILE_URL, bot.BOT_API_LOCAL)
+    processes = [
+        multiprocessing.Process(target=worker_main,
+                                args=(*worker_args, bot.METRICS_PORT and int(bot.METRICS_PORT) + n))
+        for n in range(1, args.processes + 1)
+    ]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+
+
+if __name__ == "__main__":
+    main()